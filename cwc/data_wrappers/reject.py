@@ -1,9 +1,109 @@
+import hashlib
+from collections import OrderedDict
+
 import numpy
 from mpl_toolkits.mplot3d import Axes3D
 import matplotlib.pyplot as plt
 from sklearn.decomposition import PCA
+from sklearn.decomposition import IncrementalPCA
+from sklearn.utils.extmath import randomized_svd
+from scipy.special import ndtri
+from scipy.special import gammaln
+from sklearn.neighbors import KernelDensity
+
+# Projections fitted by fit_pca, by content of the data-points and options
+PCA_CACHE = OrderedDict()
+PCA_CACHE_SIZE = 16
+
+def check_random_state(random_state):
+    """Random number generator for random_state.
+
+    Args:
+        random_state (None, int or numpy.random.RandomState): None uses the
+            global generator of numpy.random, an int seeds a new generator.
+
+    Returns:
+        (numpy.random.RandomState): the generator.
+    """
+    if random_state is None:
+        return numpy.random.mtrand._rand
+    if isinstance(random_state, numpy.random.RandomState):
+        return random_state
+    return numpy.random.RandomState(random_state)
+
+
+def first_primes(n):
+    """The n first prime numbers."""
+    primes = []
+    candidate = 2
+    while len(primes) < n:
+        if all(candidate % p for p in primes if p*p <= candidate):
+            primes.append(candidate)
+        candidate += 1
+    return numpy.array(primes)
+
+
+def halton_sequence(size, dimensions, random_state=None, start=0):
+    """Points of a scrambled Halton sequence in the unit hypercube.
+
+    The coordinate j of the point i is the radical inverse of i + 1 in the
+    base of the j-th prime number, with every digit replaced by a random
+    permutation of the digits of the base (a different one for every digit
+    position and coordinate). Without the permutations the coordinates of
+    large bases are strongly correlated (the first points lie on a few
+    lines), which makes the plain sequence worse than random points in more
+    than about ten dimensions. The scrambling removes these correlations
+    and makes the sequence random, keeping its low discrepancy.
+
+    The coordinate j is only evenly spread once there are about as many
+    points as its base, so the gain over random points fades with the
+    number of dimensions (the 100th prime is 541, the 300th is 1987);
+    reducing the dimensions with pca keeps the advantage.
+
+    Args:
+        size (int): number of points.
+        dimensions (int): number of dimensions.
+        random_state (None, int or numpy.random.RandomState): generator of
+            the permutations (see check_random_state).
+        start (int): index of the first point.
+
+    Returns:
+        ([[float]]): A matrix of size (size x dimensions)
+    """
+    random_state = check_random_state(random_state)
+    points = numpy.empty((size, dimensions))
+    indices = numpy.arange(start + 1, start + size + 1)
+    for j, base in enumerate(first_primes(dimensions)):
+        # The digits beyond the precision of a float are not needed, which
+        # also keeps the coordinates below 1
+        n_digits = int(numpy.floor(52*numpy.log(2)/numpy.log(base)))
+        i = indices.copy()
+        factor = 1.0
+        coordinate = numpy.zeros(size)
+        for digit in range(n_digits):
+            permutation = random_state.permutation(base)
+            factor /= base
+            coordinate += factor*permutation[i % base]
+            i //= base
+        points[:, j] = coordinate
+    return points
 
-def hypercube_distribution(size, dimensions, a=-0.5, b=0.5):
+
+def unit_hypercube_distribution(size, dimensions, sampling='random',
+                                random_state=None, start=0):
+    """Samples of the unit hypercube with pseudo-random ('random') or
+    low-discrepancy ('halton') sampling."""
+    random_state = check_random_state(random_state)
+    if sampling == 'random':
+        return random_state.rand(size, dimensions)
+    elif sampling == 'halton':
+        return halton_sequence(size, dimensions, random_state, start)
+    raise Exception('Sampling method unknown (sampling=\'{}\')'.format(
+                    sampling))
+
+
+def hypercube_distribution(size, dimensions, a=-0.5, b=0.5,
+                           random_state=None, sampling='random', start=0):
     """Generates random samples from a hypercube.
 
     This function generates uniformly distributed data inside an hypercube of
@@ -14,24 +114,52 @@ def hypercube_distribution(size, dimensions, a=-0.5, b=0.5):
         dimensions (int): The number of dimensions of the hypercube.
         a (float): Minimum value of the hypercube
         b (float): Maximum value of the hypercube
+        random_state (None, int or numpy.random.RandomState): see
+            check_random_state.
+        sampling (string): 'random', or 'halton' for low-discrepancy
+            samples, which cover the hypercube more evenly with the same
+            number of samples (see halton_sequence).
+        start (int): index of the first sample in the low-discrepancy
+            sequence.
 
     Returns:
         ([[float]]): A matrix of size (size x dimensions)
     """
-    return numpy.random.uniform(a,b,size=(size, dimensions))
-
-
-def hypersphere_distribution(size, dimensions, radius=1.0):
+    random_state = check_random_state(random_state)
+    if sampling == 'random':
+        return random_state.uniform(a,b,size=(size, dimensions))
+    cube = unit_hypercube_distribution(size, dimensions, sampling,
+                                       random_state, start)
+    cube *= b - a
+    cube += a
+    return cube
+
+
+def hypersphere_distribution(size, dimensions, radius=1.0,
+                             random_state=None, sampling='random', start=0):
     """Generates random samples from a hypersphere.
 
     This function generates uniformly distributed data-points inside a
     hypersphere of the specified number of dimensions and radius centered on
-    zero.
+    zero. The normal deviates are scaled in place, so the only temporary
+    arrays have one value per data-point.
+
+    With low-discrepancy sampling ('halton') the points of the
+    unit hypercube are mapped to the hypersphere with an equal-volume
+    mapping: the first coordinate u gives the radius radius*u^(1/dimensions)
+    (the fraction u of the volume is inside of it), and the other ones give
+    the direction through the inverse normal distribution function of the
+    other ones.
 
     Args:
         size (int): The number of data-points.
         dimensions (int): The number of dimensions of the hypersphere.
         radius (float): Radius of the hypersphere
+        random_state (None, int or numpy.random.RandomState): see
+            check_random_state.
+        sampling (string): 'random' or 'halton'.
+        start (int): index of the first sample in the low-discrepancy
+            sequence.
 
     Returns:
         ([[float]]): A matrix of size (size x dimensions)
@@ -40,17 +168,27 @@ def hypersphere_distribution(size, dimensions, radius=1.0):
         http://math.stackexchange.com/questions/87230/
         picking-random-points-in-the-volume-of-sphere-with-uniform-probability
     """
-    U = numpy.random.rand(size)
-    X = numpy.random.normal(size=(size, dimensions))
-
-    sphere = radius*numpy.power(U, 1.0/dimensions).reshape((-1,1))
-    sphere = sphere*X
-    sphere = sphere/numpy.sqrt(numpy.sum(X**2.0, axis=1)).reshape((-1,1))
+    random_state = check_random_state(random_state)
+    if sampling == 'random':
+        U = random_state.rand(size)
+        sphere = random_state.normal(size=(size, dimensions))
+    else:
+        # One coordinate for the radius and one per dimension for the
+        # direction
+        cube = unit_hypercube_distribution(size, dimensions + 1, sampling,
+                                           random_state, start)
+        U = cube[:, 0]
+        eps = numpy.finfo(float).eps
+        sphere = ndtri(numpy.clip(cube[:, 1:], eps, 1 - eps))
+
+    scale = radius*numpy.power(U, 1.0/dimensions)
+    scale /= numpy.sqrt(numpy.einsum('ij,ij->i', sphere, sphere))
+    sphere *= scale.reshape((-1,1))
 
     return sphere
 
 
-def hypersphere_boundary_distribution(size, dimensions):
+def hypersphere_boundary_distribution(size, dimensions, random_state=None):
     """Generates random samples from the boundary of a hypersphere.
 
     This function generates uniformly distributed data-points on the perimeter
@@ -60,20 +198,505 @@ def hypersphere_boundary_distribution(size, dimensions):
     Args:
         size (int): The number of data-points.
         dimensions (int): The number of dimensions of the hypersphere.
+        random_state (None, int or numpy.random.RandomState): see
+            check_random_state.
 
     Returns:
-        ([[float]]): A matrix of size (size x dimensions)
+        ([[float]]): A matrix of size (dimensions x size)
     """
-    normal_deviates = numpy.random.normal(size=(dimensions,size))
+    random_state = check_random_state(random_state)
+    normal_deviates = random_state.normal(size=(dimensions,size))
 
     radius = numpy.sqrt((normal_deviates**2).sum(axis=0))
     points = normal_deviates/radius
     return points
 
 
+class PCAProjection(object):
+    """Whitened PCA projection fitted by fit_pca.
+
+    Attributes:
+        mean (array-like, shape = [n_features]): mean of the data-points.
+        components (array-like, shape = [n_fitted, n_features]): principal
+            directions (all the computed ones with the 'full' solver, the
+            kept ones otherwise).
+        variances (array-like, shape = [n_fitted]): variances along them.
+        dimensions (int): number of directions kept for the reject data.
+
+    """
+    def __init__(self, mean, components, variances, dimensions):
+        self.mean = mean
+        self.components = components
+        self.variances = variances
+        self.dimensions = dimensions
+
+    def transform(self, X, dimensions=None, batch_size=4096):
+        """Whitened coordinates of X on the first dimensions fitted
+        directions (all of them if None)."""
+        if dimensions is None:
+            dimensions = len(self.variances)
+        components = self.components[:dimensions]
+        n = X.shape[0]
+        Z = numpy.empty((n, dimensions))
+        for start in range(0, n, batch_size):
+            end = min(start + batch_size, n)
+            Z[start:end] = numpy.dot(X[start:end] - self.mean, components.T)
+        Z /= numpy.sqrt(self.variances[:dimensions])
+        return Z
+
+    def inverse_transform(self, Z):
+        """Data-points of the whitened coordinates Z on the kept directions.
+        """
+        k = Z.shape[1]
+        r = numpy.dot(Z, numpy.sqrt(self.variances[:k, None]) *
+                      self.components[:k])
+        r += self.mean
+        return r
+
+
+def hash_data(X, batch_size=4096):
+    """Hash of the content of the data-points, read by blocks of rows."""
+    h = hashlib.sha1(str(X.shape) + str(X.dtype))
+    for start in range(0, X.shape[0], batch_size):
+        h.update(numpy.ascontiguousarray(X[start:start + batch_size]))
+    return h.hexdigest()
+
+
+def fit_pca(X, n_components=0, variance=0, solver='full', batch_size=None,
+            random_state=0, cache=True):
+    """Fits the whitened PCA projection used to generate reject data.
+
+    Args:
+        X ([[float]]): data-points. With solver 'incremental' any object that
+            can be sliced by rows can be used (e.g. a numpy.memmap).
+        n_components (int): number of directions to keep.
+        variance (float): proportion of variance to keep, if n_components is
+            0.
+        solver (string):
+            - 'full': sklearn.decomposition.PCA with all the directions (or
+              n_components).
+            - 'randomized': randomized SVD of rank 16, doubled until the
+              directions explain the requested variance (the total variance
+              is the sum of the variances of the features), so only about
+              the kept directions are computed.
+            - 'incremental': sklearn.decomposition.IncrementalPCA, which
+              reads X by blocks of batch_size rows.
+        batch_size (int): number of rows of the blocks ('incremental'), by
+            default 5 times the number of features.
+        random_state (int): seed of the randomized SVD.
+        cache (bool): if True the projections are kept in PCA_CACHE (up to
+            PCA_CACHE_SIZE of them) with a hash of the content of X, so
+            fitting again the same data-points reuses them.
+
+    Returns:
+        (PCAProjection): the fitted projection.
+    """
+    if solver not in ['full', 'randomized', 'incremental']:
+        raise Exception('PCA solver unknown (solver=\'{}\')'.format(solver))
+    if cache:
+        key = (hash_data(X), n_components, variance, solver, batch_size,
+               random_state)
+        if key in PCA_CACHE:
+            projection = PCA_CACHE.pop(key)
+            PCA_CACHE[key] = projection
+            return projection
+
+    n, d = X.shape
+    if solver == 'full':
+        pc = PCA(n_components=n_components or d, whiten=True)
+        pc.fit(X)
+        mean, components = pc.mean_, pc.components_
+        variances, ratios = pc.explained_variance_, \
+            pc.explained_variance_ratio_
+    elif solver == 'randomized':
+        X = numpy.asarray(X, dtype=float)
+        mean = X.mean(axis=0)
+        X = X - mean
+        total_variance = numpy.einsum('ij,ij->', X, X)/(n - 1)
+        max_rank = min(n, d)
+        rank = min(n_components or 16, max_rank)
+        while True:
+            _, singular_values, components = randomized_svd(
+                X, rank, random_state=random_state)
+            variances = singular_values**2/(n - 1)
+            ratios = variances/total_variance
+            if (n_components or rank == max_rank or
+                    ratios.sum() >= variance):
+                break
+            rank = min(2*rank, max_rank)
+    else:
+        if batch_size is None:
+            batch_size = 5*d
+        # Every block must have at least as many rows as components, the
+        # last one is merged with the previous one
+        batch_size = max(batch_size, n_components or d)
+        pc = IncrementalPCA(n_components=n_components or d)
+        starts = range(0, n, batch_size)
+        if len(starts) > 1 and n - starts[-1] < (n_components or d):
+            starts = starts[:-1]
+        for i, start in enumerate(starts):
+            end = starts[i + 1] if i + 1 < len(starts) else n
+            pc.partial_fit(numpy.array(X[start:end], dtype=float))
+        mean, components = pc.mean_, pc.components_
+        variances, ratios = pc.explained_variance_, \
+            pc.explained_variance_ratio_
+
+    if n_components:
+        dimensions = n_components
+    elif ratios.sum() < variance:
+        # The cumulative ratios can stay below variance by rounding
+        dimensions = len(ratios)
+    else:
+        dimensions = numpy.argmax(ratios.cumsum() >= variance)+1
+    if solver != 'full':
+        components, variances = components[:dimensions], variances[:dimensions]
+    projection = PCAProjection(mean, components, variances, dimensions)
+    if cache:
+        PCA_CACHE[key] = projection
+        while len(PCA_CACHE) > PCA_CACHE_SIZE:
+            PCA_CACHE.popitem(last=False)
+    return projection
+
+
+class RejectShape(object):
+    """Hyper-shape around some data-points where reject data is generated.
+
+    The shape (method, PCA space, radius and scale) is computed once by fit,
+    and the reject data can then be generated in chunks of any size. See
+    create_reject_data for the description of the arguments. The radius of
+    hshape_prop_in is measured on all the directions computed by the PCA
+    solver (all of them with 'full', the kept ones otherwise).
+
+    If projected is True (with pca), the reject data is not mapped back to
+    the space of X: it is returned in the whitened PCA space of dimensions
+    dimensions, and transform maps other data-points (e.g. the known ones)
+    to the same space. A model trained and used in that space avoids the
+    reconstruction and works on dimensions instead of n_features values
+    per data-point.
+
+    With low-discrepancy sampling (sampling 'halton') the chunks
+    of a stream are consecutive pieces of the same sequence, randomized once
+    per stream, so all the reject data of a stream covers the hyper-shape
+    evenly.
+
+    With boundary_proportion, sample_weighted draws that proportion of the
+    reject data near the boundary of the data-points of X, where it is
+    informative for a model that separates them, and the rest uniformly.
+    The boundary is the level set of a Gaussian kernel density estimate of
+    X (bandwidth boundary_bandwidth in the space of the hyper-shape) that
+    leaves out the proportion boundary_quantile of X. The boundary reject
+    data is drawn from the same kernel density estimate restricted to the
+    hyper-shape and to the outside of the level set, which is a shell
+    around the dense core of X. Every data-point has an importance weight,
+    uniform density / density of the mixture, so the weighted reject data
+    stands for uniform reject data. The uniform part of the mixture bounds
+    the weights by 1 / (1 - boundary_proportion) (defensive importance
+    sampling).
+
+    Attributes:
+        dimensions (int): number of dimensions of the hyper-shape.
+        radius (float): radius of the hypersphere, or side of the hypercube.
+        scale (float): factor applied to the samples when hshape_cov is
+            given, such that the mean squared value of their coordinates is
+            hshape_cov (computed from its expected value, so that it does not
+            depend on the samples).
+        support (array-like, shape = [n_samples, dimensions]): data-points
+            of X in the space of the hyper-shape (before scale), kept when
+            boundary_proportion is given.
+        bandwidth (float): bandwidth of the boundary samples.
+        kde (sklearn.neighbors.KernelDensity): kernel density estimate of
+            support.
+        level (float): log-density of the boundary level set.
+
+    """
+    def __init__(self, method, pca=False, pca_components=0, pca_variance=0,
+                 hshape_cov=0, hshape_prop_in=0, hshape_multiplier=1,
+                 pca_solver='full', pca_cache=True, projected=False,
+                 sampling='random', boundary_proportion=0,
+                 boundary_bandwidth=None, boundary_quantile=0.1):
+        self.method = method
+        self.boundary_proportion = boundary_proportion
+        self.boundary_bandwidth = boundary_bandwidth
+        self.boundary_quantile = boundary_quantile
+        self.sampling = sampling
+        self.pca = pca
+        self.pca_components = pca_components
+        self.pca_variance = pca_variance
+        self.pca_solver = pca_solver
+        self.pca_cache = pca_cache
+        self.projected = projected and pca
+        self.hshape_cov = hshape_cov
+        self.hshape_prop_in = hshape_prop_in
+        self.hshape_multiplier = hshape_multiplier
+
+        if method not in ['uniform_hcube', 'uniform_hsphere']:
+            raise Exception("Method to generate reject data unknown "
+                            "(method=\'{}\')".format(method))
+        if sampling not in ['random', 'halton']:
+            raise Exception("Sampling method unknown "
+                            "(sampling=\'{}\')".format(sampling))
+        if not 0 <= boundary_proportion < 1:
+            raise Exception('Option boundary_proportion needs to be in [0, 1)')
+        if not 0 < boundary_quantile <= 1:
+            raise Exception('Option boundary_quantile needs to be in (0, 1]')
+        if hshape_prop_in and hshape_cov:
+            raise Exception('Options hshape_prop_in and hshape_cov are'
+                           'mutually exclusive')
+
+    def fit(self, X):
+        if self.pca == True:
+            if self.pca_components and self.pca_variance:
+                raise Exception('Options pca_components and pca_variance are'
+                               'mutually exclusive')
+            elif not self.pca_components and not self.pca_variance:
+                raise Exception('If PCA is selected pca_components or '
+                                'pca_variance need to be specified')
+            pc = fit_pca(X, n_components=self.pca_components,
+                         variance=self.pca_variance, solver=self.pca_solver,
+                         cache=self.pca_cache)
+            dimensions = pc.dimensions
+            self.pca_projection = pc
+        else:
+            dimensions = X.shape[1]
+            pc = None
+        self.dimensions = dimensions
+
+        if self.hshape_prop_in:
+            if pc is not None:
+                distances = numpy.linalg.norm(pc.transform(X), axis=1)
+            else:
+                distances = numpy.linalg.norm(X, axis=1)
+            # Only the distance at the quantile needs to be in its sorted
+            # position
+            index = (int(X.shape[0]*self.hshape_prop_in)-1) % X.shape[0]
+            radius = numpy.partition(distances, index)[index]
+        else:
+            radius = 1
+        self.radius = radius*self.hshape_multiplier
+
+        self.scale = 1.0
+        if self.hshape_cov:
+            if self.method == 'uniform_hcube':
+                # Uniform in [-radius/2, radius/2]
+                mean_square = self.radius**2/12.0
+            else:
+                # Uniform in the hypersphere
+                mean_square = self.radius**2/(dimensions + 2.0)
+            self.scale = numpy.sqrt(self.hshape_cov/mean_square)
+
+        if self.boundary_proportion:
+            if pc is not None:
+                support = pc.transform(X, dimensions)
+            else:
+                support = numpy.array(X, dtype=float)
+            support /= self.scale
+            self.support = support
+            bandwidth = self.boundary_bandwidth
+            if bandwidth is None:
+                # Scott's rule on the mean standard deviation
+                bandwidth = support.std(axis=0).mean()*numpy.power(
+                    support.shape[0], -1.0/(dimensions + 4))
+            self.bandwidth = bandwidth
+            self.kde = KernelDensity(bandwidth=bandwidth).fit(support)
+            self.level = numpy.percentile(self.kde.score_samples(support),
+                                          100*self.boundary_quantile)
+        return self
+
+    def _draw(self, size, random_state=None, start=0):
+        """Uniform samples of the hyper-shape, before scale."""
+        if self.method == 'uniform_hcube':
+            return hypercube_distribution(size, self.dimensions,
+                                          a=-self.radius/2, b=self.radius/2,
+                                          random_state=random_state,
+                                          sampling=self.sampling, start=start)
+        return hypersphere_distribution(size, self.dimensions,
+                                        radius=self.radius,
+                                        random_state=random_state,
+                                        sampling=self.sampling, start=start)
+
+    def _output(self, r):
+        """Maps samples of the hyper-shape to the space of the reject data.
+        """
+        if self.scale != 1.0:
+            r *= self.scale
+        if self.pca == True and not self.projected:
+            r = self.pca_projection.inverse_transform(r)
+        return r
+
+    def _inside(self, r):
+        if self.method == 'uniform_hcube':
+            return numpy.all((r >= -self.radius/2) & (r <= self.radius/2),
+                             axis=1)
+        return numpy.einsum('ij,ij->i', r, r) <= self.radius**2
+
+    def _log_volume(self):
+        if self.method == 'uniform_hcube':
+            a, b = -self.radius/2, self.radius/2
+            return self.dimensions*numpy.log(b - a)
+        d = self.dimensions
+        return (0.5*d*numpy.log(numpy.pi) + d*numpy.log(self.radius) -
+                gammaln(0.5*d + 1))
+
+    def sample(self, size, random_state=None, start=0):
+        """Generates size reject data-points.
+
+        Args:
+            size (int): number of data-points.
+            random_state (None, int or numpy.random.RandomState): see
+                check_random_state.
+            start (int): index of the first data-point in the low-discrepancy
+                sequence (ignored with random sampling).
+
+        Returns:
+            ([[float]]): A matrix of size (size x n_features of X), or (size x
+            dimensions) if projected.
+        """
+        return self._output(self._draw(size, random_state, start))
+
+    def sample_weighted(self, size, random_state=None, max_rounds=100):
+        """Generates size reject data-points concentrated near the boundary
+        of the data-points of X, with their importance weights (see
+        boundary_proportion).
+
+        Args:
+            size (int): number of data-points.
+            random_state (None, int or numpy.random.RandomState): see
+                check_random_state.
+            max_rounds (int): maximum number of rounds of candidates of the
+                boundary reject data. An Exception is raised if they are not
+                enough (e.g. if the kernel density estimate has almost no
+                mass in the hyper-shape outside of the level set).
+
+        Returns:
+            ([[float]], [float]): A matrix of size (size x n_features of X),
+            or (size x dimensions) if projected, and the weights of its
+            data-points, with mean 1.
+        """
+        if not self.boundary_proportion:
+            return self.sample(size, random_state), numpy.ones(size)
+        random_state = check_random_state(random_state)
+        n_boundary = int(round(size*self.boundary_proportion))
+        r = numpy.empty((size, self.dimensions))
+        r[n_boundary:] = self._draw(size - n_boundary, random_state)
+
+        # Rejection of the kernel samples outside of the hyper-shape or
+        # inside of the level set, the proportion of accepted ones estimates
+        # the mass of the kernel density in the rest
+        filled = 0
+        n_proposed = 0
+        n_accepted = 0
+        rounds = 0
+        while filled < n_boundary:
+            if rounds == max_rounds:
+                raise Exception('Only {} of {} boundary reject data-points '
+                                'were generated in {} rounds'.format(
+                                    filled, n_boundary, max_rounds))
+            rounds += 1
+            missing = n_boundary - filled
+            if n_accepted:
+                rate = n_accepted/float(n_proposed)
+                n_candidates = min(int(numpy.ceil(1.5*missing/rate)),
+                                   64*missing)
+            else:
+                n_candidates = 2*missing
+            indices = random_state.randint(self.support.shape[0],
+                                           size=n_candidates)
+            candidates = self.support[indices] + self.bandwidth*(
+                random_state.normal(size=(n_candidates, self.dimensions)))
+            candidates = candidates[self._inside(candidates)]
+            candidates = candidates[
+                self.kde.score_samples(candidates) < self.level]
+            n_proposed += n_candidates
+            n_accepted += len(candidates)
+            candidates = candidates[:missing]
+            r[filled:filled + len(candidates)] = candidates
+            filled += len(candidates)
+
+        # Densities of the mixture relative to the uniform density, the
+        # boundary part is 0 inside of the level set
+        log_kernel = self.kde.score_samples(r)
+        outside = log_kernel < self.level
+        log_kernel += self._log_volume()
+        if n_accepted:
+            log_kernel -= numpy.log(n_accepted/float(n_proposed))
+        log_mixture = numpy.full(size, numpy.log(1 - self.boundary_proportion))
+        log_mixture[outside] = numpy.logaddexp(
+            log_mixture[outside],
+            numpy.log(self.boundary_proportion) + log_kernel[outside])
+        weights = numpy.exp(log_mixture.min() - log_mixture)
+        weights *= size/weights.sum()
+        return self._output(r), weights
+
+    def transform(self, X):
+        """Maps data-points to the space of the reject data: the whitened
+        PCA space if projected, the space of X otherwise (X is returned)."""
+        if not self.projected:
+            return X
+        return self.pca_projection.transform(X, self.dimensions)
+
+    def chunk(self, seed, index, size, start=None):
+        """Generates the chunk number index of the stream seed.
+
+        Every chunk has its own random generator, seeded with [seed, index],
+        so the chunks are reproducible and can be generated in any order or
+        in parallel. With low-discrepancy sampling the chunk is instead the
+        piece of the sequence of the stream (randomized with the seed) that
+        begins at the data-point start (index*size if None).
+        """
+        if self.sampling == 'random':
+            return self.sample(size, numpy.random.RandomState([seed, index]))
+        if start is None:
+            start = index*size
+        return self.sample(size, numpy.random.RandomState(seed), start=start)
+
+    def generate(self, num_reject, chunk_size=65536, random_state=None):
+        """Generates num_reject reject data-points in chunks.
+
+        Args:
+            num_reject (int): total number of data-points.
+            chunk_size (int): number of data-points of every chunk (but the
+                last one).
+            random_state (None or int): seed of the stream of chunks. If None
+                it is drawn from the global generator of numpy.random.
+
+        Returns:
+            (generator of [[float]]): matrices of size (chunk size x
+            n_features of X).
+        """
+        if random_state is None:
+            random_state = numpy.random.randint(2**31 - 1)
+        for index, start in enumerate(range(0, num_reject, chunk_size)):
+            yield self.chunk(random_state, index,
+                             min(chunk_size, num_reject - start), start=start)
+
+
+def generate_reject_data(X, num_reject, method, pca=False, pca_components=0,
+                         pca_variance=0, hshape_cov=0, hshape_prop_in=0,
+                         hshape_multiplier=1, chunk_size=65536,
+                         random_state=None, pca_solver='full',
+                         pca_cache=True, sampling='random'):
+    """Generates reject data in chunks, without keeping all of it in memory.
+
+    See create_reject_data and RejectShape.generate for the arguments.
+
+    Returns:
+        (generator of [[float]]): matrices of size (chunk size x
+        n_features of X).
+    """
+    shape = RejectShape(method, pca=pca, pca_components=pca_components,
+                        pca_variance=pca_variance, hshape_cov=hshape_cov,
+                        hshape_prop_in=hshape_prop_in,
+                        hshape_multiplier=hshape_multiplier,
+                        pca_solver=pca_solver, pca_cache=pca_cache,
+                        sampling=sampling).fit(X)
+    return shape.generate(int(num_reject), chunk_size=chunk_size,
+                          random_state=random_state)
+
+
 def create_reject_data(X, proportion, method, pca=False, pca_components=0,
                        pca_variance=0, hshape_cov=0, hshape_prop_in=0,
-                       hshape_multiplier=1):
+                       hshape_multiplier=1, random_state=None,
+                       pca_solver='full', pca_cache=True, sampling='random'):
     """Generates random samples with the specified distribution.
 
     This function generates data points with the specified distribution from
@@ -100,74 +723,72 @@ def create_reject_data(X, proportion, method, pca=False, pca_components=0,
             inside of the hyper-shape.
         hshape_multiplier (float): Increases or decreases the distance to the
             boundary of the hyper-shape.
+        random_state (None, int or numpy.random.RandomState): see
+            check_random_state.
+        pca_solver (string): 'full', 'randomized' or 'incremental' (see
+            fit_pca).
+        pca_cache (bool): if True the PCA projection of the same
+            data-points is only fitted once (see fit_pca).
+        sampling (string): 'random' for pseudo-random samples, or 'halton'
+            for low-discrepancy (quasi-random) samples, which cover the
+            hyper-shape more evenly (see halton_sequence for its limits in
+            many dimensions).
 
     Returns:
         ([[float]]): A matrix of size (size x dimensions)
     """
-    if pca == True:
-        if pca_components and pca_variance:
-            raise Exception('Options pca_components and pca_variance are'
-                           'mutually exclusive')
-        elif pca_components:
-            dimensions = pca_components
-            pc = PCA(n_components=dimensions, whiten=True)
-            pc.fit(X)
-        elif pca_variance:
-            dimensions = X.shape[1]
-            pc = PCA(n_components=dimensions, whiten=True)
-            pc.fit(X)
-            dimensions = numpy.argmax(pc.explained_variance_ratio_.cumsum() >=
-                                      pca_variance)+1
-        else:
-            raise Exception('If PCA is selected pca_components or pca_variance '
-                           'need to be specified')
-    else:
-        dimensions = X.shape[1]
-
-    num_reject = X.shape[0]*proportion
+    shape = RejectShape(method, pca=pca, pca_components=pca_components,
+                        pca_variance=pca_variance, hshape_cov=hshape_cov,
+                        hshape_prop_in=hshape_prop_in,
+                        hshape_multiplier=hshape_multiplier,
+                        pca_solver=pca_solver, pca_cache=pca_cache,
+                        sampling=sampling).fit(X)
+    num_reject = int(round(X.shape[0]*proportion))
+    return shape.sample(num_reject, random_state=random_state)
+
+
+def create_weighted_reject_data(X, proportion, method, pca=False,
+                                pca_components=0, pca_variance=0,
+                                hshape_cov=0, hshape_prop_in=0,
+                                hshape_multiplier=1, random_state=None,
+                                pca_solver='full', pca_cache=True,
+                                sampling='random', boundary_proportion=0.5,
+                                boundary_bandwidth=None,
+                                boundary_quantile=0.1):
+    """Generates reject data concentrated near the boundary of the data-points
+    of X, with importance weights (see RejectShape.sample_weighted).
+
+    The weighted reject data stands for uniform reject data of the same
+    total weight, so a smaller proportion can be generated than with
+    create_reject_data, and the weights passed as sample weights to the
+    model trained with it. See create_reject_data for the other arguments.
 
-    if hshape_prop_in and hshape_cov:
-        raise Exception('Options hshape_prop_in and hshape_cov are'
-                       'mutually exclusive')
-
-    if hshape_prop_in:
-        if pca == True:
-            X_transform = pc.transform(X)
-            distances = numpy.linalg.norm(X_transform, axis=1)
-        else:
-            distances = numpy.linalg.norm(X, axis=1)
-        distances.sort()
-        radius = distances[int(X.shape[0]*hshape_prop_in)-1]
-    else:
-        radius = 1
-
-    radius *= hshape_multiplier
-
-    if method == 'uniform_hcube':
-        r = hypercube_distribution(num_reject, dimensions, a=-radius/2,
-                b=radius/2)
-
-        if hshape_cov:
-            # FIXME check the equation of the variance for hypercube
-            r *= numpy.sqrt(hshape_cov/(numpy.mean(r**2)))
-    elif method == 'uniform_hsphere':
-        r = hypersphere_distribution(num_reject, dimensions,
-                                            radius=radius)
-        # TODO compute the value of r before creating the hypersphere
-        if hshape_cov:
-            r *= numpy.sqrt(hshape_cov/(numpy.mean(r**2)))
-    else:
-       raise Exception("Method to generate reject data unknown "
-                       "(method=\'{}\')".format(method))
-
-    if pca == True:
-        if pca_variance and dimensions < X.shape[0]:
-            redundant_dim = numpy.zeros((num_reject, X.shape[1] - dimensions))
-            r = numpy.hstack((r,redundant_dim))
-
-        r = pc.inverse_transform(r)
+    Args:
+        boundary_proportion (float): proportion of the reject data drawn
+            near the data-points of X, in [0, 1).
+        boundary_bandwidth (float): standard deviation of the reject data
+            drawn around every data-point, in the space of the hyper-shape
+            (whitened if pca). If None it is given by Scott's rule.
+        boundary_quantile (float): proportion of the data-points of X
+            outside of the level set of their density that is taken as
+            their boundary.
 
-    return r
+    Returns:
+        ([[float]], [float]): A matrix of size (size x dimensions) and the
+        weights of its data-points, which add up to
+        X.shape[0]*proportion.
+    """
+    shape = RejectShape(method, pca=pca, pca_components=pca_components,
+                        pca_variance=pca_variance, hshape_cov=hshape_cov,
+                        hshape_prop_in=hshape_prop_in,
+                        hshape_multiplier=hshape_multiplier,
+                        pca_solver=pca_solver, pca_cache=pca_cache,
+                        sampling=sampling,
+                        boundary_proportion=boundary_proportion,
+                        boundary_bandwidth=boundary_bandwidth,
+                        boundary_quantile=boundary_quantile).fit(X)
+    num_reject = int(round(X.shape[0]*proportion))
+    return shape.sample_weighted(num_reject, random_state=random_state)
 
 def test_hypersphere():
     x = hypersphere_distribution(1000,3)
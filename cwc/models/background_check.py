@@ -3,8 +3,12 @@ import numpy as np
 from sklearn.mixture import GMM
 from sklearn import datasets
 from scipy.special import expit
+from scipy.special import logit
 from sklearn.svm import OneClassSVM
 
+from batches import predict_by_batches
+from scoring import EstimatorScorer
+
 
 class BackgroundCheck(object):
     """This class is responsible for performing background checks.
@@ -12,26 +16,49 @@ class BackgroundCheck(object):
     Args:
         estimator (object): An object of a class that performs density
             estimation. Any density estimator can be used, as long as it has
-            the following methods: fit(X) and score(X) or decision_function(X),
-            where X is an array with shape = [n_samples, n_features].
+            the following methods: fit(X) and score(X), score_samples(X) or
+            decision_function(X), where X is an array with shape =
+            [n_samples, n_features]. score(X) is used when it gives a score
+            per sample (see EstimatorScorer).
         mu (float): Parameter that sets the deepness of the background
             valleys, compared to foreground peaks.
         m (float): Parameter for how high is the uniform background, compared
             to foreground peaks.
+        score_method (string): name of the method of the estimator that
+            gives the scores. If None it is found when the estimator is
+            fitted or set (see EstimatorScorer). 'score_samples' uses the
+            log-densities of the estimator instead of its densities.
 
     Attributes:
-        _max_dens (float): Maximum density value estimated from training data.
+        _max_dens (float): Maximum density value, from the maximum of the
+            estimator when it is known (see EstimatorScorer.maximum) or from
+            the training data otherwise.
 
     """
     # TODO add possibility of passing a generative model that does not need to
     # be trained (e.g. if the foreground has been already trained)
     def __init__(self, estimator=GMM(n_components=1, covariance_type='diag'),
-                 mu=0.0, m=1.0):
+                 mu=0.0, m=1.0, score_method=None):
         self._estimator = estimator
         self._mu = mu
         self._m = m
+        self._score_method = score_method
+        self._scorer = None
         self._max_dens = 0.0
         self._delta = 0.0
+        self._min_score = np.inf
+        self._max_score = -np.inf
+
+    def __setstate__(self, state):
+        """Restores a pickled BackgroundCheck, filling the attributes that
+        did not exist when it was pickled (the scorer is created the first
+        time X is scored)."""
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_score_method', None)
+        self.__dict__.setdefault('_scorer', None)
+        if '_min_score' not in state:
+            self._min_score = -self._delta
+            self._max_score = logit(self._max_dens) - self._delta
 
     def fit(self, X):
         """Fits the density estimator to the data in X.
@@ -44,29 +71,114 @@ class BackgroundCheck(object):
 
         """
         self._estimator.fit(X)
+        self._scorer = EstimatorScorer(self._estimator, X,
+                                       method=self._score_method)
         dens = self.score(X)
-        self._delta = 0.0 - dens.min()
-        dens = expit(dens + self._delta)
-        if hasattr(self._estimator, 'maximum'):
-            self._max_dens = expit(self._estimator.maximum[0] + self._delta)
-        else:
-            self._max_dens = dens.max()
+        self._min_score = dens.min()
+        self._max_score = dens.max()
+        self._calibrate()
+
+    def partial_fit(self, X):
+        """Updates the density estimator with a new chunk of training data.
+
+        The estimator needs a partial_fit method (e.g. MyMultivariateNormal).
+        The minimum and maximum scores are kept between calls, every chunk
+        being scored once by the estimator after it has been updated with
+        it, so the previous chunks are not scored again. If the maximum of
+        the estimator is known (see EstimatorScorer.maximum), it is used
+        instead of the maximum score.
+
+        The calibration is therefore not the same as the one of fit on all
+        the chunks: the minimum score (delta) comes from scores given by
+        earlier versions of the estimator, and is only exact if the later
+        updates do not change the score of the lowest-scoring sample (it
+        becomes closer as the estimator converges). Call set_estimator with
+        all the data to recalibrate exactly.
+
+        Args:
+            X (array-like, shape = [n_samples, n_features]): chunk of
+                training data.
+
+        Returns:
+            Nothing.
+
+        """
+        if not hasattr(self._estimator, 'partial_fit'):
+            raise TypeError('The estimator {} does not support '
+                            'partial_fit'.format(
+                                type(self._estimator).__name__))
+        self._estimator.partial_fit(X)
+        if self._scorer is None:
+            self._scorer = EstimatorScorer(self._estimator, X,
+                                           method=self._score_method)
+        dens = self.score(X)
+        self._min_score = min(dens.min(), self._min_score)
+        self._max_score = max(dens.max(), self._max_score)
+        self._calibrate()
 
     def set_estimator(self, estimator, X):
         self._estimator = estimator
+        self._scorer = EstimatorScorer(self._estimator, X,
+                                       method=self._score_method)
         dens = self.score(X)
-        self._delta = 0.0 - dens.min()
-        dens = expit(dens + self._delta)
-        if hasattr(self._estimator, 'maximum'):
-            self._max_dens = expit(self._estimator.maximum[0] + self._delta)
-        else:
-            self._max_dens = dens.max()
-
-    def predict_proba(self, X, mu=None, m=None):
+        self._min_score = dens.min()
+        self._max_score = dens.max()
+        self._calibrate()
+
+    def _calibrate(self):
+        self._delta = 0.0 - self._min_score
+        maximum = self._scorer.maximum()
+        if maximum is None:
+            maximum = self._max_score
+        self._max_dens = expit(maximum + self._delta)
+
+    def predict_proba(self, X, mu=None, m=None, batch_size=None, out=None,
+                      dtype=np.float64, n_jobs=None):
         """Performs background check on the data in X.
 
         Args:
-            X (array-like, shape = [n_samples, n_features]): training data.
+            X (array-like, shape = [n_samples, n_features]): test data. Any
+                object that can be sliced by rows can be used (e.g. a
+                numpy.memmap).
+            batch_size (int): if given, X is processed in blocks of
+                batch_size rows, which bounds the memory used.
+            out (array-like, shape = [n_samples, 2]): if given, the
+                posteriors are written in this array.
+            dtype (numpy.dtype): type of the posteriors when out is not
+                given (e.g. numpy.float32 to halve the memory used).
+            n_jobs (int): number of threads that process the blocks of X
+                concurrently (-1 uses one thread per CPU). See
+                predict_by_batches.
+
+        Returns:
+            posteriors (array-like, shape = [n_samples, 2]): posterior
+            probabilities for background (column 0) and foreground (column 1).
+
+        """
+        if mu is None:
+            mu = self._mu
+        if m is None:
+            m = self._m
+
+        def predict_block(x, posteriors):
+            if posteriors is None:
+                posteriors = np.empty((np.alen(x), 2), dtype=dtype)
+            return self.predict_proba_scores(
+                np.asarray(self.score(x), dtype=posteriors.dtype), mu, m,
+                out=posteriors)
+
+        return predict_by_batches(predict_block, X, batch_size=batch_size,
+                                  out=out, n_jobs=n_jobs)
+
+    def predict_proba_scores(self, scores, mu=None, m=None, out=None):
+        """Performs background check from the scores of the estimator (see
+        score), e.g. when they are computed for several classes at once.
+
+        Args:
+            scores (array-like, shape = [n_samples]): scores of the
+                estimator. This array is overwritten with q.
+            out (array-like, shape = [n_samples, 2]): if given, the
+                posteriors are written in this array.
 
         Returns:
             posteriors (array-like, shape = [n_samples, 2]): posterior
@@ -77,11 +189,7 @@ class BackgroundCheck(object):
             mu = self._mu
         if m is None:
             m = self._m
-        q, p_x_and_b = self.compute_q_p_x_and_b(X, mu=mu, m=m)
-        posteriors = np.zeros((np.alen(X), 2))
-        posteriors[:, 0] = p_x_and_b / (p_x_and_b + q)
-        posteriors[:, 1] = 1.0 - posteriors[:, 0]
-        return posteriors
+        return self.compute_posteriors(self.compute_q(scores), mu, m, out=out)
 
     def compute_q_p_x_and_b(self, X, mu=None, m=None):
         """
@@ -93,16 +201,103 @@ class BackgroundCheck(object):
             mu = self._mu
         if m is None:
             m = self._m
-        # TODO maybe apply expit only on the necessary cases
-        p_x_and_f = expit(self.score(X) + self._delta)
-        # TODO look for other methods to clip the probabilities?
-        q = np.clip(p_x_and_f / self._max_dens, 0.0, 1.0)
+        q = self.compute_q(np.array(self.score(X), dtype=float))
         p_x_and_b = q * mu + (1.0 - q) * m
         return q, p_x_and_b
 
+    def compute_q(self, scores):
+        """Computes q in place from the scores of the estimator.
+
+        q is expit(score + delta) / max_dens clipped to 1. The rows that get
+        clipped are the ones with score + delta >= logit(max_dens), and expit
+        is only evaluated on the other rows.
+
+        Args:
+            scores (array-like, shape = [n_samples]): scores of the
+                estimator. This array is overwritten with q.
+
+        Returns:
+            q (array-like, shape = [n_samples]): the same array as scores.
+
+        """
+        scores += self._delta
+        not_clipped = scores < logit(self._max_dens)
+        expit(scores, out=scores, where=not_clipped)
+        np.divide(scores, self._max_dens, out=scores, where=not_clipped)
+        np.copyto(scores, 1.0, where=~not_clipped)
+        # TODO look for other methods to clip the probabilities?
+        np.minimum(scores, 1.0, out=scores)
+        return scores
+
+    def compute_posteriors(self, q, mu, m, out=None):
+        """Computes the background and foreground posteriors from q.
+
+        The posterior of the background is p(x,b) / (p(x,b) + q) with
+        p(x,b) = q * mu + (1 - q) * m. All the operations are done in place
+        in out. mu and m can also be arrays that broadcast with q, in which
+        case the posteriors for all their combinations are computed.
+
+        Args:
+            q (array-like, shape = [n_samples]): see compute_q.
+            out (array-like, shape = [..., n_samples, 2]): if given, the
+                posteriors are written in this array.
+
+        Returns:
+            posteriors (array-like, shape = [..., n_samples, 2]): posterior
+            probabilities for background (column 0) and foreground (column 1).
+
+        """
+        if out is None:
+            shape = np.broadcast(q, mu, m).shape + (2,)
+            out = np.empty(shape, dtype=q.dtype)
+        background = out[..., 0]
+        foreground = out[..., 1]
+        np.multiply(q, np.subtract(mu, m), out=background)
+        background += m
+        np.add(background, q, out=foreground)
+        background /= foreground
+        np.subtract(1.0, background, out=foreground)
+        return out
+
+    def predict_proba_grid(self, X, mus, ms, statistic=None,
+                           dtype=np.float64):
+        """Performs background check on X for every pair of values of mu and
+        m.
+
+        X is scored by the estimator only once, as q does not depend on mu
+        and m.
+
+        Args:
+            X (array-like, shape = [n_samples, n_features]): test data.
+            mus (array-like, shape = [n_mus]): values of mu.
+            ms (array-like, shape = [n_ms]): values of m.
+            statistic (function): if given, it is applied to the posteriors
+                (shape = [n_samples, 2]) of every pair of mu and m, and its
+                results are returned instead of the posteriors.
+            dtype (numpy.dtype): type of the posteriors.
+
+        Returns:
+            posteriors (array-like, shape = [n_mus, n_ms, n_samples, 2]):
+            posterior probabilities for background (column 0) and foreground
+            (column 1), or the results of statistic (shape = [n_mus, n_ms,
+            ...]).
+
+        """
+        mus = np.asarray(mus, dtype=dtype).reshape(-1, 1, 1)
+        ms = np.asarray(ms, dtype=dtype).reshape(1, -1, 1)
+        q = self.compute_q(np.asarray(self.score(X), dtype=dtype))
+        if statistic is None:
+            return self.compute_posteriors(q, mus, ms)
+        posteriors = np.empty((np.alen(q), 2), dtype=dtype)
+        # The buffer is reused, so views of it are copied
+        results = [[np.copy(statistic(self.compute_posteriors(
+                        q, mu, m, out=posteriors)))
+                    for m in ms.ravel()] for mu in mus.ravel()]
+        return np.array(results)
+
     def score(self, X):
-        """Gets scores for the objects of X using different functions that
-        depend on the estimator.
+        """Gets scores for the objects of X using the method of the estimator
+        found when it was fitted or set (see EstimatorScorer).
 
         Args:
             X (array-like, shape = [n_samples, n_features]): training data.
@@ -111,13 +306,10 @@ class BackgroundCheck(object):
             (array-like, shape = [n_samples]): scores given by the estimator.
 
         """
-        if 'score' in dir(self._estimator):
-            s = self._estimator.score(X)
-            if np.alen(s) != np.alen(X):
-                s = self._estimator.score_samples(X)
-            return s
-        elif 'decision_function' in dir(self._estimator):
-            return self._estimator.decision_function(X).reshape(-1)
+        if self._scorer is None:
+            self._scorer = EstimatorScorer(self._estimator, X,
+                                           method=self._score_method)
+        return self._scorer(X)
 
 
 def test():
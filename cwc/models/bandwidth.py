@@ -0,0 +1,214 @@
+"""
+This module contains the selection of the bandwidth of the Gaussian kernel
+density estimators by leave-one-out likelihood.
+
+For a multivariate estimate, the squared distances between the training
+samples are computed once per block of rows and reused for every bandwidth.
+
+For the product of one-dimensional estimates of MyMultivariateKernelDensity
+every feature is evaluated separately with the binned estimate of
+BinnedGaussianKDE. Every feature is binned once, on a grid fine enough for
+the smallest bandwidth and wide enough for the largest one, and only the
+kernel changes with the bandwidth. The larger bandwidths are evaluated on
+a subset of the grid points (see BinnedCounts), so every bandwidth costs
+about the same as binning the feature for it alone. The
+leave-one-out density of a sample is (n f(x) - K(0)) / (n - 1). For the
+samples where the error of the binned density could be larger than rtol
+times this value (isolated samples, where the two terms cancel), it is
+computed exactly from the sorted samples, using only the neighbours whose
+kernel is not negligible next to the one of the nearest neighbour.
+
+"""
+from __future__ import division
+import numpy as np
+
+from binned_kde import BinnedCounts
+from binned_kde import BinnedGaussianKDE
+
+
+def loo_log_likelihood(X, bandwidths, product=False, rtol=1e-3,
+                       max_distances=2**22):
+    """Mean leave-one-out log-likelihood of Gaussian kernel density
+    estimates of X.
+
+    Args:
+        X (array-like, shape = [n_samples, n_features]): training samples
+            (at least two).
+        bandwidths (array-like, shape = [n_bandwidths]): bandwidths to
+            evaluate.
+        product (bool): if True the estimate is the product of one
+            dimensional estimates of every feature (as in
+            MyMultivariateKernelDensity), and the log-likelihood of every
+            feature is returned, so that the features can have different
+            bandwidths.
+        rtol (float): maximum relative error of the binned densities
+            (product only).
+        max_distances (int): maximum number of distances kept in memory.
+
+    Returns:
+        (array-like, shape = [n_bandwidths] or [n_bandwidths, n_features]):
+        mean log-likelihood of every sample under the estimate fitted to the
+        other samples.
+    """
+    X = np.asarray(X, dtype=float)
+    n, d = X.shape
+    bandwidths = np.asarray(bandwidths, dtype=float)
+    if product:
+        log_likelihoods = np.zeros((len(bandwidths), d))
+        for feature in np.arange(d):
+            counts = BinnedCounts(X[:, feature], bandwidths.min(),
+                                  bandwidths.max())
+            for i, h in enumerate(bandwidths):
+                log_likelihoods[i, feature] = binned_loo_log_likelihood(
+                    X[:, feature], h, rtol=rtol, max_distances=max_distances,
+                    counts=counts)
+        return log_likelihoods
+
+    log_likelihoods = np.zeros(len(bandwidths))
+    sq_norms = (X**2).sum(axis=1)
+    batch_size = max(max_distances // n, 1)
+    for start in np.arange(0, n, batch_size):
+        end = min(start + batch_size, n)
+        sq_distances = np.maximum(sq_norms[start:end].reshape(-1, 1) -
+                                  2 * np.dot(X[start:end], X.T) + sq_norms,
+                                  0)
+        # Every sample is left out of its own estimate
+        rows = np.arange(end - start)
+        sq_distances[rows, start + rows] = np.inf
+        # The largest kernel of every sample is the one of its nearest
+        # neighbour for all the bandwidths, so the distances are shifted
+        # once and every bandwidth only needs one exponential per pair
+        min_sq_distances = sq_distances.min(axis=1)
+        sq_distances -= min_sq_distances[:, np.newaxis]
+        kernel = np.empty_like(sq_distances)
+        for i, h in enumerate(bandwidths):
+            np.multiply(sq_distances, -0.5 / h**2, out=kernel)
+            np.exp(kernel, out=kernel)
+            log_sums = (np.log(kernel.sum(axis=1)) -
+                        0.5 / h**2 * min_sq_distances)
+            log_likelihoods[i] += log_sums.sum()
+
+    log_norm = (np.log(n - 1) + d * np.log(bandwidths) +
+                0.5 * d * np.log(2 * np.pi))
+    return log_likelihoods / n - log_norm
+
+
+def binned_loo_log_likelihood(x, bandwidth, rtol=1e-3, max_distances=2**22,
+                              counts=None):
+    """Mean leave-one-out log-likelihood of a one-dimensional Gaussian
+    kernel density estimate of x, from its binned estimate.
+
+    Args:
+        counts (BinnedCounts): x already binned (e.g. for several
+            bandwidths). If None x is binned on a grid for this bandwidth.
+
+    Returns:
+        (float): mean log-likelihood.
+    """
+    x = np.asarray(x, dtype=float).ravel()
+    n = len(x)
+    h = bandwidth
+    if counts is None:
+        counts = BinnedCounts(x, h, h)
+    kde = BinnedGaussianKDE(bandwidth=h, rtol=rtol).fit_counts(
+        counts, counts.step(h))
+    position = (x - kde.low) / kde.delta
+    grid = np.arange(len(kde.density))
+    density = np.interp(position, grid, kde.density)
+    error = np.interp(position, grid, kde.error)
+    loo_density = (n * density - 1.0 / (h * np.sqrt(2 * np.pi))) / (n - 1)
+    exact = n * error > rtol * (n - 1) * loo_density
+    log_densities = np.empty(n)
+    log_densities[~exact] = np.log(loo_density[~exact])
+    log_densities[exact] = exact_loo_log_densities(x, np.where(exact)[0], h,
+                                                   max_distances)
+    return log_densities.mean()
+
+
+def exact_loo_log_densities(x, indices, bandwidth, max_distances=2**22,
+                            max_log_ratio=36.0):
+    """Leave-one-out log-densities of the samples x[indices] of a
+    one-dimensional Gaussian kernel density estimate of x.
+
+    Only the samples whose kernel is at least exp(-max_log_ratio) times the
+    kernel of the nearest neighbour are added, which are found with a binary
+    search in the sorted samples.
+
+    Returns:
+        (array-like, shape = [n_indices]): log-densities.
+    """
+    n = len(x)
+    h = bandwidth
+    order = np.argsort(x)
+    x_sorted = x[order]
+    positions = np.empty(n, dtype=int)
+    positions[order] = np.arange(n)
+    positions = positions[indices]
+    centres = x[indices]
+
+    # Squared distance to the nearest neighbour, on either side
+    gaps = np.diff(x_sorted)
+    left = np.where(positions > 0, gaps[np.maximum(positions - 1, 0)],
+                    np.inf)
+    right = np.where(positions < n - 1,
+                     gaps[np.minimum(positions, n - 2)], np.inf)
+    min_sq_distances = np.minimum(left, right)**2
+    radius = np.sqrt(min_sq_distances + 2 * max_log_ratio * h**2)
+    starts = np.searchsorted(x_sorted, centres - radius, side='left')
+    ends = np.searchsorted(x_sorted, centres + radius, side='right')
+
+    log_sums = np.empty(len(indices))
+    lengths = ends - starts
+    first = 0
+    while first < len(indices):
+        # Blocks of samples with at most max_distances neighbours in total
+        last = first + max(np.searchsorted(
+            np.cumsum(lengths[first:]), max_distances, side='right'), 1)
+        block = np.arange(first, min(last, len(indices)))
+        block_lengths = lengths[block]
+        owners = np.repeat(np.arange(len(block)), block_lengths)
+        offsets = np.arange(block_lengths.sum()) - np.repeat(
+            np.cumsum(block_lengths) - block_lengths, block_lengths)
+        neighbours = starts[block][owners] + offsets
+        sq_distances = (x_sorted[neighbours] - centres[block][owners])**2
+        kernel = np.exp(-0.5 / h**2 * (sq_distances -
+                                       min_sq_distances[block][owners]))
+        kernel[neighbours == positions[block][owners]] = 0.0
+        log_sums[block] = (np.log(np.bincount(owners, weights=kernel,
+                                              minlength=len(block))) -
+                           0.5 / h**2 * min_sq_distances[block])
+        first = block[-1] + 1
+    return log_sums - np.log((n - 1) * h * np.sqrt(2 * np.pi))
+
+
+def select_bandwidth(X, bandwidths=None, product=False, per_feature=False):
+    """Bandwidth of a Gaussian kernel density estimate of X with the highest
+    leave-one-out likelihood (see loo_log_likelihood).
+
+    Args:
+        X (array-like, shape = [n_samples, n_features]): training samples.
+        bandwidths (array-like, shape = [n_bandwidths]): candidate
+            bandwidths. If None, 50 values from 0.01 to 3 times the mean
+            standard deviation of the features, evenly spaced in log scale.
+        product (bool): if True the bandwidth is selected for the product of
+            one-dimensional estimates of MyMultivariateKernelDensity.
+        per_feature (bool): if True (and product is True) the bandwidth of
+            every feature is selected separately.
+
+    Returns:
+        (float or array-like, shape = [n_features]): selected bandwidth, or
+        bandwidths of every feature if per_feature is True.
+    """
+    X = np.asarray(X, dtype=float)
+    if bandwidths is None:
+        scale = X.std(axis=0).mean()
+        if scale == 0:
+            scale = 1.0
+        bandwidths = scale * np.logspace(-2, np.log10(3), 50)
+    bandwidths = np.asarray(bandwidths, dtype=float)
+    log_likelihoods = loo_log_likelihood(X, bandwidths, product=product)
+    if product and per_feature:
+        return bandwidths[np.argmax(log_likelihoods, axis=0)]
+    if product:
+        log_likelihoods = log_likelihoods.sum(axis=1)
+    return bandwidths[np.argmax(log_likelihoods)]
@@ -0,0 +1,139 @@
+"""
+This module contains the helpers used by the models to make predictions on
+blocks of rows, so that the input (e.g. a numpy.memmap) and the temporary
+arrays do not need to fit in memory at once.
+
+"""
+import numpy as np
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+def gen_batches(n, batch_size):
+    """Generates slices of consecutive rows.
+
+    Args:
+        n (int): total number of rows.
+        batch_size (int): maximum number of rows in every slice.
+
+    Returns:
+        (generator of slice): slices covering the rows from 0 to n.
+    """
+    for start in range(0, n, batch_size):
+        yield slice(start, min(start + batch_size, n))
+
+
+def effective_n_jobs(n_jobs):
+    """Number of threads to use, where negative values count back from the
+    number of CPUs (-1 uses all of them).
+
+    Args:
+        n_jobs (int): requested number of threads, or None for one thread.
+
+    Returns:
+        (int): number of threads.
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(cpu_count() + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+
+def predict_by_batches(predict, X, batch_size=None, out=None, n_jobs=None):
+    """Applies a prediction function to blocks of rows of X.
+
+    Args:
+        predict (function): function with the signature predict(X, out) that
+            returns the predictions for the rows of X. If out is not None the
+            predictions must be written in it.
+        X (array-like, shape = [n_samples, n_features]): input data. Any
+            object that can be sliced by rows can be used, e.g. a
+            numpy.memmap.
+        batch_size (int): maximum number of rows per block. If None all the
+            rows are predicted at once, or split in four blocks per thread
+            when n_jobs is given.
+        out (array-like, shape = [n_samples, ...]): array where the
+            predictions are written. If None it is allocated with the shape
+            and type of the predictions of the first block.
+        n_jobs (int): number of threads that predict the blocks
+            concurrently, writing in out (-1 uses one thread per CPU). This
+            is faster when predict spends its time in code that releases the
+            GIL (most numpy, scipy and sklearn computations). The rows are
+            predicted independently, so the result is the same as predicting
+            the blocks one after the other.
+
+    Returns:
+        out (array-like, shape = [n_samples, ...]): the predictions.
+    """
+    n = np.alen(X)
+    if n == 0:
+        return predict(X, out)
+    n_jobs = effective_n_jobs(n_jobs)
+    if batch_size is None:
+        batch_size = -(-n // (4 * n_jobs)) if n_jobs > 1 else n
+    batches = list(gen_batches(n, batch_size))
+    if out is None:
+        block = predict(X[batches[0]], None)
+        out = np.empty((n,) + block.shape[1:], dtype=block.dtype)
+        out[batches[0]] = block
+        batches = batches[1:]
+
+    def predict_batch(batch):
+        predict(X[batch], out[batch])
+
+    if n_jobs == 1 or len(batches) < 2:
+        for batch in batches:
+            predict_batch(batch)
+    else:
+        pool = ThreadPool(min(n_jobs, len(batches)))
+        try:
+            pool.map(predict_batch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    return out
+
+
+def test():
+    from sklearn import datasets
+    from sklearn.svm import SVC
+    from background_check import BackgroundCheck
+    from confident_classifier import ConfidentClassifier
+    from density_estimators import MyMultivariateNormal
+    from ensemble import Ensemble
+    from oc_decomposition import OcDecomposition
+    from ovo_classifier import OvoClassifier
+
+    np.random.seed(42)
+    dataset = datasets.load_iris()
+    X, y = dataset.data, dataset.target
+    X_test = np.vstack((X, np.random.uniform(0, 8, (50, 4))))
+
+    bc = BackgroundCheck(estimator=MyMultivariateNormal())
+    bc.fit(X)
+    ovo = OvoClassifier(base_classifier=SVC(kernel='linear',
+                                            probability=True))
+    classifier = ConfidentClassifier(classifier=ovo,
+                                     estimator=MyMultivariateNormal())
+    classifier.fit(X, y)
+    ensemble = Ensemble(base_classifier=classifier, n_ensemble=3)
+    ensemble.fit(X, y)
+    oc = OcDecomposition(base_estimator=MyMultivariateNormal(),
+                         normalization='O-norm')
+    oc.fit(X, y)
+
+    for name, predict, kwargs in [
+            ('BackgroundCheck', bc.predict_proba, {'n_jobs': 2}),
+            ('ConfidentClassifier', classifier.predict_proba, {'n_jobs': 2}),
+            ('Ensemble', ensemble.predict_proba, {}),
+            ('OcDecomposition', oc.score, {'n_jobs': 2})]:
+        expected = predict(X_test)
+        print name
+        print np.allclose(predict(X_test, batch_size=7), expected)
+        out = np.empty_like(expected)
+        predict(X_test, batch_size=7, out=out)
+        print np.allclose(out, expected)
+        if kwargs:
+            print np.allclose(predict(X_test, batch_size=7, **kwargs),
+                              expected)
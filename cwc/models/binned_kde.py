@@ -0,0 +1,219 @@
+"""
+This module contains a one-dimensional Gaussian kernel density estimate
+evaluated on a grid, used by the binned algorithm of
+MyMultivariateKernelDensity.
+
+The training samples are linearly binned onto a regular grid and the
+binned counts are convolved with the kernel with the FFT, which gives the
+density at every grid point in O(n + G log G) (see BinnedCounts). The density at any other
+point is then linearly interpolated from the grid in O(1).
+
+Error bound: linear binning and linear interpolation are both linear
+interpolations, of the kernel and of the density, so each of them has an
+error of at most D^2 / 8 times the second derivative, where D is the
+spacing of the grid. The second derivative of the Gaussian kernel K_h
+satisfies |K_h''(x)| <= 1.63 K_{sqrt(2) h}(x) / h^2, so the error of the
+binned density at x is about
+
+    |f_binned(x) - f(x)| <= 0.41 (D / h)^2 f_{sqrt(2) h}(x)
+
+where f_{sqrt(2) h} is the density estimated with a bandwidth sqrt(2) h
+(computed with a second convolution of the same counts). Samples where
+this bound (with a 25% margin, plus the rounding of the FFT) is larger than
+rtol times the density, which happens in the tails, and samples outside of
+the grid are scored with the exact estimate instead.
+
+"""
+from __future__ import division
+import numpy as np
+
+
+class BinnedGaussianKDE(object):
+    """One-dimensional Gaussian kernel density estimate evaluated on a grid.
+
+    Args:
+        bandwidth (float): standard deviation of the kernel.
+        grid_size (int): number of points of the grid. If None the spacing
+            of the grid is bandwidth / 32 (with at most 2^20 points).
+        rtol (float): maximum relative error of the density allowed for a
+            grid estimate. Samples where the error bound is larger are
+            scored exactly.
+        tail (float): the grid covers the training samples plus tail
+            bandwidths on both sides.
+        batch_size (int): number of samples scored at a time by the exact
+            estimate.
+
+    Attributes:
+        low (float): first point of the grid.
+        delta (float): spacing of the grid.
+        density (array-like, shape = [grid_size]): density at the points of
+            the grid.
+        error (array-like, shape = [grid_size]): bound of the absolute error
+            of the density at the points of the grid.
+        data (array-like, shape = [n_samples]): training samples.
+
+    """
+    def __init__(self, bandwidth=1.0, grid_size=None, rtol=1e-3, tail=4.0,
+                 batch_size=1024):
+        self.bandwidth = bandwidth
+        self.grid_size = grid_size
+        self.rtol = rtol
+        self.tail = tail
+        self.batch_size = batch_size
+
+    def fit(self, x):
+        x = np.asarray(x, dtype=float).ravel()
+        return self.fit_counts(BinnedCounts(x, self.bandwidth,
+                                            self.bandwidth,
+                                            grid_size=self.grid_size,
+                                            tail=self.tail))
+
+    def fit_counts(self, counts, step=1):
+        """Fits the estimate to samples already binned (e.g. for several
+        bandwidths, see BinnedCounts).
+
+        Args:
+            counts (BinnedCounts): binned training samples.
+            step (int): the density is kept at every step-th point of the
+                grid of the counts (see BinnedCounts.step).
+
+        Returns:
+            self
+
+        """
+        h = self.bandwidth
+        self.data = counts.data
+        self.low = counts.low
+        self.delta = counts.delta * step
+        self.density = counts.convolve(h, step)
+        density_wide = counts.convolve(np.sqrt(2) * h, step)
+        self.error = (0.41 * 1.25 * (self.delta / h)**2 * density_wide +
+                      counts.n_grid * np.finfo(float).eps *
+                      self.density.max() + counts.wrap_error(h))
+        return self
+
+    def score_samples(self, x):
+        """Log-density of every value of x."""
+        x = np.asarray(x, dtype=float).ravel()
+        position = (x - self.low) / self.delta
+        grid = np.arange(len(self.density))
+        density = np.interp(position, grid, self.density)
+        error = np.interp(position, grid, self.error)
+        exact = ((position < 0) | (position > len(self.density) - 1) |
+                 (error > self.rtol * density))
+        scores = np.empty(len(x))
+        scores[~exact] = np.log(density[~exact])
+        scores[exact] = self.score_samples_exact(x[exact])
+        return scores
+
+    def score_samples_exact(self, x):
+        """Log-density of every value of x, from all the training samples."""
+        h = self.bandwidth
+        n = len(self.data)
+        scores = np.empty(len(x))
+        for start in np.arange(0, len(x), self.batch_size):
+            end = min(start + self.batch_size, len(x))
+            log_kernel = -0.5 * ((x[start:end].reshape(-1, 1) - self.data) /
+                                 h)**2
+            max_log_kernel = log_kernel.max(axis=1)
+            scores[start:end] = max_log_kernel + np.log(np.exp(
+                log_kernel - max_log_kernel.reshape(-1, 1)).sum(axis=1))
+        return scores - np.log(n * h * np.sqrt(2 * np.pi))
+
+    @property
+    def maximum(self):
+        """Log-density at the highest point of the grid."""
+        return np.log(self.density.max())
+
+
+class BinnedCounts(object):
+    """Samples linearly binned onto a regular grid, with the FFT of the
+    counts, which can be convolved with the kernels of several bandwidths.
+
+    The grid covers the samples plus tail times max_bandwidth on both sides,
+    with a spacing of min_bandwidth / 32 (with at most 2^20 points). The
+    Fourier transform of the Gaussian kernel is known, so a convolution only
+    costs one inverse FFT. A wider kernel has no frequencies above a lower
+    limit, so its convolution can be evaluated on every step-th point of
+    the grid with an inverse FFT step times shorter.
+
+    Args:
+        x (array-like, shape = [n_samples]): samples.
+        min_bandwidth (float): smallest bandwidth of the kernels.
+        max_bandwidth (float): largest bandwidth of the kernels.
+        grid_size (int): if given, number of points of the grid.
+        tail (float): margin of the grid, in bandwidths.
+
+    Attributes:
+        data (array-like, shape = [n_samples]): samples.
+        low (float): first point of the grid.
+        delta (float): spacing of the grid.
+        n_grid (int): number of points of the grid.
+
+    """
+    def __init__(self, x, min_bandwidth, max_bandwidth, grid_size=None,
+                 tail=4.0):
+        x = np.asarray(x, dtype=float).ravel()
+        self.data = x
+        self.low = x.min() - tail * max_bandwidth
+        high = x.max() + tail * max_bandwidth
+        n_grid = grid_size
+        if n_grid is None:
+            n_grid = min(int(np.ceil(32 * (high - self.low) /
+                                     min_bandwidth)) + 1, 2**20)
+        self.n_grid = n_grid
+        self.delta = (high - self.low) / (n_grid - 1)
+
+        # Linear binning: every sample is split between its two neighbours
+        position = (x - self.low) / self.delta
+        left = np.minimum(np.floor(position).astype(int), n_grid - 2)
+        weight = position - left
+        counts = (np.bincount(left, weights=1.0 - weight, minlength=n_grid) +
+                  np.bincount(left + 1, weights=weight, minlength=n_grid))
+
+        # Circular convolutions, zero padded so that the kernels only wrap
+        # around further than the width of the grid (see wrap_error)
+        self._n_fft = 2**int(np.ceil(np.log2(2 * n_grid)))
+        self._fft_counts = np.fft.rfft(counts, self._n_fft) / len(x)
+
+    def step(self, bandwidth):
+        """Largest power of two step such that every step-th point of the
+        grid is at most bandwidth / 32 from the next one."""
+        step = 1
+        while (2 * step * self.delta <= bandwidth / 32 and
+               2 * step <= self._n_fft // 2):
+            step *= 2
+        return step
+
+    def convolve(self, bandwidth, step=1):
+        """Density estimated with a Gaussian kernel of the given bandwidth at
+        every step-th point of the grid.
+
+        The spectrum of the kernel sampled on the grid is the sum of the
+        copies of exp(-2 (pi bandwidth f)^2) every 1 / delta, and it is only
+        kept up to the Nyquist frequency of the points that are evaluated,
+        where it is below exp(-2 (pi bandwidth / (2 step delta))^2), which
+        underflows if step delta <= bandwidth / 32 (see step).
+        """
+        n_fft = self._n_fft // step
+        frequencies = np.arange(n_fft // 2 + 1) / (self._n_fft * self.delta)
+        kernel = np.exp(-2 * (np.pi * bandwidth * frequencies)**2)
+        # The copies only matter if the grid is coarse for the bandwidth
+        k = 1
+        while np.pi * bandwidth * (k / self.delta - frequencies[-1]) < 20:
+            kernel += (np.exp(-2 * (np.pi * bandwidth *
+                                    (k / self.delta - frequencies))**2) +
+                       np.exp(-2 * (np.pi * bandwidth *
+                                    (k / self.delta + frequencies))**2))
+            k += 1
+        kernel /= self.delta * step
+        density = np.fft.irfft(self._fft_counts[:n_fft // 2 + 1] * kernel,
+                               n_fft)
+        return density[:(self.n_grid - 1) // step + 1]
+
+    def wrap_error(self, bandwidth):
+        """Bound of the density added by the periodic copies of the kernel,
+        which are at least (n_fft - n_grid + 1) delta from any sample."""
+        distance = (self._n_fft - self.n_grid + 1) * self.delta
+        return (2 * np.exp(-0.5 * (distance / bandwidth)**2) /
+                (bandwidth * np.sqrt(2 * np.pi)))
@@ -3,6 +3,7 @@ import numpy as np
 
 from background_check import BackgroundCheck
 from discriminative_models import MyDecisionTreeClassifier
+from batches import predict_by_batches
 
 from sklearn.mixture import GMM
 
@@ -20,11 +21,86 @@ class ConfidentClassifier(object):
             self._classifier.fit(X, y)
         self._bc.fit(X)
 
-    def predict_proba(self, X, mu=None, m=None):
+    def predict_proba(self, X, mu=None, m=None, batch_size=None, out=None,
+                      n_jobs=None):
+        """Posterior probabilities of the classes and the background.
+
+        Args:
+            X (array-like, shape = [n_samples, n_features]): test data. Any
+                object that can be sliced by rows can be used (e.g. a
+                numpy.memmap).
+            batch_size (int): if given, X is processed in blocks of
+                batch_size rows, which bounds the memory used.
+            out (array-like, shape = [n_samples, n_classes + 1]): if given,
+                the posteriors are written in this array.
+            n_jobs (int): number of threads that process the blocks of X
+                concurrently (-1 uses one thread per CPU). See
+                predict_by_batches.
+
+        Returns:
+            posteriors (array-like, shape = [n_samples, n_classes + 1]):
+            class posteriors times the foreground probability, and the
+            background probability in the last column.
+
+        """
+        def predict_block(x, posteriors):
+            class_posteriors = self._classifier.predict_proba(x)
+            bc_posteriors = self._bc.predict_proba(x, mu=mu, m=m)
+            if posteriors is None:
+                posteriors = np.empty((np.alen(x),
+                                       class_posteriors.shape[1] + 1))
+            np.multiply(class_posteriors, bc_posteriors[:, 1].reshape(-1, 1),
+                        out=posteriors[:, :-1])
+            posteriors[:, -1] = bc_posteriors[:, 0]
+            return posteriors
+
+        return predict_by_batches(predict_block, X, batch_size=batch_size,
+                                  out=out, n_jobs=n_jobs)
+
+    def predict_proba_grid(self, X, mus, ms, statistic=None):
+        """Posterior probabilities for every pair of values of mu and m.
+
+        The classifier and the density estimator are evaluated only once.
+        If statistic is given, the posteriors of one pair of mu and m are
+        computed at a time, so they are never all in memory.
+
+        Args:
+            X (array-like, shape = [n_samples, n_features]): test data.
+            mus (array-like, shape = [n_mus]): values of mu.
+            ms (array-like, shape = [n_ms]): values of m.
+            statistic (function): if given, it is applied to the posteriors
+                (shape = [n_samples, n_classes + 1]) of every pair of mu and
+                m, and its results are returned instead of the posteriors.
+
+        Returns:
+            posteriors (array-like, shape = [n_mus, n_ms, n_samples,
+            n_classes + 1]): see predict_proba, or the results of statistic
+            (shape = [n_mus, n_ms, ...]).
+
+        """
         class_posteriors = self._classifier.predict_proba(X)
-        bc_posteriors = self._bc.predict_proba(X, mu=mu, m=m)
-        class_posteriors = class_posteriors * bc_posteriors[:, 1].reshape(-1, 1)
-        return np.hstack((class_posteriors, bc_posteriors[:, 0].reshape(-1, 1)))
+        if statistic is None:
+            bc_posteriors = self._bc.predict_proba_grid(X, mus, ms)
+            posteriors = np.empty(bc_posteriors.shape[:-1] +
+                                  (class_posteriors.shape[1] + 1,))
+            np.multiply(class_posteriors, bc_posteriors[..., 1:],
+                        out=posteriors[..., :-1])
+            posteriors[..., -1] = bc_posteriors[..., 0]
+            return posteriors
+        q = self._bc.compute_q(np.asarray(self._bc.score(X), dtype=float))
+        bc_posteriors = np.empty((np.alen(q), 2))
+        posteriors = np.empty((np.alen(q), class_posteriors.shape[1] + 1))
+        results = []
+        for mu in np.ravel(mus):
+            results.append([])
+            for m in np.ravel(ms):
+                self._bc.compute_posteriors(q, mu, m, out=bc_posteriors)
+                np.multiply(class_posteriors, bc_posteriors[:, 1:],
+                            out=posteriors[:, :-1])
+                posteriors[:, -1] = bc_posteriors[:, 0]
+                # The buffer is reused, so views of it are copied
+                results[-1].append(np.copy(statistic(posteriors)))
+        return np.array(results)
 
     def predict_class_proba(self, X):
         return self._classifier.predict_proba(X)
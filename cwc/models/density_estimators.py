@@ -1,39 +1,100 @@
+from __future__ import division
 from sklearn import svm
 from ..data_wrappers import reject
+from scoring import kde_maximum
+from scoring import gmm_maximum
+from batches import effective_n_jobs
+from binned_kde import BinnedGaussianKDE
 import numpy as np
+from multiprocessing import Pool
 from scipy.stats import multivariate_normal
+from scipy.linalg import solve_triangular
+from scipy.special import gammaln
 from sklearn.mixture import GMM
 from sklearn.neighbors import KernelDensity
+from sklearn.neighbors import KDTree
+from sklearn.neighbors import BallTree
+from sklearn.utils.extmath import randomized_svd
+from sklearn.kernel_approximation import Nystroem
+from sklearn.kernel_approximation import RBFSampler
 
 
 class DensityEstimators(object):
-    def __init__(self):
+    """One confidence model per class, trained against reject data.
+
+    Args:
+        pca_solver (string): solver of the PCA of the reject data of every
+            class and of the aggregation model (see reject.fit_pca).
+            'randomized' only computes about the directions that are kept.
+        projected (bool): if True every confidence model is trained and
+            used in the whitened PCA space of the reject data of its class
+            (see reject.RejectShape), instead of the space of the samples.
+            The reject data (unknown) is then kept in that space.
+        reject_proportion (float): number of reject data-points per
+            training point of every class (and of the aggregation model).
+        boundary_proportion (float): if given, that proportion of the reject
+            data is drawn near the boundary of the training points and the
+            reject data is weighted so that it stands for as much uniform reject data as
+            training points (see reject.RejectShape.sample_weighted). A
+            reject_proportion of 0.1 to 0.2 is then usually enough.
+
+    """
+    def __init__(self, pca_solver='full', projected=False,
+                 reject_proportion=1.0, boundary_proportion=0):
         self.models = {}
         self.unknown = {}
+        self.unknown_weights = {}
         self.known = {}
+        self.shapes = {}
+        self.pca_solver = pca_solver
+        self.projected = projected
+        self.reject_proportion = reject_proportion
+        self.boundary_proportion = boundary_proportion
 
-    def train_confidence_model(self, X_kno, X_unk):
+    def train_confidence_model(self, X_kno, X_unk, unk_weights=None):
         """Train a classifier of training points
 
         Returns a classifier that predicts high probability values for training
-        points and low probability values for reject points.
+        points and low probability values for reject points. unk_weights are
+        the sample weights of the reject points (1 if None).
         """
         model = svm.SVC(probability=True)
         #model = tree.DecisionTreeClassifier(max_depth=5)
 
         X_kno_unk = np.vstack((X_kno,X_unk))
         y = np.hstack((np.ones(np.alen(X_kno)), np.zeros(np.alen(X_unk)))).T
-        model.fit(X_kno_unk, y)
+        if unk_weights is None:
+            model.fit(X_kno_unk, y)
+        else:
+            weights = np.hstack((np.ones(np.alen(X_kno)), unk_weights))
+            model.fit(X_kno_unk, y, sample_weight=weights)
 
         return model
 
+    def _reject_shape(self, x, pca_solver='full'):
+        return reject.RejectShape(method='uniform_hsphere', pca=True,
+                pca_variance=0.99, pca_components=0, hshape_cov=0,
+                hshape_prop_in=0.99, hshape_multiplier=1.5,
+                pca_solver=pca_solver, projected=self.projected,
+                boundary_proportion=self.boundary_proportion).fit(x)
+
+    def _sample_unknown(self, shape, n):
+        """Reject data for n training points and its weights (None if it is
+        not weighted)."""
+        size = max(int(round(n*self.reject_proportion)), 1)
+        if not self.boundary_proportion:
+            return shape.sample(size), None
+        r, weights = shape.sample_weighted(size)
+        return r, weights*(n/size)
+
     def _train_aggregation_model(self, X):
         scores_kno = self.predict_proba(X)
-        self.scores_agg_unk = reject.create_reject_data(scores_kno,
-                proportion=1, method='uniform_hsphere', pca=True,
-                pca_variance=0.99, pca_components=0, hshape_cov=0,
-                hshape_prop_in=0.99, hshape_multiplier=1.5)
-        model_agg = self.train_confidence_model(scores_kno,self.scores_agg_unk)
+        self.shape_agg = self._reject_shape(scores_kno, self.pca_solver)
+        self.scores_agg_unk, weights = self._sample_unknown(
+                self.shape_agg, np.alen(scores_kno))
+        model_agg = self.train_confidence_model(
+                self.shape_agg.transform(scores_kno), self.scores_agg_unk,
+                weights)
 
         return model_agg
 
@@ -49,91 +110,364 @@ class DensityEstimators(object):
         self.accuracies = {}
         for y in self.classes:
             x = X[Y==y]
-            self.unknown[y] = reject.create_reject_data(x, proportion=1,
-                        method='uniform_hsphere', pca=True, pca_variance=0.99,
-                        pca_components=0, hshape_cov=0, hshape_prop_in=0.99,
-                        hshape_multiplier=1.5)
-            self.models[y] = self.train_confidence_model(x,self.unknown[y])
+            self.shapes[y] = self._reject_shape(x, self.pca_solver)
+            self.unknown[y], self.unknown_weights[y] = self._sample_unknown(
+                    self.shapes[y], np.alen(x))
+            self.models[y] = self.train_confidence_model(
+                    self.shapes[y].transform(x), self.unknown[y],
+                    self.unknown_weights[y])
 
         self.model_agg = self._train_aggregation_model(X)
 
     def predict_proba(self,X):
         scores = np.zeros((np.alen(X), len(self.classes)))
         for index, y in enumerate(self.classes):
-            scores[:,index] = self.models[y].predict_proba(X)[:,1]
+            scores[:,index] = self.models[y].predict_proba(
+                    self.shapes[y].transform(X))[:,1]
 
         return scores
 
     def predict_confidence(self,X):
         scores = self.predict_proba(X)
-        return self.model_agg.predict_proba(scores)[:,1]
+        return self.model_agg.predict_proba(
+                self.shape_agg.transform(scores))[:,1]
+
+def update_moments(n, mean, scatter, x, diagonal=False):
+    """Merges the moments of the samples in x with the ones of previous
+    samples.
+
+    The moments of x are combined with the previous ones using the pairwise
+    update of Chan et al., which is numerically stable, so the samples can
+    be processed in chunks.
+
+    Args:
+        n (int): number of previous samples (0 if there are none).
+        mean (array-like, shape = [n_features]): mean of the previous
+            samples.
+        scatter (array-like, shape = [n_features, n_features]): sum of the
+            outer products of the centred previous samples (only its
+            diagonal, shape = [n_features], if diagonal is True).
+        x (array-like, shape = [n_samples, n_features]): new samples.
+        diagonal (bool): if True only the diagonal of the scatter matrix is
+            computed.
+
+    Returns:
+        (int, array-like, array-like): number of samples, mean and scatter
+        matrix of the previous samples and x together.
+    """
+    x = np.asarray(x, dtype=float)
+    if x.ndim == 1:
+        x = x.reshape(-1, 1)
+    n_x = x.shape[0]
+    mean_x = x.mean(axis=0)
+    x_c = x - mean_x
+    if diagonal:
+        scatter_x = np.einsum('ij,ij->j', x_c, x_c)
+    else:
+        scatter_x = np.dot(x_c.T, x_c)
+    return merge_moments(n, mean, scatter, n_x, mean_x, scatter_x)
+
+
+def merge_moments(n_a, mean_a, scatter_a, n_b, mean_b, scatter_b):
+    """Moments of the union of two disjoint sets of samples (see
+    update_moments).
+
+    Returns:
+        (int, array-like, array-like): number of samples, mean and scatter
+        matrix of both sets together.
+    """
+    if n_a == 0:
+        return n_b, mean_b, scatter_b
+    if n_b == 0:
+        return n_a, mean_a, scatter_a
+    n_total = n_a + n_b
+    delta = mean_b - mean_a
+    correction = scatter_correction(delta, np.ndim(scatter_a))
+    scatter = scatter_a + scatter_b + correction * (n_a * n_b / n_total)
+    mean = mean_a + delta * (n_b / n_total)
+    return n_total, mean, scatter
+
+
+def downdate_moments(n, mean, scatter, n_x, mean_x, scatter_x):
+    """Removes the moments of a subset of the samples, the inverse of
+    merge_moments.
+
+    Args:
+        n (int): number of samples.
+        mean (array-like, shape = [n_features]): mean of the samples.
+        scatter (array-like, shape = [n_features, n_features] or
+            [n_features]): scatter matrix of the samples, or its diagonal.
+        n_x (int): number of samples of the subset.
+        mean_x (array-like, shape = [n_features]): mean of the subset.
+        scatter_x (array-like): scatter matrix of the subset.
+
+    Returns:
+        (int, array-like, array-like): number of samples, mean and scatter
+        matrix of the samples that are not in the subset.
+    """
+    if n_x == 0:
+        return n, mean, scatter
+    n_rest = n - n_x
+    mean_rest = (n * mean - n_x * mean_x) / n_rest
+    delta = mean_x - mean_rest
+    correction = scatter_correction(delta, np.ndim(scatter))
+    scatter_rest = scatter - scatter_x - correction * (n_rest * n_x / n)
+    # The cancellation can leave tiny negative variances where they are 0
+    if np.ndim(scatter_rest) == 2:
+        np.fill_diagonal(scatter_rest,
+                         np.maximum(np.diagonal(scatter_rest), 0))
+    else:
+        scatter_rest = np.maximum(scatter_rest, 0)
+    return n_rest, mean_rest, scatter_rest
+
+
+def scatter_correction(delta, ndim):
+    """Outer product of the difference between two means (only its diagonal
+    if ndim is 1)."""
+    if ndim == 1:
+        return delta * delta
+    return np.outer(delta, delta)
+
+
+class FoldMoments(object):
+    """Moments of every class in every fold of a cross-validation.
+
+    The number of samples, mean and scatter matrix of every class in every
+    fold are computed with one pass over the data. The moments of the
+    training folds are then obtained by removing the moments of the test
+    fold from the ones of the whole class (see downdate_moments), so the
+    Gaussian estimators of every training set can be fitted without going
+    through the training data again (see fit_estimator).
+
+    Args:
+        X (array-like, shape = [n_samples, n_features]): data.
+        y (array-like, shape = [n_samples]): class of every sample.
+        folds (array-like, shape = [n_samples]): test fold of every sample
+            (e.g. the test_folds of sklearn's StratifiedKFold).
+        diagonal (bool): if True only the diagonals of the scatter matrices
+            are kept, which is enough for estimators with
+            covariance_type='diag'.
+
+    """
+    def __init__(self, X, y, folds, diagonal=False):
+        self.diagonal = diagonal
+        self.classes = np.unique(y)
+        self.fold_ids = np.unique(folds)
+        self._fold_moments = {}
+        self._class_moments = {}
+        for label in self.classes:
+            class_moments = (0, None, None)
+            for fold in self.fold_ids:
+                x = X[(y == label) & (folds == fold)]
+                if np.alen(x) == 0:
+                    moments = (0, None, None)
+                else:
+                    moments = update_moments(0, None, None, x,
+                                             diagonal=diagonal)
+                self._fold_moments[label, fold] = moments
+                class_moments = merge_moments(*(class_moments + moments))
+            self._class_moments[label] = class_moments
+
+    def training_moments(self, label, test_fold):
+        """Moments of the samples of a class that are not in the test fold.
+
+        Returns:
+            (int, array-like, array-like): number of samples, mean and
+            scatter matrix.
+        """
+        return downdate_moments(*(self._class_moments[label] +
+                                  self._fold_moments[label, test_fold]))
+
+    def fit_estimator(self, estimator, label, test_fold):
+        """Fits estimator (e.g. MyMultivariateNormal) to the samples of a
+        class that are not in the test fold, with its fit_moments method.
+
+        Returns:
+            estimator: the fitted estimator.
+        """
+        estimator.fit_moments(*self.training_moments(label, test_fold))
+        return estimator
+
 
 class MyGMM(GMM):
     def score(self, X):
         return np.exp(super(MyGMM, self).score(X))
 
 class MyMultivariateNormal(object):
+    """Multivariate normal density estimator.
+
+    The covariance matrix is factorised once (Cholesky factor, or only the
+    standard deviations when it is diagonal) and every score is computed
+    from the row-wise squared Mahalanobis distances, processing the rows in
+    blocks of batch_size so that the memory needed does not depend on the
+    number of samples.
+
+    Args:
+        mean (array-like, shape = [n_features]): mean of the distribution.
+        cov (array-like, shape = [n_features, n_features]): covariance
+            matrix of the distribution.
+        min_covar (float): value used to replace the zeros of the covariance
+            matrix estimated in fit.
+        covariance_type (string): 'full' or 'diag'.
+        batch_size (int): number of rows scored at a time.
+
+    """
     def __init__(self, mean=None, cov=None, min_covar=1e-10,
-                 covariance_type='diag'):
+                 covariance_type='diag', batch_size=4096):
         if mean is not None:
-            self.mu = mean
+            self.mu = np.atleast_1d(np.asarray(mean, dtype=float))
             self.size = len(self.mu)
             # TODO assess that the parameters mean and cov are correct
             if cov is not None:
-                # TODO create a function that computes deg, norm_const and inv
-                self.sigma = cov
-                self.det = np.linalg.det(self.sigma)
-                self.norm_const = 1.0/ ( np.power((2*np.pi),float(self.size)/2) *
-                        np.sqrt(self.det) )
-                self.inv = np.linalg.inv(self.sigma)
+                self.sigma = np.atleast_2d(np.asarray(cov, dtype=float))
+                self._compute_factor()
         self.min_covar = min_covar
         self.covariance_type = covariance_type
+        self.batch_size = batch_size
         self.alpha = np.float32(1e-32)
+        self._n = 0
 
 
         if covariance_type not in ['full', 'diag',]:
             raise ValueError('Invalid value for covariance_type: %s' %
                              covariance_type)
 
+    def __setstate__(self, state):
+        """Restores a pickled MyMultivariateNormal, factorising sigma again
+        if it was pickled before the factor existed. The moments of the
+        training samples were not kept then, so a later partial_fit starts
+        from scratch."""
+        self.__dict__.update(state)
+        self.__dict__.setdefault('batch_size', 4096)
+        self.__dict__.setdefault('_n', 0)
+        if '_log_norm_const' not in state and 'sigma' in state:
+            self.mu = np.atleast_1d(np.asarray(self.mu, dtype=float))
+            self.sigma = np.atleast_2d(np.asarray(self.sigma, dtype=float))
+            self.size = len(self.mu)
+            self._compute_factor()
+
     def pseudo_determinant(self, A, alpha):
         n = len(A)
         return np.linalg.det(A + np.eye(n)*alpha)/ np.power(alpha, n-np.rank(A))
 
     def fit(self, x):
-        self.mu = x.mean(axis=0)
-        self.sigma = np.cov(x.T, bias=1) # bias=0 (N-1), bias=1 (N)
-        self.sigma[self.sigma==0] = self.min_covar
+        self._n = 0
+        self.partial_fit(x)
+
+    def partial_fit(self, x):
+        """Updates the mean and the covariance matrix with the samples in x.
+
+        Only the number of samples, the mean and the scatter matrix are kept
+        between calls, so fitting the chunks of a dataset one after the other
+        gives the same parameters as fitting the whole dataset.
+
+        Args:
+            x (array-like, shape = [n_samples, n_features]): new samples.
+
+        """
+        if self._n == 0:
+            self.mu = None
+            self._scatter = None
+        self.fit_moments(*update_moments(
+            self._n, self.mu, self._scatter, x,
+            diagonal=(self.covariance_type == 'diag')))
+
+    def fit_moments(self, n, mean, scatter):
+        """Sets the mean and the covariance matrix from the moments of the
+        training samples (see FoldMoments).
+
+        Args:
+            n (int): number of samples.
+            mean (array-like, shape = [n_features]): mean of the samples.
+            scatter (array-like, shape = [n_features, n_features]): sum of
+                the outer products of the centred samples, or only its
+                diagonal if covariance_type is 'diag'.
+
+        """
+        if self.covariance_type == 'diag' and np.ndim(scatter) == 2:
+            scatter = np.diag(scatter)
+        self._n, self.mu, self._scatter = n, mean, scatter
+        cov = self._scatter / self._n # bias=1 (N)
+        cov[cov==0] = self.min_covar
         if(self.covariance_type == 'diag'):
-            self.sigma = np.eye(np.alen(self.sigma))*self.sigma
+            cov = np.diag(cov)
+        self.sigma = cov
+        self.size = self.mu.shape[0]
+        self._compute_factor()
 
-        if len(self.mu.shape) == 0:
-            self.size = 1
-        else:
-            self.size = self.mu.shape[0]
-
-        self.det = np.linalg.det(self.sigma)
-        # If sigma is singular
-        if self.det == 0:
-            self.pseudo_det = self.pseudo_determinant(self.sigma*2*np.pi, self.alpha)
-            self.norm_const = 1.0/ np.sqrt(self.pseudo_det)
-            self.inv = np.linalg.pinv(self.sigma)
+    def _compute_factor(self):
+        """Factorises sigma and computes the log normalisation constant.
+
+        A diagonal sigma only keeps its standard deviations, any other
+        positive definite sigma keeps its lower Cholesky factor. If sigma is
+        singular the quadratic form uses the pseudo-inverse (through a
+        whitening matrix of its non-null eigenvectors) and the pseudo
+        determinant.
+        """
+        variances = np.diag(self.sigma)
+        self._std = None
+        self._chol = None
+        self._whiten = None
+        if (np.all(variances > 0) and
+                np.count_nonzero(self.sigma - np.diag(variances)) == 0):
+            self._std = np.sqrt(variances)
+            log_det = 2.0 * np.log(self._std).sum()
+            rank = self.size
         else:
-            self.norm_const = 1.0/ ( np.power((2*np.pi),float(self.size)/2) *
-                    np.sqrt(self.det) )
-            self.inv = np.linalg.inv(self.sigma)
+            try:
+                self._chol = np.linalg.cholesky(self.sigma)
+                log_det = 2.0 * np.log(np.diag(self._chol)).sum()
+                rank = self.size
+            except np.linalg.LinAlgError:
+                # If sigma is singular
+                eigvals, eigvecs = np.linalg.eigh(self.sigma)
+                tol = eigvals.max() * self.size * np.finfo(float).eps
+                nonnull = eigvals > tol
+                self._whiten = eigvecs[:, nonnull] / np.sqrt(eigvals[nonnull])
+                log_det = np.log(eigvals[nonnull]).sum()
+                rank = np.sum(nonnull)
 
-    def score(self,x):
-        x_mu = np.subtract(x,self.mu)
-        result = np.exp(-0.5 * np.diag(np.dot(x_mu,np.dot(self.inv,x_mu.T))))
+        self._log_norm_const = -0.5 * (rank * np.log(2 * np.pi) + log_det)
+        self.det = np.exp(log_det)
+        self.norm_const = np.exp(self._log_norm_const)
 
-        return self.norm_const * result
+    def mahalanobis(self, x):
+        """Squared Mahalanobis distance from every row of x to the mean.
 
-    # FIXME: look for an appropriate name
-    def log_likelihood(self,x):
-        x_mu = np.subtract(x,self.mu)
-        result = -0.5 * np.diag(np.dot(x_mu,np.dot(self.inv,x_mu.T)))
+        Args:
+            x (array-like, shape = [n_samples, n_features]): samples.
+
+        Returns:
+            (array-like, shape = [n_samples]): squared distances.
+
+        """
+        x = np.asarray(x)
+        if x.ndim < 2:
+            x = x.reshape(-1, self.size)
+        n = x.shape[0]
+        distances = np.empty(n)
+        for start in np.arange(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            x_mu = np.subtract(x[start:end], self.mu)
+            if self._std is not None:
+                x_mu /= self._std
+            elif self._chol is not None:
+                x_mu = solve_triangular(self._chol, x_mu.T, lower=True,
+                                        check_finite=False).T
+            else:
+                x_mu = np.dot(x_mu, self._whiten)
+            distances[start:end] = np.einsum('ij,ij->i', x_mu, x_mu)
+        return distances
 
-        return self.norm_const * result
+    def score_samples(self, x):
+        """Log-density of every row of x."""
+        return self._log_norm_const - 0.5 * self.mahalanobis(x)
+
+    def score(self,x):
+        return np.exp(self.score_samples(x))
+
+    def log_likelihood(self,x):
+        return self.score_samples(x)
 
     @property
     def means_(self):
@@ -150,7 +484,7 @@ class MyMultivariateNormal(object):
 
     @property
     def maximum(self):
-        return self.score(np.array(self.mu).reshape(-1,1))
+        return np.array([self._log_norm_const])
 
 
 class MultivariateNormal(object):
@@ -162,16 +496,44 @@ class MultivariateNormal(object):
             self.sigma = cov
         self.allow_singular = allow_singular
         self.covariance_type = covariance_type
+        self._n = 0
 
     def fit(self, x):
-        self.mu = x.mean(axis=0)
-        self.sigma = np.cov(x.T, bias=1) # bias=0 (N-1), bias=1 (N)
+        self._n = 0
+        self.partial_fit(x)
+
+    def partial_fit(self, x):
+        """Updates the mean and the covariance matrix with the samples in x
+        (see MyMultivariateNormal.partial_fit).
+
+        Args:
+            x (array-like, shape = [n_samples, n_features]): new samples.
+
+        """
+        if self._n == 0:
+            self.mu = None
+            self._scatter = None
+        self.fit_moments(*update_moments(
+            self._n, self.mu, self._scatter, x,
+            diagonal=(self.covariance_type == 'diag')))
+
+    def fit_moments(self, n, mean, scatter):
+        """Sets the mean and the covariance matrix from the moments of the
+        training samples (see MyMultivariateNormal.fit_moments).
+        """
+        if self.covariance_type == 'diag' and np.ndim(scatter) == 2:
+            scatter = np.diag(scatter)
+        self._n, self.mu, self._scatter = n, mean, scatter
+        self.sigma = self._scatter / self._n # bias=1 (N)
         if self.covariance_type == 'diag':
-            self.sigma = np.eye(np.alen(self.sigma))*self.sigma
+            self.sigma = np.diag(self.sigma)
 
         self.model = multivariate_normal(mean=self.mu, cov=self.sigma,
                 allow_singular=self.allow_singular)
 
+    def score_samples(self, x):
+        return self.model.logpdf(x)
+
     def score(self,x):
         return self.model.pdf(x)
 
@@ -188,19 +550,192 @@ class MultivariateNormal(object):
     def sample(self, n):
         return np.random.multivariate_normal(self.mu, self.sigma, n)
 
+    @property
+    def maximum(self):
+        return np.array([self.model.logpdf(self.mu)])
+
+
+class ProbabilisticPCA(object):
+    """Probabilistic PCA density estimator (Tipping and Bishop, 1999).
+
+    The samples are modelled as a Gaussian with covariance W W^T + s I,
+    where the loading matrix W (shape = [n_features, n_components]) spans
+    the principal subspace of the training samples and s is the isotropic
+    noise variance, the mean variance of the discarded directions. Only the
+    principal directions V, their variances l and s are kept, and the
+    Woodbury identity gives the squared Mahalanobis distance of x - mean as
+
+        |z / sqrt(l)|^2 + (|x - mean|^2 - |z|^2) / s,    z = V (x - mean)
+
+    so scoring costs O(n_samples n_features n_components) and no matrix of
+    shape [n_features, n_features] is ever built, even when the covariance
+    of the training samples is singular (e.g. image pixels).
+
+    Args:
+        n_components (int): dimension of the principal subspace. It is
+            reduced to n_samples - 1 or n_features - 1 if it is larger.
+        svd_solver (string): 'full' computes the whole SVD of the centred
+            samples, 'randomized' only the first n_components directions
+            (Halko et al., 2011), in O(n_samples n_features n_components).
+            'auto' uses 'randomized' when n_components is smaller than a
+            tenth of the dimensions of the samples.
+        min_variance (float): lower bound of the noise variance, relative to
+            the mean variance of the features.
+        random_state (int): seed of the randomized SVD.
+        batch_size (int): number of rows scored at a time.
+
+    Attributes:
+        mean_ (array-like, shape = [n_features]): mean of the samples.
+        components_ (array-like, shape = [n_components, n_features]):
+            orthonormal principal directions.
+        explained_variance_ (array-like, shape = [n_components]): variances
+            along the principal directions (at least noise_variance_).
+        noise_variance_ (float): variance of the isotropic noise.
+
+    """
+    def __init__(self, n_components=10, svd_solver='auto', min_variance=1e-6,
+                 random_state=0, batch_size=4096):
+        self.n_components = n_components
+        self.svd_solver = svd_solver
+        self.min_variance = min_variance
+        self.random_state = random_state
+        self.batch_size = batch_size
+
+        if svd_solver not in ['auto', 'full', 'randomized']:
+            raise ValueError('Invalid value for svd_solver: %s' % svd_solver)
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=float)
+        n, d = X.shape
+        k = max(min(self.n_components, n - 1, d - 1), 0)
+        self.mean_ = X.mean(axis=0)
+        X = X - self.mean_
+        total_variance = np.einsum('ij,ij->', X, X) / n
+
+        solver = self.svd_solver
+        if solver == 'auto':
+            solver = 'randomized' if k < 0.1 * min(n, d) else 'full'
+        if k == 0:
+            singular_values = np.zeros(0)
+            components = np.zeros((0, d))
+        elif solver == 'randomized':
+            _, singular_values, components = randomized_svd(
+                X, k, random_state=self.random_state)
+        else:
+            _, singular_values, components = np.linalg.svd(
+                X, full_matrices=False)
+        singular_values = singular_values[:k]
+        self.components_ = components[:k]
+
+        variances = singular_values**2 / n
+        self.noise_variance_ = max(
+            (total_variance - variances.sum()) / (d - k),
+            self.min_variance * max(total_variance / d, np.finfo(float).tiny))
+        self.explained_variance_ = np.maximum(variances, self.noise_variance_)
+        log_det = (np.log(self.explained_variance_).sum() +
+                   (d - k) * np.log(self.noise_variance_))
+        self._log_norm_const = -0.5 * (d * np.log(2 * np.pi) + log_det)
+        return self
+
+    @property
+    def loadings_(self):
+        """Loading matrix W, shape = [n_features, n_components]."""
+        return (self.components_.T *
+                np.sqrt(self.explained_variance_ - self.noise_variance_))
+
+    def mahalanobis(self, x):
+        """Squared Mahalanobis distance from every row of x to the mean."""
+        x = np.asarray(x)
+        if x.ndim < 2:
+            x = x.reshape(-1, len(self.mean_))
+        n = x.shape[0]
+        distances = np.empty(n)
+        for start in np.arange(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            x_mu = np.subtract(x[start:end], self.mean_)
+            z = np.dot(x_mu, self.components_.T)
+            residuals = np.maximum(np.einsum('ij,ij->i', x_mu, x_mu) -
+                                   np.einsum('ij,ij->i', z, z), 0)
+            distances[start:end] = (
+                np.einsum('ij,ij->i', z / self.explained_variance_, z) +
+                residuals / self.noise_variance_)
+        return distances
+
+    def score_samples(self, x):
+        """Log-density of every row of x."""
+        return self._log_norm_const - 0.5 * self.mahalanobis(x)
+
+    def score(self, x):
+        return np.exp(self.score_samples(x))
+
+    def sample(self, n):
+        z = np.random.randn(n, len(self.explained_variance_))
+        noise = np.random.randn(n, len(self.mean_))
+        return (self.mean_ + np.dot(z, self.loadings_.T) +
+                np.sqrt(self.noise_variance_) * noise)
+
+    @property
+    def maximum(self):
+        return np.array([self._log_norm_const])
+
 
 class MyMultivariateKernelDensity(object):
-    def __init__(self, kernel='gaussian', bandwidth=1.0):
+    """Product of one-dimensional kernel density estimates, one per feature.
+
+    Args:
+        kernel (string): kernel of sklearn.neighbors.KernelDensity.
+        bandwidth (float or array-like, shape = [n_features]): bandwidth of
+            the kernel, or of the kernel of every feature (see
+            bandwidth.select_bandwidth).
+        algorithm (string): 'exact' scores every feature with
+            sklearn.neighbors.KernelDensity, which costs O(n_train) per
+            sample. 'binned' (only for the gaussian kernel) computes the
+            density of every feature on a grid and interpolates it, which
+            costs O(n_train + grid_size log grid_size) per feature to fit and
+            O(1) per sample, falling back to the exact density where the
+            relative error could be larger than rtol (see
+            BinnedGaussianKDE).
+        grid_size (int): number of grid points per feature ('binned'). If
+            None the spacing of the grid is bandwidth / 32.
+        rtol (float): maximum relative error of the density of a feature
+            ('binned').
+
+    """
+    def __init__(self, kernel='gaussian', bandwidth=1.0, algorithm='exact',
+                 grid_size=None, rtol=1e-3):
         self._kernel = kernel
         self._bandwidth = bandwidth
+        self._algorithm = algorithm
+        self._grid_size = grid_size
+        self._rtol = rtol
         self._estimators = []
 
+        if algorithm not in ['exact', 'binned']:
+            raise ValueError('Invalid value for algorithm: %s' % algorithm)
+        if algorithm == 'binned' and kernel != 'gaussian':
+            raise ValueError('The binned algorithm needs a gaussian kernel')
+
     def fit(self, X):
         p = X.shape[1]
+        bandwidths = np.ones(p) * self._bandwidth
+        self._estimators = []
+        self._maximum = 0.0
         for feature in np.arange(p):
-            kd = KernelDensity(kernel=self._kernel, bandwidth=self._bandwidth)
-            kd.fit(X[:, feature].reshape(-1, 1))
+            if self._algorithm == 'binned':
+                kd = BinnedGaussianKDE(bandwidth=bandwidths[feature],
+                                       grid_size=self._grid_size,
+                                       rtol=self._rtol)
+                kd.fit(X[:, feature])
+                maximum = kd.maximum
+            else:
+                kd = KernelDensity(kernel=self._kernel,
+                                   bandwidth=bandwidths[feature])
+                kd.fit(X[:, feature].reshape(-1, 1))
+                maximum = kde_maximum(kd)
             self._estimators.append(kd)
+            # The features are independent, so the maximum is the sum of the
+            # maximums of every feature
+            self._maximum += maximum
 
     def score(self, X):
         p = len(self._estimators)
@@ -211,4 +746,962 @@ class MyMultivariateKernelDensity(object):
             scores[:, feature] = s
         return scores.sum(axis=1)
 
+    @property
+    def maximum(self):
+        return np.array([self._maximum])
+
+
+def kernel_herding(candidates, mean_embedding, bandwidth, n_representatives):
+    """Selects representatives of a distribution with kernel herding (Chen,
+    Welling and Smola, 2010).
+
+    At step t the candidate x that maximises t mu(x) - sum_{s < t} k(x, x_s)
+    is selected, where mu is the mean embedding of the distribution and
+    k(x, y) = exp(-||x - y||^2 / (2 bandwidth^2)). The maximum mean
+    discrepancy (MMD) between the distribution and the selected samples
+    decreases as O(1 / n_representatives) when the distribution is well
+    covered by the candidates (O(1 / sqrt(n_representatives)) in the worst
+    case).
+
+    Args:
+        candidates (array-like, shape = [n_candidates, n_features]): samples
+            that can be selected.
+        mean_embedding (array-like, shape = [n_candidates]): mean of the
+            kernel between every candidate and the distribution.
+        bandwidth (float): bandwidth of the kernel.
+        n_representatives (int): number of herding steps.
+
+    Returns:
+        (array-like, array-like): indices of the selected candidates and their
+        weights (the fraction of steps in which they were selected).
+    """
+    candidates = np.asarray(candidates, dtype=float)
+    sq_norms = (candidates**2).sum(axis=1)
+    kernel_sums = np.zeros(np.alen(candidates))
+    selected = np.empty(n_representatives, dtype=int)
+    for t in np.arange(n_representatives):
+        i = np.argmax((t + 1) * mean_embedding - kernel_sums)
+        selected[t] = i
+        sq_distances = np.maximum(sq_norms - 2 * np.dot(candidates,
+                                                        candidates[i]) +
+                                  sq_norms[i], 0)
+        kernel_sums += np.exp(-0.5 * sq_distances / bandwidth**2)
+    indices, counts = np.unique(selected, return_counts=True)
+    return indices, counts / n_representatives
+
+
+class MultivariateKernelDensity(object):
+    """Multivariate kernel density estimator with a bounded error.
+
+    The training samples are stored in a space-partitioning tree
+    (sklearn.neighbors.KernelDensity), and the contribution of the nodes
+    that are far enough from a query is approximated as a whole, within the
+    absolute and relative tolerances atol and rtol. This avoids scoring
+    every training sample, which makes the estimator usable on large
+    training sets.
+
+    If n_representatives is given (gaussian kernel only), the training
+    samples are replaced by at most n_representatives weighted samples
+    chosen with kernel_herding, so the cost of scoring does not depend on
+    the number of training samples. For every x, the density differs from
+    the density of all the training samples by at most
+    mmd / (2 pi bandwidth^2)^(d/2) (see density_error), where mmd is the
+    maximum mean discrepancy between the training samples and the
+    representatives.
+
+    Args:
+        kernel (string): kernel of sklearn.neighbors.KernelDensity.
+        bandwidth (float): bandwidth of the kernel.
+        atol (float): absolute tolerance of the density.
+        rtol (float): relative tolerance of the density.
+        algorithm (string): 'kd_tree', 'ball_tree' or 'auto'.
+        leaf_size (int): number of samples in the leaves of the tree.
+        breadth_first (bool): if True the tree is traversed breadth first,
+            which is usually faster with a tolerance and more accurate in
+            the tails.
+        n_representatives (int): number of kernel herding steps, or None
+            to keep all the training samples.
+        n_candidates (int): maximum number of training samples (chosen at
+            random) that can be selected as representatives.
+        random_state (int): seed used to choose the candidates.
+
+    Attributes:
+        maximum (array-like, shape = [1]): highest log-density of the
+            training samples, computed in fit (see kde_maximum), or of the
+            representatives.
+        mmd (float): estimated maximum mean discrepancy between the training
+            samples and the representatives.
+        density_error (float): bound of the absolute error of the density
+            due to the compression.
+
+    """
+    def __init__(self, kernel='gaussian', bandwidth=1.0, atol=0.0, rtol=1e-4,
+                 algorithm='auto', leaf_size=40, breadth_first=True,
+                 n_representatives=None, n_candidates=10000, random_state=0):
+        self._estimator = KernelDensity(kernel=kernel, bandwidth=bandwidth,
+                                        atol=atol, rtol=rtol,
+                                        algorithm=algorithm,
+                                        leaf_size=leaf_size,
+                                        breadth_first=breadth_first)
+        self._n_representatives = n_representatives
+        self._n_candidates = n_candidates
+        self._random_state = random_state
+        self._representatives = None
+        self._weights = None
+        self._maximum = 0.0
+        self.mmd = 0.0
+        self.density_error = 0.0
+
+        if n_representatives is not None and kernel != 'gaussian':
+            raise ValueError('The representatives need a gaussian kernel')
+
+    def fit(self, X):
+        self._estimator.fit(X)
+        self._representatives = None
+        self._weights = None
+        self.mmd = 0.0
+        self.density_error = 0.0
+        if self._n_representatives is None:
+            self._maximum = kde_maximum(self._estimator)
+            return
+        X = np.asarray(X, dtype=float)
+        n, d = X.shape
+        h = self._estimator.bandwidth
+        if n > self._n_candidates:
+            candidates = X[np.random.RandomState(self._random_state).choice(
+                n, self._n_candidates, replace=False)]
+        else:
+            candidates = X
+        # The kernel of the density is k(x, y) / (2 pi h^2)^(d/2)
+        log_norm = 0.5 * d * np.log(2 * np.pi * h**2)
+        mean_embedding = np.exp(self._estimator.score_samples(candidates) +
+                                log_norm)
+        indices, self._weights = kernel_herding(candidates, mean_embedding, h,
+                                                self._n_representatives)
+        self._representatives = candidates[indices]
+
+        # Squared MMD, the squared norm of the mean embedding of the training
+        # samples being estimated from the candidates
+        kernel = np.exp(self._log_kernel(self._representatives))
+        mmd2 = (mean_embedding.mean() -
+                2 * np.dot(self._weights, mean_embedding[indices]) +
+                np.dot(self._weights, np.dot(kernel, self._weights)))
+        self.mmd = np.sqrt(max(mmd2, 0.0))
+        self.density_error = self.mmd * np.exp(-log_norm)
+        self._maximum = self.score_samples(self._representatives).max()
+
+    def _log_kernel(self, X):
+        h = self._estimator.bandwidth
+        r = self._representatives
+        sq_distances = ((X**2).sum(axis=1).reshape(-1, 1) -
+                        2 * np.dot(X, r.T) + (r**2).sum(axis=1))
+        return -0.5 * np.maximum(sq_distances, 0) / h**2
+
+    def score_samples(self, X, batch_size=1024):
+        """Log-density of every row of X."""
+        if self._representatives is None:
+            return self._estimator.score_samples(X)
+        X = np.asarray(X, dtype=float)
+        d = self._representatives.shape[1]
+        log_weights = np.log(self._weights)
+        scores = np.empty(np.alen(X))
+        for start in np.arange(0, np.alen(X), batch_size):
+            end = min(start + batch_size, np.alen(X))
+            log_kernel = self._log_kernel(X[start:end]) + log_weights
+            max_log_kernel = log_kernel.max(axis=1)
+            scores[start:end] = max_log_kernel + np.log(np.exp(
+                log_kernel - max_log_kernel.reshape(-1, 1)).sum(axis=1))
+        return scores - 0.5 * d * np.log(2 * np.pi *
+                                         self._estimator.bandwidth**2)
+
+    def score(self, X):
+        return np.exp(self.score_samples(X))
+
+    @property
+    def maximum(self):
+        return np.array([self._maximum])
+
+
+class KNNDensity(object):
+    """k-nearest-neighbour density estimator.
+
+    The density at x is k / (n V_d r_k(x)^d), where r_k(x) is the distance
+    from x to its k-th nearest training sample and V_d the volume of the
+    unit ball in d dimensions, so the estimate follows any number of modes
+    of any shape. The training samples are stored in a space-partitioning
+    tree built once in fit, which finds the neighbours in sub-linear time.
+    The tree is kept when the estimator is pickled or exported with
+    save_model, so it is not built again when it is loaded.
+
+    Args:
+        n_neighbors (int): k, number of neighbours.
+        algorithm (string): 'kd_tree' or 'ball_tree'.
+        leaf_size (int): number of samples in the leaves of the tree.
+        batch_size (int): number of samples queried at a time.
+        min_distance (float): lower bound of r_k(x), which keeps the density
+            finite on repeated training samples.
+
+    Attributes:
+        maximum (array-like, shape = [1]): highest log-density of the
+            training samples, computed in fit leaving every sample out of
+            its own neighbours (otherwise it would be its own nearest
+            neighbour, at distance 0).
+
+    """
+    def __init__(self, n_neighbors=10, algorithm='kd_tree', leaf_size=40,
+                 batch_size=1024, min_distance=1e-10):
+        self.n_neighbors = n_neighbors
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+        self.min_distance = min_distance
+
+        if algorithm not in ['kd_tree', 'ball_tree']:
+            raise ValueError('Invalid value for algorithm: %s' % algorithm)
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=float)
+        n, d = X.shape
+        if self.algorithm == 'kd_tree':
+            self.tree_ = KDTree(X, leaf_size=self.leaf_size)
+        else:
+            self.tree_ = BallTree(X, leaf_size=self.leaf_size)
+        self._k = min(self.n_neighbors, n)
+        log_ball_volume = 0.5 * d * np.log(np.pi) - gammaln(0.5 * d + 1)
+        self._log_norm_const = np.log(self._k) - np.log(n) - log_ball_volume
+        # The first neighbour of every training sample is itself
+        distances = self.kneighbors_distance(X, k=min(self._k + 1, n))
+        self._maximum = self._log_density(distances).max()
+        return self
+
+    def kneighbors_distance(self, X, k=None):
+        """Distance from every row of X to its k-th nearest training
+        sample (n_neighbors-th if k is None)."""
+        if k is None:
+            k = self._k
+        X = np.asarray(X, dtype=float)
+        n = np.alen(X)
+        distances = np.empty(n)
+        for start in np.arange(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            distances[start:end] = self.tree_.query(
+                X[start:end], k=k, return_distance=True)[0][:, -1]
+        return distances
+
+    def _log_density(self, distances):
+        d = self.tree_.data.shape[1]
+        distances = np.maximum(distances, self.min_distance)
+        return self._log_norm_const - d * np.log(distances)
+
+    def score_samples(self, X):
+        """Log-density of every row of X."""
+        return self._log_density(self.kneighbors_distance(X))
+
+    def score(self, X):
+        return np.exp(self.score_samples(X))
+
+    @property
+    def maximum(self):
+        return np.array([self._maximum])
+
+
+class ApproximateOneClassSVM(object):
+    """One-class SVM with an approximated Gaussian kernel.
+
+    The samples are mapped to n_components features whose inner products
+    approximate the kernel exp(-gamma |x - y|^2), with the Nystroem method
+    or with random Fourier features (Rahimi and Recht, 2007), and the primal
+    linear one-class SVM objective (Schoelkopf et al., 2001)
+
+        1/2 |w|^2 - rho + 1 / nu * mean(max(0, rho - w phi(x)))
+
+    is minimised by averaged minibatch stochastic gradient descent, with
+    step sizes 1 / t (the objective is strongly convex in w). rho is then
+    set to its optimal value for the final w, the nu-quantile of the scores
+    w phi(x) of the training samples. Fitting costs
+    O(n_samples n_components n_features n_epochs) and the decision function
+    O(n_components n_features) per sample, whatever the number of training
+    samples, unlike sklearn.svm.OneClassSVM.
+
+    Args:
+        nu (float): upper bound of the fraction of training samples outside
+            of the estimated support.
+        gamma (float): parameter of the Gaussian kernel. If None it is
+            1 / n_features.
+        kernel_approximation (string): 'nystroem' or 'fourier'.
+        n_components (int): number of features of the approximated kernel.
+        n_epochs (int): number of passes over the training samples.
+        batch_size (int): number of samples per gradient step.
+        max_features (int): the features of the training samples are kept in
+            memory between epochs if there are at most max_features values.
+        random_state (int): seed of the feature map and of the order of the
+            samples.
+
+    Attributes:
+        coef_ (array-like, shape = [n_components]): w.
+        offset_ (float): rho.
+
+    """
+    def __init__(self, nu=0.5, gamma=None, kernel_approximation='nystroem',
+                 n_components=100, n_epochs=10, batch_size=256,
+                 max_features=2**24, random_state=0):
+        self.nu = nu
+        self.gamma = gamma
+        self.kernel_approximation = kernel_approximation
+        self.n_components = n_components
+        self.n_epochs = n_epochs
+        self.batch_size = batch_size
+        self.max_features = max_features
+        self.random_state = random_state
+
+        if kernel_approximation not in ['nystroem', 'fourier']:
+            raise ValueError('Invalid value for kernel_approximation: %s' %
+                             kernel_approximation)
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=float)
+        n, d = X.shape
+        gamma = self.gamma
+        if gamma is None:
+            gamma = 1.0 / d
+        random_state = np.random.RandomState(self.random_state)
+        if self.kernel_approximation == 'nystroem':
+            self.feature_map_ = Nystroem(
+                gamma=gamma, n_components=min(self.n_components, n),
+                random_state=self.random_state)
+        else:
+            self.feature_map_ = RBFSampler(
+                gamma=gamma, n_components=self.n_components,
+                random_state=self.random_state)
+        self.feature_map_.fit(X)
+
+        # The features are computed once if they fit in max_features
+        # values, and for every minibatch otherwise
+        n_features = self.feature_map_.transform(X[:1]).shape[1]
+        if n * n_features <= self.max_features:
+            features = self._transform(X)
+        else:
+            features = None
+
+        w = np.zeros(n_features)
+        rho = 0.0
+        w_mean = np.zeros_like(w)
+        rho_mean = 0.0
+        t = 0
+        n_averaged = 0
+        for epoch in np.arange(self.n_epochs):
+            order = random_state.permutation(n)
+            for start in np.arange(0, n, self.batch_size):
+                batch = order[start:start + self.batch_size]
+                if features is None:
+                    phi = self.feature_map_.transform(X[batch])
+                else:
+                    phi = features[batch]
+                active = np.dot(phi, w) < rho
+                t += 1
+                step = 1.0 / t
+                # The hinge loss of the samples inside the margin pulls w
+                # towards their features
+                w *= 1.0 - step
+                w += step / self.nu * phi[active].sum(axis=0) / len(phi)
+                rho -= step * (active.mean() / self.nu - 1.0)
+                # The iterates of the first epoch are not averaged
+                if epoch > 0 or self.n_epochs == 1:
+                    n_averaged += 1
+                    w_mean += (w - w_mean) / n_averaged
+                    rho_mean += (rho - rho_mean) / n_averaged
+        # For a given w the optimal rho is the nu-quantile of w phi(x), which
+        # the steps 1 / t approach very slowly
+        self.coef_ = w_mean
+        if features is None:
+            scores = self.decision_function(X, offset=0.0)
+        else:
+            scores = np.dot(features, w_mean)
+        self.offset_ = np.percentile(scores, 100 * self.nu)
+        return self
+
+    def _transform(self, X, batch_size=4096):
+        n = np.alen(X)
+        features = None
+        for start in np.arange(0, n, batch_size):
+            end = min(start + batch_size, n)
+            phi = self.feature_map_.transform(X[start:end])
+            if features is None:
+                features = np.empty((n, phi.shape[1]))
+            features[start:end] = phi
+        return features
+
+    def decision_function(self, X, batch_size=4096, offset=None):
+        """Signed distance of every row of X to the boundary of the
+        estimated support (positive inside)."""
+        if offset is None:
+            offset = self.offset_
+        X = np.asarray(X, dtype=float)
+        n = np.alen(X)
+        scores = np.empty(n)
+        for start in np.arange(0, n, batch_size):
+            end = min(start + batch_size, n)
+            scores[start:end] = np.dot(
+                self.feature_map_.transform(X[start:end]), self.coef_)
+        return scores - offset
+
+    def predict(self, X):
+        return np.where(self.decision_function(X) >= 0, 1, -1)
+
+
+class SelectionCache(dict):
+    """Configurations chosen by GaussianMixtureSelection, shared by all the
+    copies of the estimators (e.g. the estimators of every class made by
+    OcDecomposition), as copying the cache returns the same cache."""
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def fit_covariance_type(args):
+    """Fits Gaussian mixtures with one covariance type and an increasing
+    number of components, every mixture being initialised from the previous
+    one (see GaussianMixtureSelection).
+
+    Args:
+        args (tuple): covariance type, list of numbers of components,
+            training samples, validation samples (or None to use the BIC),
+            initial parameters of the first mixture (or None), and keyword
+            arguments of sklearn.mixture.GaussianMixture.
+
+    Returns:
+        (list of tuple): criterion (lower is better) and fitted mixture for
+        every number of components.
+    """
+    # GaussianMixture only exists next to GMM in some versions of sklearn,
+    # so it is only imported when the mixtures are selected
+    from sklearn.mixture import GaussianMixture
+    covariance_type, n_components_list, X, X_valid, init, kwargs = args
+    results = []
+    previous = None
+    for n_components in n_components_list:
+        if previous is not None:
+            init = grow_gaussian_mixture(previous, X, n_components)
+        gmm = GaussianMixture(n_components=n_components,
+                              covariance_type=covariance_type, **kwargs)
+        if init is not None and len(init['weights']) == n_components:
+            gmm.weights_init = init['weights']
+            gmm.means_init = init['means']
+            gmm.precisions_init = init['precisions']
+        gmm.fit(X)
+        if X_valid is None:
+            criterion = gmm.bic(X)
+        else:
+            criterion = -gmm.score(X_valid)
+        results.append((criterion, gmm))
+        previous = gmm
+    return results
+
+
+def gaussian_mixture_parameters(gmm):
+    """Parameters of a fitted GaussianMixture, used to initialise another
+    one."""
+    return {'weights': gmm.weights_, 'means': gmm.means_,
+            'precisions': gmm.precisions_}
+
+
+def grow_gaussian_mixture(gmm, X, n_components):
+    """Initial parameters of a mixture with more components, from a fitted
+    mixture.
+
+    Every new component is centred on the sample of X with the lowest
+    likelihood that has not been used yet, with the mean precision of the
+    previous components and the same weight as the others.
+    """
+    params = gaussian_mixture_parameters(gmm)
+    n_new = n_components - gmm.n_components
+    worst = np.argsort(gmm.score_samples(X))[:n_new]
+    weights = np.hstack([params['weights'] * gmm.n_components,
+                         np.ones(n_new)]) / n_components
+    means = np.vstack([params['means'], X[worst]])
+    precisions = params['precisions']
+    if gmm.covariance_type != 'tied':
+        new = np.repeat(precisions.mean(axis=0)[np.newaxis], n_new, axis=0)
+        precisions = np.concatenate([precisions, new])
+    return {'weights': weights, 'means': means, 'precisions': precisions}
+
+
+class GaussianMixtureSelection(object):
+    """Gaussian mixture with the number of components and the covariance
+    type chosen by the BIC or by the likelihood of held-out samples.
+
+    The covariance types are searched in parallel processes. For every
+    covariance type the numbers of components are fitted in increasing
+    order, every mixture being initialised from the previous one (see
+    grow_gaussian_mixture) instead of with k-means.
+
+    If a cache is given, the chosen configuration and parameters are stored
+    in it under (key, label), where label is set by OcDecomposition to the
+    index of the class. When the estimator is fitted again with the same
+    key and label (e.g. in the next fold of a cross-validation), only the
+    cached configuration is fitted, initialised from the cached parameters.
+
+    Args:
+        n_components (list of int): numbers of components.
+        covariance_types (list of string): covariance types of
+            sklearn.mixture.GaussianMixture.
+        criterion (string): 'bic' or 'held_out'.
+        validation_fraction (float): fraction of the samples held out
+            ('held_out').
+        n_jobs (int): number of processes (-1 uses one process per CPU).
+        cache (SelectionCache): chosen configurations.
+        key (object): key of the dataset in the cache.
+        random_state (int): seed of the held-out samples and of the
+            mixtures.
+        max_iter (int): maximum number of EM iterations.
+
+    Attributes:
+        best_estimator_ (sklearn.mixture.GaussianMixture): chosen mixture,
+            fitted to all the samples.
+        label (object): label of the class in the cache.
+
+    """
+    def __init__(self, n_components=(1, 2, 3, 4, 5),
+                 covariance_types=('full', 'tied', 'diag', 'spherical'),
+                 criterion='bic', validation_fraction=0.25, n_jobs=None,
+                 cache=None, key=None, random_state=0, max_iter=100):
+        self.n_components = n_components
+        self.covariance_types = covariance_types
+        self.criterion = criterion
+        self.validation_fraction = validation_fraction
+        self.n_jobs = n_jobs
+        self.cache = cache
+        self.key = key
+        self.random_state = random_state
+        self.max_iter = max_iter
+        self.label = None
+
+        if criterion not in ['bic', 'held_out']:
+            raise ValueError('Invalid value for criterion: %s' % criterion)
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=float)
+        kwargs = {'max_iter': self.max_iter,
+                  'random_state': self.random_state}
+        cache_key = (self.key, self.label)
+        if self.cache is not None and cache_key in self.cache:
+            cached = self.cache[cache_key]
+            init = cached['init']
+            if np.shape(init['means'])[1] != X.shape[1]:
+                init = None
+            _, gmm = fit_covariance_type((cached['covariance_type'],
+                                          [cached['n_components']], X, None,
+                                          init, kwargs))[0]
+        else:
+            gmm = self._search(X, kwargs)
+        self.best_estimator_ = gmm
+        if self.cache is not None:
+            self.cache[cache_key] = {
+                'n_components': gmm.n_components,
+                'covariance_type': gmm.covariance_type,
+                'init': gaussian_mixture_parameters(gmm)}
+        self._maximum = gmm_maximum(gmm)
+        return self
+
+    def _search(self, X, kwargs):
+        n = np.alen(X)
+        n_components = [k for k in sorted(self.n_components) if k <= n]
+        if self.criterion == 'held_out':
+            order = np.random.RandomState(self.random_state).permutation(n)
+            n_valid = int(np.ceil(self.validation_fraction * n))
+            X_train, X_valid = X[order[n_valid:]], X[order[:n_valid]]
+            n_components = [k for k in n_components if k <= len(X_train)]
+        else:
+            X_train, X_valid = X, None
+        tasks = [(covariance_type, n_components, X_train, X_valid, None,
+                  kwargs) for covariance_type in self.covariance_types]
+        n_jobs = min(effective_n_jobs(self.n_jobs), len(tasks))
+        if n_jobs == 1:
+            results = map(fit_covariance_type, tasks)
+        else:
+            pool = Pool(n_jobs)
+            try:
+                results = pool.map(fit_covariance_type, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        criterion, gmm = min(sum(results, []), key=lambda result: result[0])
+        if X_valid is not None:
+            # The chosen mixture is fitted again to all the samples
+            _, gmm = fit_covariance_type((
+                gmm.covariance_type, [gmm.n_components], X, None,
+                gaussian_mixture_parameters(gmm), kwargs))[0]
+        return gmm
+
+    def score_samples(self, X):
+        return self.best_estimator_.score_samples(X)
+
+    def score(self, X):
+        return np.exp(self.score_samples(X))
+
+    @property
+    def maximum(self):
+        return np.array([self._maximum])
+
+
+class ClassKernelDensity(object):
+    """Gaussian kernel density estimates of every class, from a single index
+    of all the training samples.
+
+    The samples of all the classes are stored in one space-partitioning
+    tree with their labels, so one radius query per test sample gives the
+    densities of all the classes. The kernel is truncated at cutoff
+    bandwidths; every neglected training sample contributes less than
+    exp(-cutoff^2 / 2) to the sum of kernels of its class. The classes for
+    which this could be more than rtol times the sum (e.g. for samples far
+    from the training samples) are computed from a tree of the samples of
+    the class: only the samples whose kernel is at least rtol / n_class
+    times the one of the nearest sample are added, so the relative error is
+    still at most rtol and far samples only add the few training samples
+    of a thin shell instead of all the samples of the class.
+
+    Args:
+        bandwidth (float): standard deviation of the kernel.
+        cutoff (float): radius of the queries, in bandwidths.
+        rtol (float): maximum relative error of the densities.
+        algorithm (string): 'kd_tree' or 'ball_tree'.
+        leaf_size (int): number of samples in the leaves of the tree.
+        batch_size (int): number of samples queried at a time.
+
+    Attributes:
+        classes (array-like, shape = [n_classes]): labels of the classes.
+        maximum (array-like, shape = [n_classes]): highest log-density of
+            the training samples of every class (on at most 1000 samples per
+            class, see kde_maximum).
+
+    """
+    def __init__(self, bandwidth=1.0, cutoff=6.0, rtol=1e-3,
+                 algorithm='kd_tree', leaf_size=40, batch_size=1024):
+        self.bandwidth = bandwidth
+        self.cutoff = cutoff
+        self.rtol = rtol
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+
+        if algorithm not in ['kd_tree', 'ball_tree']:
+            raise ValueError('Invalid value for algorithm: %s' % algorithm)
+
+    def fit(self, X, y):
+        self._data = np.asarray(X, dtype=float)
+        self.classes, self._labels = np.unique(y, return_inverse=True)
+        self._counts = np.bincount(self._labels)
+        tree_class = KDTree if self.algorithm == 'kd_tree' else BallTree
+        self._tree = tree_class(self._data, leaf_size=self.leaf_size)
+        self._class_trees = [
+            tree_class(self._data[self._labels == label],
+                       leaf_size=self.leaf_size)
+            for label in np.arange(len(self.classes))]
+
+        random_state = np.random.RandomState(0)
+        self.maximum = np.zeros(len(self.classes))
+        for label in np.arange(len(self.classes)):
+            indices = np.where(self._labels == label)[0]
+            if len(indices) > 1000:
+                indices = random_state.choice(indices, 1000, replace=False)
+            self.maximum[label] = self.score_classes(self._data[indices],
+                                                     [label]).max()
+
+    def score_classes(self, X, labels=None):
+        """Log-density of every class for every row of X.
+
+        Args:
+            X (array-like, shape = [n_samples, n_features]): samples.
+            labels (array-like, shape = [n_labels]): if given, only the
+                log-densities of the classes with these indices are
+                returned.
+
+        Returns:
+            (array-like, shape = [n_samples, n_classes]): log-densities.
+
+        """
+        X = np.asarray(X, dtype=float)
+        n = np.alen(X)
+        n_classes = len(self.classes)
+        if labels is None:
+            labels = np.arange(n_classes)
+        labels = np.asarray(labels)
+        h = self.bandwidth
+        sums = np.zeros((n, n_classes))
+        for start in np.arange(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            indices, distances = self._tree.query_radius(
+                X[start:end], r=self.cutoff * h, return_distance=True)
+            rows = np.repeat(np.arange(end - start),
+                             [len(i) for i in indices])
+            if len(rows) == 0:
+                continue
+            cells = rows * n_classes + self._labels[np.hstack(indices)]
+            weights = np.exp(-0.5 * (np.hstack(distances) / h)**2)
+            sums[start:end] = np.bincount(
+                cells, weights=weights,
+                minlength=(end - start) * n_classes).reshape(-1, n_classes)
+
+        sums = sums[:, labels]
+        counts = self._counts[labels]
+        neglected = counts * np.exp(-0.5 * self.cutoff**2)
+        exact = sums * self.rtol < neglected
+        log_sums = np.log(np.where(exact, 1.0, sums))
+        for i in np.where(exact.any(axis=0))[0]:
+            rows = np.where(exact[:, i])[0]
+            log_sums[rows, i] = self._log_sum_kernels(X[rows], labels[i])
+
+        d = self._data.shape[1]
+        return (log_sums - np.log(counts) - d * np.log(h) -
+                0.5 * d * np.log(2 * np.pi))
+
+    def _log_sum_kernels(self, X, label):
+        """Log of the sum of the kernels of the samples of a class at every
+        row of X, with a relative error of at most rtol.
+
+        The samples whose kernel is less than rtol / n_class times the
+        kernel of the nearest sample are left out, and the other ones are
+        found with one radius query per row on the tree of the class.
+        """
+        tree = self._class_trees[label]
+        h = self.bandwidth
+        min_sq_distances = tree.query(X, k=1)[0][:, 0]**2
+        radius = np.sqrt(min_sq_distances + 2 * h**2 *
+                         np.log(self._counts[label] / self.rtol))
+        scores = np.empty(np.alen(X))
+        for start in np.arange(0, np.alen(X), self.batch_size):
+            end = min(start + self.batch_size, np.alen(X))
+            distances = tree.query_radius(X[start:end], r=radius[start:end],
+                                          return_distance=True)[1]
+            rows = np.repeat(np.arange(end - start),
+                             [len(d) for d in distances])
+            # The kernels are shifted by the one of the nearest sample
+            kernel = np.exp(-0.5 / h**2 * (np.hstack(distances)**2 -
+                                           min_sq_distances[start:end][rows]))
+            scores[start:end] = (np.log(np.bincount(rows, weights=kernel,
+                                                    minlength=end - start)) -
+                                 0.5 / h**2 * min_sq_distances[start:end])
+        return scores
+
+
+class StackedMultivariateNormal(object):
+    """Multivariate normal density estimates of every class, scored
+    together.
+
+    The means of all the classes are kept in one array of shape
+    [n_classes, n_features], and their standard deviations (covariance_type
+    'diag') or lower Cholesky factors ('full') in one array of shape
+    [n_classes, n_features] or [n_classes, n_features, n_features]. Every
+    block of samples is scored for all the classes into one array of shape
+    [n_samples, n_classes]: with 'diag' the squared Mahalanobis distances
+    to all the classes are two matrix products, and with 'full' every class
+    needs one triangular solve of the whole block (the same number of
+    operations as a single matrix product with the inverse factors of all
+    the classes side by side, but half the flops as the factors are
+    triangular).
+
+    Every class is estimated as in MyMultivariateNormal (the covariance is
+    normalised by the number of samples and its zeros are replaced by
+    min_covar). If the covariance of a class is singular, its factor is a
+    whitening matrix of the non-null eigenvectors, and the pseudo
+    determinant is used.
+
+    Args:
+        covariance_type (string): 'full' or 'diag'.
+        min_covar (float): value used to replace the zeros of the covariance
+            matrices.
+        batch_size (int): number of rows scored at a time.
+
+    Attributes:
+        classes (array-like, shape = [n_classes]): labels of the classes.
+        means_ (array-like, shape = [n_classes, n_features]): means.
+        covars_ (array-like, shape = [n_classes, n_features(, n_features)]):
+            covariance matrices, or their diagonals with 'diag'.
+        maximum (array-like, shape = [n_classes]): log-density of every
+            class at its mean.
+        densities (bool): True, the score method of MyMultivariateNormal
+            gives densities, so the density of every class is used where
+            MyMultivariateNormal would use its score (see ClassDensity).
+
+    """
+    densities = True
+
+    def __init__(self, covariance_type='diag', min_covar=1e-10,
+                 batch_size=4096):
+        self.covariance_type = covariance_type
+        self.min_covar = min_covar
+        self.batch_size = batch_size
+
+        if covariance_type not in ['full', 'diag',]:
+            raise ValueError('Invalid value for covariance_type: %s' %
+                             covariance_type)
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=float)
+        self.classes, labels = np.unique(y, return_inverse=True)
+        n_classes = len(self.classes)
+        d = X.shape[1]
+        diagonal = self.covariance_type == 'diag'
+        self.means_ = np.zeros((n_classes, d))
+        self.covars_ = np.zeros((n_classes, d) if diagonal else
+                                (n_classes, d, d))
+        for label in np.arange(n_classes):
+            n, mean, scatter = update_moments(0, None, None,
+                                              X[labels == label],
+                                              diagonal=diagonal)
+            cov = scatter / n # bias=1 (N)
+            cov[cov == 0] = self.min_covar
+            self.means_[label] = mean
+            self.covars_[label] = cov
+        self._compute_factors()
+        return self
+
+    def _compute_factors(self):
+        """Factorises the covariance matrices and computes the log
+        normalisation constants (see MyMultivariateNormal._compute_factor).
+        """
+        n_classes, d = self.means_.shape
+        if self.covariance_type == 'diag':
+            self._precisions = 1.0 / self.covars_
+            # The samples are centred on the mean of the classes, which
+            # reduces the cancellations of the expanded squares
+            self._centre = self.means_.mean(axis=0)
+            centred_means = self.means_ - self._centre
+            self._precision_means = self._precisions * centred_means
+            self._mean_norms = (self._precision_means *
+                                centred_means).sum(axis=1)
+            log_dets = np.log(self.covars_).sum(axis=1)
+            ranks = np.ones(n_classes) * d
+        else:
+            self._factors = np.zeros((n_classes, d, d))
+            self._singular = np.zeros(n_classes, dtype=bool)
+            log_dets = np.zeros(n_classes)
+            ranks = np.ones(n_classes) * d
+            for label, cov in enumerate(self.covars_):
+                try:
+                    chol = np.linalg.cholesky(cov)
+                    self._factors[label] = chol
+                    log_dets[label] = 2.0 * np.log(np.diag(chol)).sum()
+                except np.linalg.LinAlgError:
+                    # If the covariance matrix is singular
+                    eigvals, eigvecs = np.linalg.eigh(cov)
+                    tol = eigvals.max() * d * np.finfo(float).eps
+                    nonnull = eigvals > tol
+                    self._factors[label][:, :nonnull.sum()] = (
+                        eigvecs[:, nonnull] / np.sqrt(eigvals[nonnull]))
+                    self._singular[label] = True
+                    log_dets[label] = np.log(eigvals[nonnull]).sum()
+                    ranks[label] = nonnull.sum()
+        self.maximum = -0.5 * (ranks * np.log(2 * np.pi) + log_dets)
+
+    def mahalanobis(self, X, labels=None):
+        """Squared Mahalanobis distances from every row of X to the mean of
+        every class (or of the classes with indices labels), shape =
+        [n_samples, n_classes]."""
+        X = np.asarray(X, dtype=float)
+        if labels is None:
+            labels = np.arange(len(self.classes))
+        labels = np.atleast_1d(labels)
+        n = np.alen(X)
+        distances = np.empty((n, len(labels)))
+        if self.covariance_type == 'diag':
+            precisions = self._precisions[labels]
+            precision_means = self._precision_means[labels]
+            mean_norms = self._mean_norms[labels]
+        for start in np.arange(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            if self.covariance_type == 'diag':
+                x = X[start:end] - self._centre
+                block = np.dot(x**2, precisions.T)
+                block -= 2 * np.dot(x, precision_means.T)
+                block += mean_norms
+                distances[start:end] = block
+                continue
+            for i, label in enumerate(labels):
+                x_mu = np.subtract(X[start:end], self.means_[label])
+                if self._singular[label]:
+                    x_mu = np.dot(x_mu, self._factors[label])
+                else:
+                    x_mu = solve_triangular(self._factors[label], x_mu.T,
+                                            lower=True,
+                                            check_finite=False).T
+                distances[start:end, i] = np.einsum('ij,ij->i', x_mu, x_mu)
+        return np.maximum(distances, 0, out=distances)
+
+    def score_classes(self, X, labels=None):
+        """Log-density of every class for every row of X.
+
+        Args:
+            X (array-like, shape = [n_samples, n_features]): samples.
+            labels (array-like, shape = [n_labels]): if given, only the
+                log-densities of the classes with these indices are
+                returned.
+
+        Returns:
+            (array-like, shape = [n_samples, n_classes]): log-densities.
+
+        """
+        if labels is None:
+            labels = np.arange(len(self.classes))
+        labels = np.atleast_1d(labels)
+        distances = self.mahalanobis(X, labels)
+        distances *= -0.5
+        distances += self.maximum[labels]
+        return distances
+
+
+class ClassDensity(object):
+    """Density of one class of a class-aware estimator (e.g.
+    ClassKernelDensity), which can be used as the estimator of a
+    BackgroundCheck.
+
+    Args:
+        estimator (object): fitted estimator with a score_classes method.
+        index (int): index of the class.
+
+    """
+    def __init__(self, estimator, index):
+        self.estimator = estimator
+        self.index = index
+
+    def fit(self, X):
+        """The class-aware estimator is fitted to all the classes at once."""
+        pass
+
+    def score_samples(self, X):
+        return self.estimator.score_classes(X, [self.index])[:, 0]
+
+    def score(self, X):
+        """Density of the class if the estimator has a densities attribute
+        set to True (e.g. StackedMultivariateNormal, as the score method of
+        MyMultivariateNormal), otherwise its log-density."""
+        scores = self.score_samples(X)
+        if getattr(self.estimator, 'densities', False):
+            return np.exp(scores)
+        return scores
+
+    @property
+    def maximum(self):
+        return np.array([self.estimator.maximum[self.index]])
+
+
+def test():
+    from sklearn import datasets
 
+    dataset = datasets.load_iris()
+    X, y = dataset.data.copy(), dataset.target
+    # The covariance matrix of the last class is singular
+    X[y == 2, 3] = X[y == 2, 0]
+    X_test = np.vstack((X, np.random.RandomState(0).uniform(0, 8, (50, 4))))
+    for covariance_type in ['diag', 'full']:
+        stacked = StackedMultivariateNormal(covariance_type=covariance_type)
+        stacked.fit(X, y)
+        scores = np.zeros((np.alen(X_test), len(stacked.classes)))
+        for label in stacked.classes:
+            estimator = MyMultivariateNormal(covariance_type=covariance_type)
+            estimator.fit(X[y == label])
+            scores[:, label] = estimator.score_samples(X_test)
+        print "StackedMultivariateNormal {}".format(covariance_type)
+        print np.allclose(stacked.score_classes(X_test), scores)
@@ -11,6 +11,7 @@ from scipy.optimize import minimize
 
 from ovo_classifier import OvoClassifier
 from confident_classifier import ConfidentClassifier
+from batches import predict_by_batches
 
 
 class Ensemble(object):
@@ -140,18 +141,39 @@ class Ensemble(object):
             votes[range(n), pred] += conf * self._weights[c_index]
         return votes.argmax(axis=1)
 
-    def predict_proba(self, X):
-        n = np.alen(X)
-        for c_index, c in enumerate(self._classifiers):
-            res = get_predictions(c, X)
-            pred = res[0]
-            conf = res[1]
-            if c_index == 0:
-                votes = np.zeros((n, c.n_classes))
-            votes[range(n), pred] += conf * self._weights[c_index]
-        proba = votes/votes.sum(axis=1).reshape(-1,1)
-        proba[np.isnan(proba)] = 1/proba.shape[1]
-        return proba
+    def predict_proba(self, X, batch_size=None, out=None):
+        """Weighted votes of the ensemble normalised to probabilities.
+
+        Args:
+            X (array-like, shape = [n_samples, n_features]): test data. Any
+                object that can be sliced by rows can be used (e.g. a
+                numpy.memmap).
+            batch_size (int): if given, X is processed in blocks of
+                batch_size rows, which bounds the memory used.
+            out (array-like, shape = [n_samples, n_classes]): if given, the
+                probabilities are written in this array.
+
+        Returns:
+            proba (array-like, shape = [n_samples, n_classes]).
+
+        """
+        def predict_block(x, proba):
+            n = np.alen(x)
+            if proba is None:
+                proba = np.zeros((n, self._classifiers[0].n_classes))
+            else:
+                proba[:] = 0.0
+            for c_index, c in enumerate(self._classifiers):
+                res = get_predictions(c, x)
+                pred = res[0]
+                conf = res[1]
+                proba[range(n), pred] += conf * self._weights[c_index]
+            proba /= proba.sum(axis=1).reshape(-1, 1)
+            proba[np.isnan(proba)] = 1/proba.shape[1]
+            return proba
+
+        return predict_by_batches(predict_block, X, batch_size=batch_size,
+                                  out=out)
 
     def accuracy(self, X, y):
         predictions = self.predict(X)
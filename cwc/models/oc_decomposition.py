@@ -7,27 +7,83 @@ import copy
 from scipy.stats import norm
 
 from background_check import BackgroundCheck
+from batches import predict_by_batches
+from scoring import EstimatorScorer
 
 
 class OcDecomposition(object):
+    """One-class decomposition of a classification problem.
+
+    Args:
+        base_estimator (object): estimator copied for every class, a
+            BackgroundCheck or a density estimator. If the density estimator
+            (of the BackgroundCheck) has a score_classes method (e.g.
+            ClassKernelDensity or StackedMultivariateNormal) it is fitted
+            once to all the classes, and the densities of all the classes
+            are computed together.
+        normalization (string): 'O-norm' or 'T-norm', for density
+            estimators.
+        score_method (string): name of the method of the density estimators
+            whose scores are exponentiated (see EstimatorScorer). If None it
+            is found when they are fitted (score if it gives a score per
+            sample), 'score_samples' uses their log-densities.
+
+    """
     def __init__(self, base_estimator=BackgroundCheck(),
-                 normalization=None):
+                 normalization=None, score_method=None):
         self._base_estimator = base_estimator
         self._estimators = []
         self._thresholds = []
         self._normalization = normalization
         self._priors = []
         self._means = []
+        self._scorers = []
+        self._class_estimator = None
+        self._score_method = score_method
+
+    def __setstate__(self, state):
+        """Restores a pickled OcDecomposition, filling the attributes that
+        did not exist when it was pickled (the scorers are created the first
+        time X is scored)."""
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_scorers', None)
+        self.__dict__.setdefault('_class_estimator', None)
+        self.__dict__.setdefault('_score_method', None)
 
     def fit(self, X, y, threshold_percentile=10, mus=None, ms=None):
         classes = np.unique(y)
         n_classes = np.alen(classes)
         class_count = np.bincount(y)
         self._priors = class_count / np.alen(y)
+        if type(self._base_estimator) is BackgroundCheck:
+            density_estimator = self._base_estimator._estimator
+        else:
+            density_estimator = self._base_estimator
+        if hasattr(density_estimator, 'score_classes'):
+            self._class_estimator = copy.deepcopy(density_estimator)
+            self._class_estimator.fit(X, y)
+        else:
+            self._class_estimator = None
         for c_index in np.arange(n_classes):
-            c = copy.deepcopy(self._base_estimator)
-            c.fit(X[y == c_index])
+            if self._class_estimator is None:
+                c = copy.deepcopy(self._base_estimator)
+                # GaussianMixtureSelection caches its configuration per class,
+                # so it is told which class it fits
+                if type(c) is BackgroundCheck:
+                    set_label(c._estimator, c_index)
+                else:
+                    set_label(c, c_index)
+                c.fit(X[y == c_index])
+            elif type(self._base_estimator) is BackgroundCheck:
+                from density_estimators import ClassDensity
+                c = copy.deepcopy(self._base_estimator)
+                c.set_estimator(ClassDensity(self._class_estimator, c_index),
+                                X[y == c_index])
+            else:
+                from density_estimators import ClassDensity
+                c = ClassDensity(self._class_estimator, c_index)
             self._estimators.append(c)
+        self._set_scorers(X)
         scores = self.score(X, mus=mus, ms=ms)
         self._thresholds = np.zeros(len(self._estimators))
         for c_index in np.arange(n_classes):
@@ -45,6 +101,8 @@ class OcDecomposition(object):
         classes = np.unique(y)
         n_classes = np.alen(classes)
         self._estimators = estimators
+        self._class_estimator = None
+        self._set_scorers(X)
         class_count = np.bincount(y)
         self._priors = class_count / np.alen(y)
         scores = self.score(X, mus=mus, ms=ms)
@@ -54,36 +112,95 @@ class OcDecomposition(object):
             self._thresholds[c_index] = np.percentile(u, threshold_percentile)
         self._means = scores.mean(axis=0)
 
-    def score(self, X, mus=None, ms=None):
+    def _set_scorers(self, X):
+        if type(self._base_estimator) is BackgroundCheck:
+            self._scorers = []
+        else:
+            self._scorers = [EstimatorScorer(estimator, X,
+                                             method=self._score_method)
+                             for estimator in self._estimators]
+
+    def score(self, X, mus=None, ms=None, batch_size=None, out=None,
+              n_jobs=None):
+        """Scores of every one-class estimator on the data in X.
+
+        Args:
+            X (array-like, shape = [n_samples, n_features]): test data. Any
+                object that can be sliced by rows can be used (e.g. a
+                numpy.memmap).
+            batch_size (int): if given, X is processed in blocks of
+                batch_size rows, which bounds the memory used.
+            out (array-like, shape = [n_samples, n_classes]): if given, the
+                scores are written in this array.
+            n_jobs (int): number of threads that process the blocks of X
+                concurrently (-1 uses one thread per CPU). See
+                predict_by_batches.
+
+        Returns:
+            scores (array-like, shape = [n_samples, n_classes]).
+
+        """
         if type(self._base_estimator) is BackgroundCheck:
-            return self.score_bc(X, mus=mus, ms=ms)
+            return self.score_bc(X, mus=mus, ms=ms, batch_size=batch_size,
+                                 out=out, n_jobs=n_jobs)
         elif self._normalization in ["O-norm", "T-norm"]:
-            return self.score_dens(X) + 1e-8    # this value is added to avoid
-                                                # having 0-valued thresholds,
-                                                # which is a problem for o-norm
-
-    def score_dens(self, X):
-        n = np.alen(X)
-        scores = np.zeros((n, len(self._estimators)))
-        for i, estimator in enumerate(self._estimators):
-            s = np.exp(estimator.score(X))
-            scores[range(n), i] = s
-        return scores
-
-    def score_bc(self, X, mus=None, ms=None):
-        n = np.alen(X)
-        probas = np.zeros((n, len(self._estimators)))
-        for i, estimator in enumerate(self._estimators):
-            if mus is None:
-                mu = None
-            else:
-                mu = mus[i]
-            if ms is None:
-                m = None
-            else:
-                m = ms[i]
-            probas[range(n), i] = estimator.predict_proba(X, mu=mu, m=m)[:, 1]
-        return probas
+            scores = self.score_dens(X, batch_size=batch_size, out=out,
+                                     n_jobs=n_jobs)
+            scores += 1e-8  # this value is added to avoid having 0-valued
+                            # thresholds, which is a problem for o-norm
+            return scores
+        else:
+            return None
+
+    def score_dens(self, X, batch_size=None, out=None, n_jobs=None):
+        def score_block(x, scores):
+            if scores is None:
+                scores = np.zeros((np.alen(x), len(self._estimators)))
+            if self._scorers is None:
+                self._set_scorers(x)
+            if self._class_estimator is not None:
+                # The scores are the ones of the scorers of the classes (see
+                # ClassDensity.score), computed for all the classes at once
+                scores[:] = self._class_estimator.score_classes(x)
+                if self._scorers[0].densities:
+                    np.exp(scores, out=scores)
+                return np.exp(scores, out=scores)
+            for i, scorer in enumerate(self._scorers):
+                np.exp(scorer(x), out=scores[:, i])
+            return scores
+
+        return predict_by_batches(score_block, X, batch_size=batch_size,
+                                  out=out, n_jobs=n_jobs)
+
+    def score_bc(self, X, mus=None, ms=None, batch_size=None, out=None,
+                 n_jobs=None):
+        def score_block(x, scores):
+            if scores is None:
+                scores = np.zeros((np.alen(x), len(self._estimators)))
+            if self._class_estimator is not None:
+                class_scores = self._class_estimator.score_classes(x)
+            for i, estimator in enumerate(self._estimators):
+                if mus is None:
+                    mu = None
+                else:
+                    mu = mus[i]
+                if ms is None:
+                    m = None
+                else:
+                    m = ms[i]
+                if self._class_estimator is None:
+                    posteriors = estimator.predict_proba(x, mu=mu, m=m)
+                else:
+                    s = class_scores[:, i].copy()
+                    if estimator._scorer.densities:
+                        np.exp(s, out=s)
+                    posteriors = estimator.predict_proba_scores(s, mu=mu,
+                                                                m=m)
+                scores[:, i] = posteriors[:, 1]
+            return scores
+
+        return predict_by_batches(score_block, X, batch_size=batch_size,
+                                  out=out, n_jobs=n_jobs)
 
     def predict(self, X, mus=None, ms=None):
         scores = self.score(X, mus=mus, ms=ms)
@@ -129,3 +246,14 @@ class OcDecomposition(object):
     @property
     def thresholds(self):
         return self._thresholds
+
+
+def set_label(estimator, label):
+    """Sets the label of a GaussianMixtureSelection (the key of its cache of
+    selections). density_estimators is only imported for estimators with a
+    label attribute."""
+    if not hasattr(estimator, 'label'):
+        return
+    from density_estimators import GaussianMixtureSelection
+    if isinstance(estimator, GaussianMixtureSelection):
+        estimator.label = label
@@ -0,0 +1,186 @@
+import numpy as np
+
+
+class EstimatorScorer(object):
+    """Gives the per-sample scores of a density estimator.
+
+    The estimator is inspected only once, when the scorer is created, to
+    find the method that returns one score per sample. The methods are tried
+    in the following order: score, score_samples (the tuple returned by the
+    old sklearn mixtures is unpacked), logpdf and decision_function. This
+    is the order used by BackgroundCheck and OcDecomposition before the
+    scorer was introduced, so the scores of the bundled estimators are
+    densities (their score method) and not log-densities. Passing
+    method='score_samples' uses the log-densities instead.
+
+    Args:
+        estimator (object): a fitted density estimator.
+        X (array-like, shape = [n_samples, n_features]): samples used to
+            check the output of the methods (only the first two rows are
+            scored).
+        method (string): name of the method to use. If given the estimator
+            is not inspected.
+
+    Attributes:
+        method (string): name of the method used to score the samples.
+        densities (bool): True if the scores are the exponentials of the
+            log-densities given by score_samples (e.g. the score method of
+            MyMultivariateNormal), so the maximum attribute of the estimator
+            is exponentiated too.
+
+    """
+    methods = ['score', 'score_samples', 'logpdf', 'decision_function']
+
+    def __init__(self, estimator, X, method=None):
+        self.estimator = estimator
+        self.method = method
+        probe = X[:2]
+        if method is None:
+            for method in self.methods:
+                if not hasattr(estimator, method):
+                    continue
+                self.method = method
+                if np.alen(self(probe)) == np.alen(probe):
+                    break
+            else:
+                raise ValueError('The estimator {} has no method that '
+                                 'returns a score per sample'.format(
+                                     type(estimator).__name__))
+        self.densities = False
+        self.log_densities = self.method == 'score_samples'
+        if self.method == 'score' and hasattr(estimator, 'score_samples'):
+            scores = self(probe)
+            log_densities = EstimatorScorer(estimator, probe,
+                                            method='score_samples')(probe)
+            self.log_densities = np.allclose(scores, log_densities)
+            with np.errstate(over='ignore'):
+                self.densities = np.allclose(scores, np.exp(log_densities))
+
+    def __call__(self, X):
+        """Scores the samples of X.
+
+        Args:
+            X (array-like, shape = [n_samples, n_features]): samples.
+
+        Returns:
+            (array-like, shape = [n_samples]): scores given by the estimator.
+
+        """
+        s = getattr(self.estimator, self.method)(X)
+        if type(s) is tuple:
+            s = s[0]
+        return np.reshape(s, -1)
+
+    def maximum(self):
+        """Maximum score of the estimator, found without scoring the training
+        data.
+
+        It is the maximum attribute of the estimator if it has one
+        (exponentiated if the scores are densities). Otherwise, if the scores
+        are log-densities, it is found with gmm_maximum for Gaussian mixtures
+        and with kde_maximum for sklearn.neighbors.KernelDensity.
+
+        Returns:
+            (float): the maximum score, or None if it is not known.
+
+        """
+        if hasattr(self.estimator, 'maximum'):
+            maximum = np.ravel(self.estimator.maximum)[0]
+            if self.densities:
+                return np.exp(maximum)
+            return maximum
+        if not self.log_densities:
+            return None
+        if (hasattr(self.estimator, 'means_') and
+                hasattr(self.estimator, 'weights_')):
+            return gmm_maximum(self.estimator)
+        if (hasattr(self.estimator, 'tree_') and
+                hasattr(self.estimator, 'bandwidth')):
+            return kde_maximum(self.estimator)
+        return None
+
+
+def gmm_maximum(gmm, max_iter=100, tol=1e-8):
+    """Log-density of a Gaussian mixture at its highest mode.
+
+    The modes are found with the fixed-point iteration of Carreira-Perpinan
+    (2000), x = (sum_k r_k(x) P_k)^-1 sum_k r_k(x) P_k m_k, where r_k are the
+    responsibilities, P_k the precision matrices and m_k the means, starting
+    from the mean of every component.
+
+    Args:
+        gmm (object): fitted sklearn.mixture.GMM or GaussianMixture.
+        max_iter (int): maximum number of iterations.
+        tol (float): the search stops when no point moves more than tol.
+
+    Returns:
+        (float): log-density at the highest mode found.
+    """
+    means = np.asarray(gmm.means_, dtype=float)
+    n_components, n_features = means.shape
+    if hasattr(gmm, 'covariances_'):
+        covars = np.asarray(gmm.covariances_, dtype=float)
+    else:
+        covars = np.asarray(gmm.covars_, dtype=float)
+    diagonal = gmm.covariance_type in ['spherical', 'diag']
+    if diagonal:
+        precisions = 1.0 / (np.ones((n_components, n_features)) *
+                            covars.reshape(n_components, -1))
+        precision_means = precisions * means
+    else:
+        if gmm.covariance_type == 'tied':
+            covars = np.tile(covars, (n_components, 1, 1))
+        precisions = np.linalg.inv(covars)
+        precision_means = np.einsum('kij,kj->ki', precisions, means)
+
+    x = means.copy()
+    for iteration in range(max_iter):
+        r = gmm.predict_proba(x)
+        if diagonal:
+            new_x = np.dot(r, precision_means) / np.dot(r, precisions)
+        else:
+            new_x = np.linalg.solve(np.einsum('sk,kij->sij', r, precisions),
+                                    np.dot(r, precision_means))
+        shift = np.abs(new_x - x).max()
+        x = new_x
+        if shift < tol:
+            break
+    return EstimatorScorer(gmm, x, method='score_samples')(x).max()
+
+
+def kde_maximum(kde, n_samples=1000, random_state=0):
+    """Maximum log-density of a kernel density estimate over a random subset
+    of its training points.
+
+    Args:
+        kde (sklearn.neighbors.KernelDensity): fitted estimator.
+        n_samples (int): maximum number of training points evaluated.
+        random_state (int): seed used to choose the points (the global
+            random state is not modified).
+
+    Returns:
+        (float): the maximum log-density found.
+    """
+    data = np.asarray(kde.tree_.data)
+    if len(data) > n_samples:
+        indices = np.random.RandomState(random_state).choice(
+            len(data), n_samples, replace=False)
+        data = data[indices]
+    return kde.score_samples(data).max()
+
+
+def test():
+    from sklearn import datasets
+    from sklearn.mixture import GMM
+    from sklearn.mixture import GaussianMixture
+
+    X = datasets.load_iris().data
+    for mixture in [GMM, GaussianMixture]:
+        for covariance_type in ['spherical', 'diag', 'tied', 'full']:
+            gmm = mixture(n_components=3, covariance_type=covariance_type,
+                          random_state=0)
+            gmm.fit(X)
+            training_maximum = EstimatorScorer(gmm, X,
+                                               method='score_samples')(X).max()
+            print "{} {}".format(mixture.__name__, covariance_type)
+            print gmm_maximum(gmm) >= training_maximum
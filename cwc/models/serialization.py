@@ -0,0 +1,1070 @@
+"""
+This module exports fitted models to a directory with one .npy file per
+array and a JSON manifest describing how the arrays are put together, and
+loads them back as light models that only need numpy to make predictions.
+
+The arrays can be memory-mapped when the model is loaded, so loading a
+model does not read its parameters nor import sklearn or scipy (except for
+the search tree of KNNDensity, restored the first time it is queried).
+
+"""
+from __future__ import division
+import os
+import json
+import numpy as np
+
+from batches import predict_by_batches
+from binned_kde import BinnedGaussianKDE
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+
+def save_model(model, path):
+    """Exports a fitted model to the directory path.
+
+    The supported models are BackgroundCheck, OcDecomposition,
+    OvoClassifier, ConfidentClassifier, Ensemble and
+    MyDecisionTreeClassifier, with SVC classifiers (linear, rbf, poly or
+    sigmoid kernel) and MyMultivariateNormal, MultivariateNormal,
+    ProbabilisticPCA, KNNDensity, GMM, GaussianMixture (or the one chosen
+    by GaussianMixtureSelection), KernelDensity (gaussian kernel),
+    MyMultivariateKernelDensity (gaussian kernel, exact or binned),
+    MultivariateKernelDensity (gaussian kernel, exported without its
+    tolerances, or with its representatives), OneClassSVM or
+    ApproximateOneClassSVM density estimators. The classes of a
+    StackedMultivariateNormal or a ClassKernelDensity (see OcDecomposition)
+    are exported as separate estimators.
+
+    Args:
+        model (object): fitted model.
+        path (string): directory where the model is saved. It is created if
+            it does not exist.
+
+    Returns:
+        Nothing.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    writer = ArrayWriter(path)
+    manifest = {'format_version': FORMAT_VERSION,
+                'model': encode(model, writer)}
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def load_model(path, mmap_mode='r'):
+    """Loads a model exported with save_model.
+
+    Args:
+        path (string): directory where the model was saved.
+        mmap_mode (string): mode used to memory-map the arrays (see
+            numpy.load), or None to read them in memory.
+
+    Returns:
+        (object): a model with the same prediction methods as the exported
+        one, that only needs numpy.
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest['format_version'] > FORMAT_VERSION:
+        raise ValueError('Unsupported model format version: {}'.format(
+                         manifest['format_version']))
+    reader = ArrayReader(path, mmap_mode=mmap_mode)
+    return decode(manifest['model'], reader)
+
+
+class ArrayWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.n_arrays = 0
+
+    def add(self, array):
+        name = '{}.npy'.format(self.n_arrays)
+        np.save(os.path.join(self.path, name), np.ascontiguousarray(array))
+        self.n_arrays += 1
+        return name
+
+
+class ArrayReader(object):
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+    def get(self, name):
+        return np.load(os.path.join(self.path, name),
+                       mmap_mode=self.mmap_mode)
+
+
+def is_instance(model, class_name):
+    """Checks the class of a model by name, so that the sklearn classes do
+    not need to be imported (some of them only exist in some versions)."""
+    return any(c.__name__ == class_name for c in type(model).__mro__)
+
+
+def node(model_type, params=None, arrays=None, children=None):
+    return {'type': model_type, 'params': params or {},
+            'arrays': arrays or {}, 'children': children or {}}
+
+
+def encode(model, writer):
+    """Describes a fitted model as a node of the manifest, saving its arrays
+    with writer."""
+    from background_check import BackgroundCheck
+    from confident_classifier import ConfidentClassifier
+    from ensemble import Ensemble
+    from oc_decomposition import OcDecomposition
+    from ovo_classifier import OvoClassifier
+    from density_estimators import MyMultivariateNormal
+    from density_estimators import MultivariateNormal
+    from density_estimators import ProbabilisticPCA
+    from density_estimators import KNNDensity
+    from density_estimators import GaussianMixtureSelection
+    from density_estimators import ApproximateOneClassSVM
+    from density_estimators import ClassDensity
+    from density_estimators import MyMultivariateKernelDensity
+    from density_estimators import MultivariateKernelDensity
+
+    if isinstance(model, BackgroundCheck):
+        return node('background_check',
+                    params={'delta': float(model._delta),
+                            'max_dens': float(model._max_dens),
+                            'mu': float(model._mu), 'm': float(model._m),
+                            'densities': bool(model._scorer.densities)},
+                    children={'estimator': encode(model._estimator, writer)})
+    elif isinstance(model, ConfidentClassifier):
+        if hasattr(model._classifier, '_n_classes'):
+            n_classes = model.n_classes
+        else:
+            n_classes = len(model._classifier.classes_)
+        return node('confident_classifier',
+                    params={'n_classes': int(n_classes)},
+                    children={'classifier': encode(model._classifier, writer),
+                              'bc': encode(model._bc, writer)})
+    elif isinstance(model, OvoClassifier):
+        confident = type(model._base_classifier) is ConfidentClassifier
+        return node('ovo_classifier',
+                    params={'n_classes': int(model._n_classes),
+                            'confident': confident},
+                    arrays={'combinations': writer.add(model._combinations)},
+                    children={'classifiers': [encode(c, writer) for c in
+                                              model._classifiers]})
+    elif isinstance(model, Ensemble):
+        return node('ensemble',
+                    arrays={'weights': writer.add(model._weights)},
+                    children={'classifiers': [encode(c, writer) for c in
+                                              model._classifiers]})
+    elif isinstance(model, OcDecomposition):
+        bc = type(model._base_estimator) is BackgroundCheck
+        return node('oc_decomposition',
+                    params={'normalization': model._normalization, 'bc': bc,
+                            'densities': [bool(s.densities) for s in
+                                          model._scorers]},
+                    arrays={'thresholds': writer.add(model._thresholds),
+                            'priors': writer.add(model._priors),
+                            'means': writer.add(model._means)},
+                    children={'estimators': [encode(e, writer) for e in
+                                             model._estimators]})
+    elif isinstance(model, MyMultivariateNormal):
+        return encode_gaussian(model, writer)
+    elif isinstance(model, MultivariateNormal):
+        return encode_gaussian(MyMultivariateNormal(model.mu, model.sigma),
+                               writer)
+    elif isinstance(model, ClassDensity):
+        return encode_class_density(model, writer)
+    elif isinstance(model, KNNDensity):
+        return encode_knn_density(model, writer)
+    elif isinstance(model, GaussianMixtureSelection):
+        return encode(model.best_estimator_, writer)
+    elif isinstance(model, ApproximateOneClassSVM):
+        feature_map = model.feature_map_
+        if model.kernel_approximation == 'nystroem':
+            arrays = {'components': writer.add(feature_map.components_),
+                      'normalization': writer.add(
+                          feature_map.normalization_)}
+        else:
+            arrays = {'random_weights': writer.add(
+                          feature_map.random_weights_),
+                      'random_offset': writer.add(
+                          feature_map.random_offset_)}
+        arrays['coef'] = writer.add(model.coef_)
+        return node('approximate_one_class_svm',
+                    params={'kernel_approximation':
+                                model.kernel_approximation,
+                            'gamma': float(feature_map.gamma),
+                            'offset': float(model.offset_)},
+                    arrays=arrays)
+    elif isinstance(model, ProbabilisticPCA):
+        return node('probabilistic_pca',
+                    params={'log_norm_const': float(model._log_norm_const),
+                            'noise_variance': float(model.noise_variance_)},
+                    arrays={'mean': writer.add(model.mean_),
+                            'components': writer.add(model.components_),
+                            'variances': writer.add(
+                                model.explained_variance_)})
+    elif (isinstance(model, MyMultivariateKernelDensity) and
+            model._algorithm == 'binned'):
+        return node('binned_product_kernel_density',
+                    children={'features': [encode(e, writer) for e in
+                                           model._estimators]})
+    elif isinstance(model, BinnedGaussianKDE):
+        return node('binned_kernel_density',
+                    params={'bandwidth': float(model.bandwidth),
+                            'rtol': float(model.rtol),
+                            'low': float(model.low),
+                            'delta': float(model.delta)},
+                    arrays={'density': writer.add(model.density),
+                            'error': writer.add(model.error),
+                            'data': writer.add(model.data)})
+    elif isinstance(model, MyMultivariateKernelDensity):
+        if model._kernel != 'gaussian':
+            raise ValueError('Only the gaussian kernel can be exported')
+        data = np.hstack([np.asarray(e.tree_.data) for e in
+                          model._estimators])
+        bandwidths = np.array([e.bandwidth for e in model._estimators])
+        return node('product_kernel_density',
+                    arrays={'data': writer.add(data),
+                            'bandwidths': writer.add(bandwidths)})
+    elif isinstance(model, MultivariateKernelDensity):
+        if model._representatives is None:
+            return encode(model._estimator, writer)
+        return node('kernel_density',
+                    params={'bandwidth': float(model._estimator.bandwidth)},
+                    arrays={'data': writer.add(model._representatives),
+                            'weights': writer.add(model._weights)})
+    elif is_instance(model, 'KernelDensity'):
+        if model.kernel != 'gaussian' or model.metric != 'euclidean':
+            raise ValueError('Only the gaussian kernel with euclidean metric '
+                             'can be exported')
+        return node('kernel_density',
+                    params={'bandwidth': float(model.bandwidth)},
+                    arrays={'data': writer.add(np.asarray(model.tree_.data))})
+    elif is_instance(model, 'GMM') or is_instance(model, 'GaussianMixture'):
+        return encode_gaussian_mixture(model, writer)
+    elif is_instance(model, 'MyDecisionTreeClassifier'):
+        tree = model.tree_
+        return node('tree',
+                    arrays={'children_left': writer.add(tree.children_left),
+                            'children_right': writer.add(tree.children_right),
+                            'feature': writer.add(tree.feature),
+                            'threshold': writer.add(tree.threshold),
+                            'value': writer.add(tree.value[:, 0, :])})
+    elif is_instance(model, 'OneClassSVM'):
+        return node('kernel_expansion',
+                    **encode_kernel_expansion(model, writer))
+    elif is_instance(model, 'SVC'):
+        if len(model.classes_) != 2:
+            raise ValueError('Only binary SVC can be exported')
+        description = encode_kernel_expansion(model, writer)
+        description['arrays']['classes'] = writer.add(model.classes_)
+        if model.probability:
+            description['params']['prob_a'] = float(model.probA_[0])
+            description['params']['prob_b'] = float(model.probB_[0])
+        return node('svc', **description)
+    raise ValueError('Models of type {} can not be exported'.format(
+                     type(model).__name__))
+
+
+def encode_gaussian(model, writer):
+    if model._std is not None:
+        arrays = {'std': writer.add(model._std)}
+    elif model._chol is not None:
+        arrays = {'chol': writer.add(model._chol)}
+    else:
+        arrays = {'whiten': writer.add(model._whiten)}
+    arrays['mean'] = writer.add(model.mu)
+    return node('gaussian',
+                params={'log_norm_const': float(model._log_norm_const)},
+                arrays=arrays)
+
+
+def encode_class_density(model, writer):
+    """Describes the density of one class of a class-aware estimator as the
+    density estimator of that class only."""
+    estimator = model.estimator
+    index = model.index
+    if is_instance(estimator, 'StackedMultivariateNormal'):
+        if estimator.covariance_type == 'diag':
+            arrays = {'std': writer.add(np.sqrt(estimator.covars_[index]))}
+        elif estimator._singular[index]:
+            arrays = {'whiten': writer.add(estimator._factors[index])}
+        else:
+            arrays = {'chol': writer.add(estimator._factors[index])}
+        arrays['mean'] = writer.add(estimator.means_[index])
+        return node('gaussian',
+                    params={'log_norm_const': float(estimator.maximum[index])},
+                    arrays=arrays)
+    elif is_instance(estimator, 'ClassKernelDensity'):
+        data = estimator._data[estimator._labels == index]
+        return node('kernel_density',
+                    params={'bandwidth': float(estimator.bandwidth)},
+                    arrays={'data': writer.add(data)})
+    raise ValueError('Models of type {} can not be exported'.format(
+                     type(estimator).__name__))
+
+
+def encode_knn_density(model, writer):
+    """Describes a KNNDensity with the state of its tree, so that the tree
+    is not built again when the model is loaded."""
+    import sklearn
+    tree_state = []
+    arrays = {}
+    for item in model.tree_.__getstate__():
+        if isinstance(item, np.ndarray):
+            key = 'tree_{}'.format(len(tree_state))
+            arrays[key] = writer.add(item)
+            tree_state.append(['array', key])
+        elif item is None or isinstance(item, (int, long, np.integer)):
+            tree_state.append(['value', None if item is None else int(item)])
+        elif is_instance(item, 'EuclideanDistance'):
+            tree_state.append(['metric', 'euclidean'])
+        else:
+            raise ValueError('The tree of the KNNDensity can not be '
+                             'exported')
+    return node('knn_density',
+                params={'k': int(model._k),
+                        'log_norm_const': float(model._log_norm_const),
+                        'min_distance': float(model.min_distance),
+                        'maximum': float(model._maximum),
+                        'algorithm': model.algorithm,
+                        'leaf_size': int(model.leaf_size),
+                        'batch_size': int(model.batch_size),
+                        'sklearn_version': sklearn.__version__,
+                        'tree_state': tree_state},
+                arrays=arrays)
+
+
+def encode_gaussian_mixture(model, writer):
+    means = np.asarray(model.means_, dtype=float)
+    n_components, n_features = means.shape
+    if hasattr(model, 'covariances_'):
+        covars = np.asarray(model.covariances_, dtype=float)
+    else:
+        covars = np.asarray(model.covars_, dtype=float)
+    if model.covariance_type in ['spherical', 'diag']:
+        std = np.sqrt(np.ones((n_components, n_features)) *
+                      covars.reshape(n_components, -1))
+        whiten = 1.0 / std
+        log_det = np.log(std).sum(axis=1)
+    else:
+        if model.covariance_type == 'tied':
+            covars = np.tile(covars, (n_components, 1, 1))
+        chol = np.linalg.cholesky(covars)
+        whiten = np.transpose(np.linalg.inv(chol), (0, 2, 1))
+        log_det = np.log(np.diagonal(chol, axis1=1, axis2=2)).sum(axis=1)
+    log_weights = np.log(model.weights_)
+    log_norm_consts = (log_weights - log_det -
+                       0.5 * n_features * np.log(2 * np.pi))
+    return node('gaussian_mixture',
+                arrays={'means': writer.add(means),
+                        'whiten': writer.add(whiten),
+                        'log_norm_consts': writer.add(log_norm_consts)})
+
+
+def encode_kernel_expansion(model, writer):
+    params = {'kernel': model.kernel, 'gamma': float(model._gamma),
+              'coef0': float(model.coef0), 'degree': int(model.degree),
+              'intercept': float(model.intercept_[0])}
+    if model.kernel == 'linear':
+        arrays = {'coef': writer.add(model.coef_[0])}
+    else:
+        arrays = {'support_vectors': writer.add(model.support_vectors_),
+                  'dual_coef': writer.add(model.dual_coef_[0])}
+    return {'params': params, 'arrays': arrays}
+
+
+def decode(description, reader):
+    """Builds the numpy model described by a node of the manifest."""
+    model_type = description['type']
+    params = description['params']
+    arrays = dict((key, reader.get(name)) for key, name in
+                  description['arrays'].items())
+    children = {}
+    for key, child in description['children'].items():
+        if type(child) is list:
+            children[key] = [decode(c, reader) for c in child]
+        else:
+            children[key] = decode(child, reader)
+    if model_type not in MODEL_TYPES:
+        raise ValueError('Unknown model type: {}'.format(model_type))
+    return MODEL_TYPES[model_type](params, arrays, children)
+
+
+def expit(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def logsumexp(a, axis):
+    a_max = a.max(axis=axis)
+    a_max[~np.isfinite(a_max)] = 0.0
+    return a_max + np.log(np.exp(a - np.expand_dims(a_max, axis)).sum(
+        axis=axis))
+
+
+def squared_distances(X, Y):
+    distances = ((X * X).sum(axis=1).reshape(-1, 1) - 2 * np.dot(X, Y.T) +
+                 (Y * Y).sum(axis=1))
+    return np.maximum(distances, 0.0, out=distances)
+
+
+class GaussianModel(object):
+    def __init__(self, params, arrays, children):
+        self.log_norm_const = params['log_norm_const']
+        self.mean = arrays['mean']
+        self.std = arrays.get('std')
+        self.chol = arrays.get('chol')
+        self.whiten = arrays.get('whiten')
+        if self.chol is not None:
+            # The inverse of a triangular matrix is computed once so that the
+            # scoring only needs a matrix product
+            self.whiten = np.linalg.inv(self.chol).T
+
+    def score_samples(self, X):
+        x_mu = np.asarray(X, dtype=float).reshape(-1, len(self.mean))
+        x_mu = x_mu - self.mean
+        if self.std is not None:
+            x_mu /= self.std
+        else:
+            x_mu = np.dot(x_mu, self.whiten)
+        return self.log_norm_const - 0.5 * np.einsum('ij,ij->i', x_mu, x_mu)
+
+    @property
+    def maximum(self):
+        return np.array([self.log_norm_const])
+
+
+class ProbabilisticPCAModel(object):
+    def __init__(self, params, arrays, children):
+        self.log_norm_const = params['log_norm_const']
+        self.noise_variance = params['noise_variance']
+        self.mean = arrays['mean']
+        self.components = arrays['components']
+        self.variances = arrays['variances']
+
+    def score_samples(self, X):
+        x_mu = np.asarray(X, dtype=float).reshape(-1, len(self.mean))
+        x_mu = x_mu - self.mean
+        z = np.dot(x_mu, self.components.T)
+        residuals = np.maximum(np.einsum('ij,ij->i', x_mu, x_mu) -
+                               np.einsum('ij,ij->i', z, z), 0)
+        return self.log_norm_const - 0.5 * (
+            np.einsum('ij,ij->i', z / self.variances, z) +
+            residuals / self.noise_variance)
+
+    @property
+    def maximum(self):
+        return np.array([self.log_norm_const])
+
+
+class GaussianMixtureModel(object):
+    def __init__(self, params, arrays, children):
+        self.means = arrays['means']
+        self.whiten = arrays['whiten']
+        self.log_norm_consts = arrays['log_norm_consts']
+
+    def score_samples(self, X):
+        X = np.asarray(X, dtype=float)
+        log_dens = np.empty((np.alen(X), len(self.means)))
+        for k, mean in enumerate(self.means):
+            if self.whiten.ndim == 2:
+                x_mu = (X - mean) * self.whiten[k]
+            else:
+                x_mu = np.dot(X - mean, self.whiten[k])
+            log_dens[:, k] = (self.log_norm_consts[k] -
+                              0.5 * np.einsum('ij,ij->i', x_mu, x_mu))
+        return logsumexp(log_dens, axis=1)
+
+
+class KernelDensityModel(object):
+    def __init__(self, params, arrays, children):
+        self.bandwidth = params['bandwidth']
+        self.data = arrays['data']
+        n = len(self.data)
+        self.log_weights = np.log(arrays.get('weights', np.ones(n) / n))
+
+    def score_samples(self, X, max_distances=2**22):
+        """Log-density of every row of X, computed in blocks of at most
+        max_distances distances to the training samples."""
+        X = np.asarray(X, dtype=float)
+        n, d = self.data.shape
+        scores = np.empty(np.alen(X))
+        batch_size = max(max_distances // n, 1)
+        for start in np.arange(0, np.alen(X), batch_size):
+            end = min(start + batch_size, np.alen(X))
+            log_dens = (-0.5 * squared_distances(X[start:end], self.data) /
+                        self.bandwidth**2 + self.log_weights)
+            scores[start:end] = logsumexp(log_dens, axis=1)
+        return (scores - d * np.log(self.bandwidth) -
+                0.5 * d * np.log(2 * np.pi))
+
+
+class KNNDensityModel(object):
+    """k-nearest-neighbour density of a KNNDensity.
+
+    The tree is restored from its saved state the first time that samples
+    are scored, which imports sklearn. If the model was exported with
+    another version of sklearn the tree is built again from the data.
+    """
+    def __init__(self, params, arrays, children):
+        self.params = params
+        self.arrays = arrays
+        self.k = params['k']
+        self.log_norm_const = params['log_norm_const']
+        self.min_distance = params['min_distance']
+        self.batch_size = params['batch_size']
+        self.tree = None
+
+    def _load_tree(self):
+        import sklearn
+        from sklearn.neighbors import KDTree
+        from sklearn.neighbors import BallTree
+        from sklearn.neighbors import DistanceMetric
+        tree_class = KDTree if self.params['algorithm'] == 'kd_tree' else \
+            BallTree
+        state = []
+        for kind, value in self.params['tree_state']:
+            if kind == 'array':
+                # The tree needs writable arrays
+                state.append(np.require(self.arrays[value],
+                                        requirements=['C', 'W']))
+            elif kind == 'metric':
+                state.append(DistanceMetric.get_metric(value))
+            else:
+                state.append(value)
+        if self.params['sklearn_version'] == sklearn.__version__:
+            tree = tree_class.__new__(tree_class)
+            tree.__setstate__(tuple(state))
+        else:
+            tree = tree_class(state[0], leaf_size=self.params['leaf_size'])
+        return tree
+
+    def score_samples(self, X):
+        if self.tree is None:
+            self.tree = self._load_tree()
+        X = np.asarray(X, dtype=float)
+        n = np.alen(X)
+        distances = np.empty(n)
+        for start in np.arange(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            distances[start:end] = self.tree.query(
+                X[start:end], k=self.k, return_distance=True)[0][:, -1]
+        d = X.shape[1]
+        return (self.log_norm_const -
+                d * np.log(np.maximum(distances, self.min_distance)))
+
+    @property
+    def maximum(self):
+        return np.array([self.params['maximum']])
+
+
+class ProductKernelDensityModel(object):
+    def __init__(self, params, arrays, children):
+        self.data = arrays['data']
+        self.bandwidths = arrays['bandwidths']
+
+    def score_samples(self, X, max_distances=2**22):
+        """Log-density of every row of X, computed in blocks of at most
+        max_distances distances to the training samples."""
+        X = np.asarray(X, dtype=float)
+        n, d = self.data.shape
+        scores = np.zeros(np.alen(X))
+        batch_size = max(max_distances // n, 1)
+        for start in np.arange(0, np.alen(X), batch_size):
+            end = min(start + batch_size, np.alen(X))
+            for feature in np.arange(d):
+                log_dens = -0.5 * ((X[start:end, feature].reshape(-1, 1) -
+                                    self.data[:, feature]) /
+                                   self.bandwidths[feature])**2
+                scores[start:end] += logsumexp(log_dens, axis=1)
+        return scores - (d * (np.log(n) + 0.5 * np.log(2 * np.pi)) +
+                         np.log(self.bandwidths).sum())
+
+
+class BinnedProductKernelDensityModel(object):
+    def __init__(self, params, arrays, children):
+        self._estimators = children['features']
+
+    def score_samples(self, X):
+        X = np.asarray(X, dtype=float)
+        scores = np.zeros(np.alen(X))
+        for feature, estimator in enumerate(self._estimators):
+            scores += estimator.score_samples(X[:, feature])
+        return scores
+
+
+def binned_kernel_density(params, arrays, children):
+    estimator = BinnedGaussianKDE(bandwidth=params['bandwidth'],
+                                  rtol=params['rtol'])
+    estimator.low = params['low']
+    estimator.delta = params['delta']
+    estimator.density = arrays['density']
+    estimator.error = arrays['error']
+    estimator.data = arrays['data']
+    return estimator
+
+
+class KernelExpansionModel(object):
+    """Decision function of a kernel machine (SVC or OneClassSVM)."""
+    def __init__(self, params, arrays, children):
+        self.kernel = params['kernel']
+        self.gamma = params['gamma']
+        self.coef0 = params['coef0']
+        self.degree = params['degree']
+        self.intercept = params['intercept']
+        self.coef = arrays.get('coef')
+        self.support_vectors = arrays.get('support_vectors')
+        self.dual_coef = arrays.get('dual_coef')
+
+    def decision_function(self, X):
+        X = np.asarray(X, dtype=float)
+        if self.kernel == 'linear':
+            return np.dot(X, self.coef) + self.intercept
+        elif self.kernel == 'rbf':
+            K = np.exp(-self.gamma * squared_distances(X,
+                                                       self.support_vectors))
+        elif self.kernel == 'poly':
+            K = (self.gamma * np.dot(X, self.support_vectors.T) +
+                 self.coef0)**self.degree
+        elif self.kernel == 'sigmoid':
+            K = np.tanh(self.gamma * np.dot(X, self.support_vectors.T) +
+                        self.coef0)
+        else:
+            raise ValueError('Unknown kernel: {}'.format(self.kernel))
+        return np.dot(K, self.dual_coef) + self.intercept
+
+    def score_samples(self, X):
+        return self.decision_function(X)
+
+
+class ApproximateOneClassSVMModel(object):
+    def __init__(self, params, arrays, children):
+        self.kernel_approximation = params['kernel_approximation']
+        self.gamma = params['gamma']
+        self.offset = params['offset']
+        self.coef = arrays['coef']
+        self.components = arrays.get('components')
+        self.normalization = arrays.get('normalization')
+        self.random_weights = arrays.get('random_weights')
+        self.random_offset = arrays.get('random_offset')
+
+    def decision_function(self, X, batch_size=4096):
+        X = np.asarray(X, dtype=float)
+        scores = np.empty(np.alen(X))
+        for start in np.arange(0, np.alen(X), batch_size):
+            end = min(start + batch_size, np.alen(X))
+            x = X[start:end]
+            if self.kernel_approximation == 'nystroem':
+                features = np.dot(np.exp(-self.gamma * squared_distances(
+                    x, self.components)), self.normalization.T)
+            else:
+                features = np.cos(np.dot(x, self.random_weights) +
+                                  self.random_offset)
+                features *= np.sqrt(2.0 / len(self.random_offset))
+            scores[start:end] = np.dot(features, self.coef)
+        return scores - self.offset
+
+    def score_samples(self, X):
+        return self.decision_function(X)
+
+
+class SVCModel(KernelExpansionModel):
+    """Binary SVC. The probabilities are computed as in libsvm: Platt's
+    sigmoid of the decision value followed by its pairwise coupling
+    iterations (which for two classes stop close to the sigmoid value)."""
+    def __init__(self, params, arrays, children):
+        super(SVCModel, self).__init__(params, arrays, children)
+        self.classes = arrays['classes']
+        self.prob_a = params.get('prob_a')
+        self.prob_b = params.get('prob_b')
+
+    def predict(self, X):
+        return self.classes[(self.decision_function(X) >= 0).astype(int)]
+
+    def predict_proba(self, X, max_iter=100, min_prob=1e-7):
+        f = -self.decision_function(X) * self.prob_a + self.prob_b
+        e = np.exp(-np.abs(f))
+        r01 = np.where(f >= 0, e / (1.0 + e), 1.0 / (1.0 + e))
+        r01 = np.clip(r01, min_prob, 1 - min_prob)
+        r10 = 1.0 - r01
+        q00 = r10 * r10
+        q01 = -r10 * r01
+        q11 = r01 * r01
+        p0 = np.ones_like(r01) / 2
+        p1 = np.ones_like(r01) / 2
+        active = np.ones(len(r01), dtype=bool)
+        for iteration in range(max_iter):
+            qp0 = q00 * p0 + q01 * p1
+            qp1 = q01 * p0 + q11 * p1
+            pqp = p0 * qp0 + p1 * qp1
+            error = np.maximum(np.abs(qp0 - pqp), np.abs(qp1 - pqp))
+            active &= error >= 0.005 / 2
+            if not active.any():
+                break
+            diff = (pqp - qp0) / q00
+            new_p0 = (p0 + diff) / (1 + diff)
+            new_p1 = p1 / (1 + diff)
+            pqp = (pqp + diff * (diff * q00 + 2 * qp0)) / (1 + diff)**2
+            qp1 = (qp1 + diff * q01) / (1 + diff)
+            diff = (pqp - qp1) / q11
+            new_p0 /= 1 + diff
+            new_p1 = (new_p1 + diff) / (1 + diff)
+            p0 = np.where(active, new_p0, p0)
+            p1 = np.where(active, new_p1, p1)
+        return np.vstack((p0, p1)).T
+
+
+class TreeModel(object):
+    """MyDecisionTreeClassifier (leaf counts with Laplace smoothing)."""
+    def __init__(self, params, arrays, children):
+        self.children_left = arrays['children_left']
+        self.children_right = arrays['children_right']
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.value = arrays['value']
+
+    def apply(self, X):
+        # sklearn compares the features in single precision
+        X = np.asarray(X, dtype=np.float32)
+        nodes = np.zeros(np.alen(X), dtype=np.intp)
+        rows = np.arange(np.alen(X))
+        while True:
+            inner = self.children_left[nodes] != -1
+            if not inner.any():
+                return nodes
+            rows_inner = rows[inner]
+            nodes_inner = nodes[inner]
+            left = (X[rows_inner, self.feature[nodes_inner]] <=
+                    self.threshold[nodes_inner])
+            nodes[inner] = np.where(left, self.children_left[nodes_inner],
+                                    self.children_right[nodes_inner])
+
+    def predict_proba(self, X):
+        alpha = 1
+        leaf_counts = self.value[self.apply(X)] + alpha
+        return leaf_counts/leaf_counts.sum(axis=1).reshape(-1,1)
+
+
+class BackgroundCheckModel(object):
+    def __init__(self, params, arrays, children):
+        self._delta = params['delta']
+        self._max_dens = params['max_dens']
+        self._mu = params['mu']
+        self._m = params['m']
+        # True if the scores were the densities (see EstimatorScorer)
+        self._densities = params['densities']
+        self._estimator = children['estimator']
+
+    def score(self, X):
+        if self._densities:
+            return np.exp(self._estimator.score_samples(X))
+        return self._estimator.score_samples(X)
+
+    def predict_proba(self, X, mu=None, m=None, batch_size=None, out=None):
+        if mu is None:
+            mu = self._mu
+        if m is None:
+            m = self._m
+
+        def predict_block(x, posteriors):
+            q = np.clip(expit(self.score(x) + self._delta) / self._max_dens,
+                        0.0, 1.0)
+            p_x_and_b = q * mu + (1.0 - q) * m
+            if posteriors is None:
+                posteriors = np.empty((np.alen(x), 2))
+            posteriors[:, 0] = p_x_and_b / (p_x_and_b + q)
+            posteriors[:, 1] = 1.0 - posteriors[:, 0]
+            return posteriors
+
+        return predict_by_batches(predict_block, X, batch_size=batch_size,
+                                  out=out)
+
+
+class ConfidentClassifierModel(object):
+    def __init__(self, params, arrays, children):
+        self._classifier = children['classifier']
+        self._bc = children['bc']
+        self.n_classes = params['n_classes']
+
+    def predict_proba(self, X, mu=None, m=None, batch_size=None, out=None):
+        def predict_block(x, posteriors):
+            class_posteriors = self._classifier.predict_proba(x)
+            bc_posteriors = self._bc.predict_proba(x, mu=mu, m=m)
+            if posteriors is None:
+                posteriors = np.empty((np.alen(x),
+                                       class_posteriors.shape[1] + 1))
+            posteriors[:, :-1] = class_posteriors * bc_posteriors[:, 1:]
+            posteriors[:, -1] = bc_posteriors[:, 0]
+            return posteriors
+
+        return predict_by_batches(predict_block, X, batch_size=batch_size,
+                                  out=out)
+
+    def predict(self, X, mu=None, m=None):
+        return np.argmax(self.predict_proba(X, mu, m), axis=1)
+
+
+class OvoClassifierModel(object):
+    def __init__(self, params, arrays, children):
+        self.n_classes = params['n_classes']
+        self._confident = params['confident']
+        self._combinations = arrays['combinations']
+        self._classifiers = children['classifiers']
+
+    def predict_proba(self, X):
+        n = np.alen(X)
+        confidences = np.ones((n, self.n_classes))
+        for index, combination in enumerate(self._combinations):
+            probas = self._classifiers[index].predict_proba(X)
+            confidences[:, combination] *= probas
+        return confidences / (confidences.sum(axis=1).reshape(-1, 1))
+
+    def predict(self, X, mu=None, m=None):
+        n = np.alen(X)
+        rows = np.arange(n)
+        votes = np.zeros((n, self.n_classes))
+        confidences = np.ones((n, self.n_classes))*2
+        check_probs = np.ones((n, self.n_classes))*2
+        for index, combination in enumerate(self._combinations):
+            classifier = self._classifiers[index]
+            if self._confident:
+                probas = classifier.predict_proba(X, mu=mu, m=m)
+                winners = np.argmax(probas[:, :-1], axis=1)
+                new_conf = probas[rows, winners]
+            else:
+                winners = classifier.predict(X)
+                new_conf = expit(classifier.decision_function(X))
+            predictions = combination[winners]
+            votes[rows, predictions] += 1
+            old_conf = confidences[rows, predictions]
+            confidences[rows, predictions] = np.minimum(old_conf, new_conf)
+            if self._confident:
+                old_check = confidences[rows, predictions]
+                check_probs[rows, predictions] = np.minimum(
+                    old_check, 1.0 - probas[:, -1])
+        predictions = votes.argmax(axis=1)
+        if self._confident:
+            return [predictions, confidences[rows, predictions],
+                    check_probs[rows, predictions]]
+        return [predictions, confidences[rows, predictions]]
+
+
+class EnsembleModel(object):
+    def __init__(self, params, arrays, children):
+        self._weights = arrays['weights']
+        self._classifiers = children['classifiers']
+
+    def predict_proba(self, X, batch_size=None, out=None):
+        def predict_block(x, proba):
+            n = np.alen(x)
+            if proba is None:
+                proba = np.zeros((n, self._classifiers[0].n_classes))
+            else:
+                proba[:] = 0.0
+            for c_index, c in enumerate(self._classifiers):
+                if type(c) is OvoClassifierModel:
+                    pred, conf = c.predict(x)[:2]
+                else:
+                    probas = c.predict_proba(x)
+                    pred = np.argmax(probas[:, :-1], axis=1)
+                    conf = probas[np.arange(n), pred]
+                proba[np.arange(n), pred] += conf * self._weights[c_index]
+            proba /= proba.sum(axis=1).reshape(-1, 1)
+            proba[np.isnan(proba)] = 1/proba.shape[1]
+            return proba
+
+        return predict_by_batches(predict_block, X, batch_size=batch_size,
+                                  out=out)
+
+    def predict(self, X, batch_size=None):
+        return self.predict_proba(X, batch_size=batch_size).argmax(axis=1)
+
+
+class OcDecompositionModel(object):
+    def __init__(self, params, arrays, children):
+        self._normalization = params['normalization']
+        self._bc = params['bc']
+        self._thresholds = arrays['thresholds']
+        self._priors = arrays['priors']
+        self._means = arrays['means']
+        self._estimators = children['estimators']
+        self._densities = params['densities']
+
+    def score(self, X, mus=None, ms=None, batch_size=None, out=None):
+        if not self._bc and self._normalization not in ["O-norm", "T-norm"]:
+            return None
+
+        def score_block(x, scores):
+            if scores is None:
+                scores = np.empty((np.alen(x), len(self._estimators)))
+            for i, estimator in enumerate(self._estimators):
+                if self._bc:
+                    mu = None if mus is None else mus[i]
+                    m = None if ms is None else ms[i]
+                    scores[:, i] = estimator.predict_proba(x, mu=mu,
+                                                           m=m)[:, 1]
+                else:
+                    s = estimator.score_samples(x)
+                    if self._densities[i]:
+                        s = np.exp(s)
+                    scores[:, i] = np.exp(s) + 1e-8
+            return scores
+
+        return predict_by_batches(score_block, X, batch_size=batch_size,
+                                  out=out)
+
+    def predict(self, X, mus=None, ms=None, batch_size=None):
+        scores = self.score(X, mus=mus, ms=ms, batch_size=batch_size)
+        if scores is None:
+            return None
+        n_classes = len(self._estimators)
+        reject = scores <= self._thresholds
+        if self._bc:
+            total_reject = (np.sum(reject, axis=1) == n_classes)
+            scores[reject] = -1
+            predictions = scores.argmax(axis=1)
+            predictions[total_reject] = n_classes
+        elif self._normalization == "O-norm":
+            scores /= self._thresholds
+            scores[reject] = -1
+            max_scores = scores.max(axis=1)
+            predictions = scores.argmax(axis=1)
+            predictions[max_scores <= 1] = n_classes
+        elif self._normalization == "T-norm":
+            scores -= self._thresholds
+            means = self._means - self._thresholds
+            scores = (scores / means) * self._priors
+            scores[reject] = -np.inf
+            max_scores = scores.max(axis=1)
+            predictions = scores.argmax(axis=1)
+            predictions[max_scores <= 0] = n_classes
+        return predictions
+
+
+MODEL_TYPES = {'background_check': BackgroundCheckModel,
+               'confident_classifier': ConfidentClassifierModel,
+               'ovo_classifier': OvoClassifierModel,
+               'ensemble': EnsembleModel,
+               'oc_decomposition': OcDecompositionModel,
+               'gaussian': GaussianModel,
+               'gaussian_mixture': GaussianMixtureModel,
+               'probabilistic_pca': ProbabilisticPCAModel,
+               'knn_density': KNNDensityModel,
+               'kernel_density': KernelDensityModel,
+               'product_kernel_density': ProductKernelDensityModel,
+               'binned_product_kernel_density':
+                   BinnedProductKernelDensityModel,
+               'binned_kernel_density': binned_kernel_density,
+               'kernel_expansion': KernelExpansionModel,
+               'svc': SVCModel,
+               'approximate_one_class_svm': ApproximateOneClassSVMModel,
+               'tree': TreeModel}
+
+
+def round_trip(model, X, method, path):
+    """Saves and loads model, and checks that the loaded model gives the
+    same predictions with method on the data in X."""
+    save_model(model, path)
+    loaded = load_model(path)
+    expected = getattr(model, method)(X)
+    result = getattr(loaded, method)(X)
+    if method == 'predict':
+        return np.all(result == expected)
+    return np.allclose(result, expected, rtol=1e-6, atol=1e-10)
+
+
+def test():
+    import shutil
+    import tempfile
+    from sklearn import datasets
+    from sklearn.mixture import GMM
+    from sklearn.neighbors import KernelDensity
+    from sklearn.svm import SVC
+    from sklearn.svm import OneClassSVM
+    from background_check import BackgroundCheck
+    from confident_classifier import ConfidentClassifier
+    from discriminative_models import MyDecisionTreeClassifier
+    from ensemble import Ensemble
+    from oc_decomposition import OcDecomposition
+    from ovo_classifier import OvoClassifier
+    from density_estimators import MyMultivariateNormal
+    from density_estimators import MultivariateNormal
+    from density_estimators import ProbabilisticPCA
+    from density_estimators import KNNDensity
+    from density_estimators import GaussianMixtureSelection
+    from density_estimators import ApproximateOneClassSVM
+    from density_estimators import MyMultivariateKernelDensity
+    from density_estimators import MultivariateKernelDensity
+    from density_estimators import StackedMultivariateNormal
+    from density_estimators import ClassKernelDensity
+
+    np.random.seed(42)
+    dataset = datasets.load_iris()
+    X, y = dataset.data, dataset.target
+    X_test = np.vstack((X, np.random.uniform(0, 8, (50, 4))))
+    ovo = OvoClassifier(base_classifier=SVC(kernel='linear',
+                                            probability=True))
+    classifier = ConfidentClassifier(classifier=ovo,
+                                     estimator=MyMultivariateNormal(),
+                                     mu=0.5, m=0.5)
+    ensemble = Ensemble(base_classifier=classifier, n_ensemble=3)
+    ensemble.fit(X, y)
+
+    path = tempfile.mkdtemp()
+    try:
+        save_model(ensemble, path)
+        loaded = load_model(path)
+        print "Ensemble of ConfidentClassifier"
+        print np.allclose(loaded.predict_proba(X), ensemble.predict_proba(X))
+        print np.all(loaded.predict(X) == ensemble.predict(X))
+
+        estimators = [
+            ('MyMultivariateNormal', MyMultivariateNormal()),
+            ('MyMultivariateNormal full',
+             MyMultivariateNormal(covariance_type='full')),
+            ('MultivariateNormal', MultivariateNormal()),
+            ('ProbabilisticPCA', ProbabilisticPCA(n_components=2)),
+            ('KNNDensity', KNNDensity()),
+            ('GMM', GMM(n_components=3, covariance_type='full')),
+            ('GaussianMixtureSelection',
+             GaussianMixtureSelection(n_components=(1, 2))),
+            ('KernelDensity', KernelDensity(bandwidth=0.5)),
+            ('MyMultivariateKernelDensity',
+             MyMultivariateKernelDensity(bandwidth=0.5)),
+            ('MyMultivariateKernelDensity binned',
+             MyMultivariateKernelDensity(bandwidth=0.5,
+                                         algorithm='binned')),
+            ('MultivariateKernelDensity',
+             MultivariateKernelDensity(bandwidth=0.5, rtol=1e-10)),
+            ('MultivariateKernelDensity representatives',
+             MultivariateKernelDensity(bandwidth=0.5, n_representatives=30)),
+            ('OneClassSVM', OneClassSVM()),
+            ('ApproximateOneClassSVM nystroem', ApproximateOneClassSVM()),
+            ('ApproximateOneClassSVM fourier',
+             ApproximateOneClassSVM(kernel_approximation='fourier'))]
+        for name, estimator in estimators:
+            bc = BackgroundCheck(estimator=estimator)
+            bc.fit(X)
+            print "BackgroundCheck with {}".format(name)
+            print round_trip(bc, X_test, 'predict_proba', path)
+
+        print "ConfidentClassifier with a tree"
+        classifier = ConfidentClassifier(
+            classifier=MyDecisionTreeClassifier(max_depth=3),
+            estimator=MyMultivariateNormal())
+        classifier.fit(X, y)
+        print round_trip(classifier, X_test, 'predict_proba', path)
+
+        for name, estimator, normalization in [
+                ('StackedMultivariateNormal', StackedMultivariateNormal(),
+                 'O-norm'),
+                ('ClassKernelDensity', ClassKernelDensity(bandwidth=0.5),
+                 'T-norm'),
+                ('BackgroundCheck of StackedMultivariateNormal',
+                 BackgroundCheck(StackedMultivariateNormal()), None)]:
+            oc = OcDecomposition(base_estimator=estimator,
+                                 normalization=normalization)
+            oc.fit(X, y)
+            print "OcDecomposition with {}".format(name)
+            print round_trip(oc, X_test, 'predict', path)
+    finally:
+        shutil.rmtree(path)
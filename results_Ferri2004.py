@@ -43,6 +43,8 @@ def accuracy_abstention_curves(y, posteriors, x_train, x_test, n_ws=11):
     bc.fit(x_train)
     absts_bc = np.zeros(n_ws)
     accs_bc = np.zeros(n_ws)
+    mus = (1.0 - ks[0]) * ws + ks[0]
+    bc_posteriors_grid = bc.predict_proba_grid(x_test, mus=mus, ms=[0.0])
 
     for index, w in enumerate(ws):
         taus = (1.0 - ks) * w + ks
@@ -53,8 +55,7 @@ def accuracy_abstention_curves(y, posteriors, x_train, x_test, n_ws=11):
         absts_ferri[index] = abst_ferri
         accs_ferri[index] = acc_ferri
 
-        mu = taus[0]
-        bc_posteriors = bc.predict_proba(x_test, mu=mu, m=0.0)
+        bc_posteriors = bc_posteriors_grid[index, 0]
         p = np.hstack((posteriors*bc_posteriors[:, 1].reshape(-1, 1),
                        bc_posteriors[:, 0].reshape(-1, 1)))
         predictions = np.argmax(p, axis=1)
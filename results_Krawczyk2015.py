@@ -15,6 +15,9 @@ from cwc.data_wrappers.datasets import Data
 from cwc.models.discriminative_models import MyDecisionTreeClassifier
 from cwc.models.background_check import BackgroundCheck
 from cwc.models.oc_decomposition import OcDecomposition
+from cwc.models.density_estimators import ApproximateOneClassSVM
+from cwc.models.density_estimators import GaussianMixtureSelection
+from cwc.models.density_estimators import SelectionCache
 
 import pandas as pd
 from diary import Diary
@@ -98,6 +101,8 @@ def main(dataset_names=None):
                                    'n_folds', n_folds,
                                    'estimator_type', estimator_type])
     data = Data(dataset_names=dataset_names)
+    # Mixture configurations chosen in the first fold of every class
+    gmm_cache = SelectionCache()
     for i, (name, dataset) in enumerate(data.datasets.iteritems()):
         np.random.seed(seed_num)
         dataset.print_summary()
@@ -113,8 +118,13 @@ def main(dataset_names=None):
 
                 if estimator_type == "svm":
                     est = OneClassSVM(nu=0.5, gamma=0.5)
+                elif estimator_type == "approx_svm":
+                    est = ApproximateOneClassSVM(nu=0.5, gamma=0.5)
                 elif estimator_type == "gmm":
                     est = GMM(n_components=3)
+                elif estimator_type == "gmm_select":
+                    est = GaussianMixtureSelection(n_jobs=-1, cache=gmm_cache,
+                                                   key=name)
                 bc = BackgroundCheck(estimator=est)
                 oc = OcDecomposition(base_estimator=bc)
                 oc.fit(x_train, y_train)
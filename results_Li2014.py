@@ -13,6 +13,8 @@ from cwc.models.ovo_classifier import OvoClassifier
 from cwc.models.confident_classifier import ConfidentClassifier
 from cwc.models.ensemble import Ensemble
 from cwc.models.density_estimators import MyMultivariateNormal
+from cwc.models.density_estimators import KNNDensity
+from cwc.models.density_estimators import ApproximateOneClassSVM
 
 import pandas as pd
 from diary import Diary
@@ -146,12 +148,17 @@ def main(dataset_names=None, estimator_type="gmm", mc_iterations=20, n_folds=5,
                 if estimator_type == "svm":
                     gamma = 1.0/x_train.shape[1]
                     est = OneClassSVM(nu=0.1, gamma=gamma)
+                elif estimator_type == "approx_svm":
+                    gamma = 1.0/x_train.shape[1]
+                    est = ApproximateOneClassSVM(nu=0.1, gamma=gamma)
                 elif estimator_type == "gmm":
                     est = GMM(n_components=1)
                 elif estimator_type == "gmm3":
                     est = GMM(n_components=3)
                 elif estimator_type == "mymvn":
                     est = MyMultivariateNormal()
+                elif estimator_type == "knn":
+                    est = KNNDensity(n_neighbors=10)
                 # Multiclass discriminative model with one-vs-one binary class.
                 ovo = OvoClassifier(base_classifier=sv)
                 classifier = ConfidentClassifier(classifier=ovo, estimator=est,
@@ -11,11 +11,12 @@ from sklearn import datasets
 import matplotlib.pyplot as plt
 
 
-def train_reject_model(x, r):
+def train_reject_model(x, r, r_weights=None):
     """Train a classifier of training points
 
     Returns a classifier that predicts high probability values for training
-    points and low probability values for reject points.
+    points and low probability values for reject points. r_weights are the
+    sample weights of the reject points (1 if None).
     """
     model_rej = svm.SVC(C=100.0, cache_size=200, class_weight=None, coef0=0.0,
   decision_function_shape=None, degree=3, gamma=0.55, kernel='rbf',
@@ -23,7 +24,11 @@ def train_reject_model(x, r):
   tol=0.001, verbose=False)
     xr = np.vstack((x, r))
     yr = np.hstack((np.ones(np.alen(x)), np.zeros(np.alen(r)))).T
-    model_rej.fit(xr, yr.astype(int))
+    if r_weights is None:
+        model_rej.fit(xr, yr.astype(int))
+    else:
+        weights = np.hstack((np.ones(np.alen(x)), r_weights))
+        model_rej.fit(xr, yr.astype(int), sample_weight=weights)
 
     return model_rej
 
@@ -38,6 +43,10 @@ def train_classifier_model(x, y):
 
 
 if __name__ == "__main__":
+    # If True the reject model is trained with a fifth of the reject data,
+    # weighted (see reject.create_weighted_reject_data)
+    weighted_reject = False
+
     np.random.seed(1)
 
     dataset = fetch_mldata('MNIST original')
@@ -98,11 +107,24 @@ if __name__ == "__main__":
     # Classifier of training data
     model_clas = train_classifier_model(xk_training, yk_training)
 
-    u = reject.create_reject_data(xk_training,
-                                  proportion=1, method='uniform_hsphere',
-                                  pca=True, pca_variance=0.9,
-                                  pca_components=0, hshape_cov=0,
-                                  hshape_prop_in=0.99, hshape_multiplier=2)
+    if weighted_reject:
+        # A fifth of the reject data, concentrated near the boundary of the
+        # training data and weighted to stand for as much uniform reject
+        # data as training data
+        u, u_weights = reject.create_weighted_reject_data(
+            xk_training, proportion=0.2, method='uniform_hsphere', pca=True,
+            pca_variance=0.9, pca_components=0, hshape_cov=0,
+            hshape_prop_in=0.99, hshape_multiplier=2,
+            boundary_proportion=0.5)
+        u_weights *= np.alen(xk_training) / np.alen(u)
+    else:
+        u = reject.create_reject_data(xk_training,
+                                      proportion=1, method='uniform_hsphere',
+                                      pca=True, pca_variance=0.9,
+                                      pca_components=0, hshape_cov=0,
+                                      hshape_prop_in=0.99,
+                                      hshape_multiplier=2)
+        u_weights = None
 
     model_clas_ks = model_clas.predict_proba(xk_training)
     model_clas_us = model_clas.predict_proba(u)
@@ -111,7 +133,7 @@ if __name__ == "__main__":
     p_u = np.hstack([model_clas_us, u])
 
     # Classifier of unknown data
-    model_rej = train_reject_model(p_x, p_u)
+    model_rej = train_reject_model(p_x, p_u, u_weights)
 
     xk_test = test_set[np.logical_not(np.in1d(test_y, unknown_classes))]
     yk_test = test_y[np.logical_not(np.in1d(test_y, unknown_classes))]